@@ -0,0 +1,733 @@
+import asyncio
+import functools
+import io
+import json
+import logging
+import time
+
+import requests
+
+from marine_eov_broker.CatalogCache import DEFAULT_CACHE_TTL
+from marine_eov_broker.ErddapMarineRI import (SUMMARY_COLUMNS, ErddapDataset, conditional_headers, parse_wms_capabilities,
+                                               response_validators)
+from marine_eov_broker.HttpTransport import HttpTransport
+from marine_eov_broker.LazyImport import LazyModule
+from marine_eov_broker.MarineRiBroker import DEFAULT_SERVER_TIMEOUT, BrokerResponse, ErddapRequest, MarineBroker
+from marine_eov_broker.NVSQueries import sparql_builder
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# pandas is imported on first use, see LazyModule
+pd = LazyModule("pandas")
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncResponse:
+    """
+    Fully read response of an AsyncHttpTransport request.
+    """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def __repr__(self):
+        return f"<AsyncResponse [{self.status_code}]> for {self.url}"
+
+    def raise_for_status(self):
+        # Raise the same exception as the synchronous transport so that callers handle both the same way.
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+class AsyncHttpTransport:
+    """
+    asyncio counterpart of HttpTransport, based on aiohttp.
+    A single global semaphore bounds the number of requests in flight for all the coroutines of the broker,
+    and connections are pooled & limited for each host.
+    """
+
+    def __init__(self, max_in_flight=100, max_per_host=8, timeout=300, retries=3, backoff_factor=0.5):
+        """
+        Keyword arguments:
+        max_in_flight -- maximum number of requests in flight, all hosts included
+        max_per_host -- maximum number of connections for each host
+        timeout -- total timeout in seconds for each request
+        retries -- number of retries for failed connections & transient server errors
+        backoff_factor -- retries are spaced by backoff_factor * 2 ** (retry number - 1) seconds
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncHttpTransport requires aiohttp, install it with : pip install aiohttp")
+        self.max_in_flight = max_in_flight
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._session = None
+        self._semaphore = None
+
+    def __repr__(self):
+        return f"AsyncHttpTransport ({self.max_in_flight} requests in flight, {self.max_per_host} per host)"
+
+    def session(self):
+        # The session & semaphore are created lazily so that they are bound to the running event loop.
+        if self._session is None or self._session.closed:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=self.max_per_host),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def get(self, url, headers=None) -> AsyncResponse:
+        """
+        GET request, retried with an exponential backoff on failed connections & transient server errors.
+        """
+        return await self.request("GET", url, headers=headers)
+
+    async def post(self, url, data=None, headers=None) -> AsyncResponse:
+        """
+        POST request (data is form-encoded if it is a dict), retried like get().
+        """
+        return await self.request("POST", url, data=data, headers=headers)
+
+    async def request(self, method, url, data=None, headers=None) -> AsyncResponse:
+        session = self.session()
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._semaphore:
+                    logger.debug(f"{method} {url}")
+                    async with session.request(method, url, data=data, headers=headers) as resp:
+                        content = await resp.read()
+                        if resp.status not in HttpTransport.RETRY_STATUS_CODES or attempt == self.retries:
+                            return AsyncResponse(url, resp.status, resp.headers, content)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                logger.debug(f"Request to {url} failed with {repr(e)}, will retry.")
+            await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+
+    async def read_csv(self, url, **kwargs) -> "pd.DataFrame":
+        """
+        Downloads a CSV file and loads it in a DataFrame ; raises requests.HTTPError on HTTP errors.
+        Keyword arguments are passed to pandas.read_csv().
+        """
+        resp = await self.get(url)
+        resp.raise_for_status()
+        return pd.read_csv(io.BytesIO(resp.content), **kwargs)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+async def conditional_get_async(url, transport, validators=None):
+    """
+    Coroutine version of ErddapMarineRI.conditional_get() on an AsyncHttpTransport.
+    Returns a tuple (response, validators) where response is None if the content did not change.
+    """
+    validators = validators or {}
+    resp = await transport.get(url, headers=conditional_headers(validators))
+    if resp.status_code == 304:
+        return None, dict(validators)
+    resp.raise_for_status()
+    return resp, response_validators(resp, validators.get("marker"))
+
+
+async def run_blocking(function, *args):
+    """
+    Runs a blocking call (catalog & data caches SQLite queries, file reads & writes) in the default executor
+    of the running event loop, so that the other coroutines are not stalled meanwhile.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args))
+
+
+def write_file(path, content):
+    with open(path, 'wb') as out:
+        out.write(content)
+
+
+class AsyncMarineBroker(MarineBroker):
+    """
+    asyncio variant of MarineBroker : datasets loading, spatiotemporal coverage checks and data downloads
+    are coroutines sharing a single AsyncHttpTransport, so that one event loop can serve many broker queries
+    concurrently without threads.
+
+    Usage :
+    broker = await AsyncMarineBroker.create()
+    response = await broker.submit_request(["EV_SEATEMP"], "2022-01-16", "2022-01-17", -40, 35, 2, 62, "nc")
+    await broker.fetch_response_data_async(response)
+    await broker.close()
+    """
+
+    def __init__(self, erddap_servers=MarineBroker.DEFAULT_ERDDAP_SERVERS,
+                 sparql_endpoints=MarineBroker.DEFAULT_SPARQL_ENDPOINTS,
+                 cache_dir=None, cache_ttl=DEFAULT_CACHE_TTL, transport=None, coverage_cache=None, data_cache=None,
+                 server_timeout=DEFAULT_SERVER_TIMEOUT, bulk_metadata=True, vocabularies_bundle=None,
+                 async_transport=None):
+        """Create a new broker ; nothing is loaded until load_async() is awaited (see create()).
+
+        Keyword arguments are the ones of MarineBroker, and :
+        async_transport -- AsyncHttpTransport used by the coroutines of the broker
+        """
+        self.init_state(erddap_servers, cache_dir, cache_ttl, transport, coverage_cache, data_cache,
+                        server_timeout, bulk_metadata, vocabularies_bundle)
+        # The synchronous transport set up by init_state() is kept for the inherited methods
+        # (SPARQL queries, ErddapRequest helpers).
+        self.async_transport = async_transport if async_transport is not None else AsyncHttpTransport()
+        # allDatasets tables, datasets metadata & EOVs vocabularies being downloaded, see datasets_summaries_async(),
+        # load_datasets_metadata_async() & load_vocabularies_async()
+        self._summaries_tasks = {}
+        self._metadata_tasks = {}
+        self._vocabularies_tasks = {}
+        # asyncio tasks scanning each Erddap server, see load_async()
+        self.ready = {}
+        self.build_index()
+
+    @classmethod
+    async def create(cls, *args, wait=True, **kwargs):
+        """
+        Creates a broker and loads its datasets (the EOVs vocabularies are resolved when first requested).
+        If wait is False, the broker is returned while the Erddap servers are still being scanned in background.
+        """
+        broker = cls(*args, **kwargs)
+        await broker.load_async(wait)
+        return broker
+
+    async def close(self):
+        await self.async_transport.close()
+
+    async def load_async(self, wait=True):
+        """
+        Scans all the Erddap servers concurrently : each server is listed & its datasets
+        loaded in a task (see the ready attribute), and each dataset can be queried as soon as it is loaded.
+        Servers & datasets which fail to load are reported in failed_servers & failed_datasets.
+        """
+        start = time.time()
+        self.ready = {erddap_server: asyncio.ensure_future(self.load_erddap_server_async(erddap_server))
+                      for erddap_server in self.erddap_servers}
+        for task in self.ready.values():
+            # Failures are reported in failed_servers, the tasks exceptions are retrieved to be logged only once
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+        if wait:
+            await self.wait_ready_async(self.server_timeout)
+        self.update_index()
+        logger.debug(f"Loaded {len(self.datasets)} datasets in {time.time() - start} seconds.")
+
+    async def load_erddap_server_async(self, erddap_server) -> int:
+        """
+        Coroutine version of MarineBroker.load_erddap_server().
+        """
+        start = time.time()
+        try:
+            datasets_list = await self.find_datasets_in_erddap_server_async(erddap_server)
+        except Exception as e:
+            self.failed_servers[erddap_server] = f"Could not get datasets list : {repr(e)}"
+            logger.warning(f"Could not get datasets list of {erddap_server} : {repr(e)}")
+            raise
+        with self._datasets_lock:
+            self.datasets_list.extend([(erddap_server, dataset_id) for dataset_id in datasets_list
+                                       if (erddap_server, dataset_id) not in self.datasets_list])
+
+        tasks = [asyncio.ensure_future(self.load_dataset_async(erddap_server, dataset_id)) for dataset_id in datasets_list]
+        if len(tasks) == 0:
+            return 0
+        timeout = None if self.server_timeout is None else max(0, self.server_timeout - (time.time() - start))
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        loaded = sum(task.result() is not None for task in done)
+
+        if len(pending) > 0:
+            self.failed_servers[erddap_server] = (f"Timed out after {self.server_timeout} seconds, "
+                                                  f"{len(pending)} datasets out of {len(tasks)} not loaded")
+            logger.warning(f"{erddap_server} : {self.failed_servers[erddap_server]}")
+        else:
+            self.failed_servers.pop(erddap_server, None)
+        logger.info(f"Loaded {loaded} datasets out of {len(tasks)} from {erddap_server} in {time.time() - start} seconds.")
+        return loaded
+
+    async def load_dataset_async(self, erddap_server, dataset_id):
+        """
+        Coroutine version of MarineBroker.load_dataset().
+        """
+        try:
+            dataset = await self.get_dataset_async(erddap_server, dataset_id)
+        except Exception as e:
+            self.failed_datasets[(erddap_server, dataset_id)] = repr(e)
+            logger.warning(f"Could not load {dataset_id} from {erddap_server} : {repr(e)}")
+            return None
+        self.register_dataset(dataset)
+        return dataset
+
+    def wait_ready(self, timeout=None) -> dict:
+        """
+        The servers are scanned by the event loop, which can not be blocked : this only reports
+        the failed servers. Use wait_ready_async() to wait for the servers.
+        """
+        self.update_index()
+        return self.failed_servers
+
+    async def wait_ready_async(self, timeout=None) -> dict:
+        """
+        Coroutine version of MarineBroker.wait_ready().
+        """
+        if len(self.ready) > 0:
+            done, pending = await asyncio.wait(list(self.ready.values()), timeout=timeout)
+            for erddap_server, task in self.ready.items():
+                if task in pending:
+                    self.failed_servers.setdefault(erddap_server, f"Still loading after {timeout} seconds")
+                    logger.warning(f"{erddap_server} is still loading after {timeout} seconds, "
+                                   f"its datasets are registered as they are loaded.")
+        self.update_index()
+        return self.failed_servers
+
+    async def find_datasets_in_erddap_server_async(self, erddap_server) -> list:
+        """
+        Returns the dataset IDs configured for an Erddap server, or all the datasets it hosts if None.
+        """
+        if self.erddap_servers[erddap_server] is not None:
+            return list(self.erddap_servers[erddap_server])
+        if self.catalog_cache is not None:
+            datasets_list = await run_blocking(self.catalog_cache.get_server_datasets, erddap_server)
+            if datasets_list is not None:
+                return datasets_list
+        summaries = await self.datasets_summaries_async(erddap_server) if self.bulk_metadata else {}
+        if len(summaries) > 0:
+            datasets_list = list(summaries)
+        else:
+            erddap_datasets_list = await self.async_transport.read_csv(f"{erddap_server}/info/index.csv")
+            datasets_list = erddap_datasets_list[erddap_datasets_list["Dataset ID"] != "allDatasets"]["Dataset ID"].to_list()
+        if self.catalog_cache is not None:
+            await run_blocking(self.catalog_cache.put_server_datasets, erddap_server, datasets_list)
+        return datasets_list
+
+    async def datasets_summaries_async(self, erddap_server) -> dict:
+        """
+        Coroutine version of MarineBroker.datasets_summaries() : the allDatasets table of a server
+        is downloaded once, by the first coroutine needing it.
+        """
+        if erddap_server not in self._summaries_tasks:
+            self._summaries_tasks[erddap_server] = asyncio.ensure_future(self.fetch_datasets_summaries_async(erddap_server))
+        summaries = await self._summaries_tasks[erddap_server]
+        self._summaries[erddap_server] = summaries
+        return summaries
+
+    async def fetch_datasets_summaries_async(self, erddap_server) -> dict:
+        try:
+            all_datasets = await self.async_transport.read_csv(
+                f"{erddap_server}/tabledap/allDatasets.csv?{'%2C'.join(SUMMARY_COLUMNS)}", skiprows=[1])
+        except Exception as e:
+            logger.warning(f"Could not get allDatasets table from {erddap_server} : {repr(e)}")
+            return {}
+        return self.summaries_from_table(all_datasets)
+
+    async def cached_async(self, get_cached, fetch, put_cached, description):
+        """
+        Coroutine version of MarineBroker.cached() : fetch is a coroutine function,
+        get_cached & put_cached are run in the executor of the event loop.
+        """
+        if self.catalog_cache is None:
+            return await fetch()
+        value = await run_blocking(get_cached, False)
+        if value is not None:
+            return value
+        try:
+            value = await fetch()
+        except Exception as e:
+            value = await run_blocking(get_cached, True)
+            if value is None:
+                raise
+            logger.warning(f"Failed to refresh {description} ({str(e)}), using stale catalog cache entry.")
+            return value
+        await run_blocking(put_cached, value)
+        return value
+
+    async def get_dataset_async(self, erddap_server, dataset_id) -> ErddapDataset:
+        """
+        Coroutine version of MarineBroker.get_dataset() : a fresh catalog cache entry is used as is,
+        a stale one is revalidated (see fetch_dataset_async()).
+        """
+        start = time.time()
+        erddap_dataset = await self.cached_async(
+            lambda allow_stale: self.catalog_cache.get_dataset(erddap_server, dataset_id, allow_stale),
+            lambda: self.fetch_dataset_async(erddap_server, dataset_id),
+            self.catalog_cache.put_dataset if self.catalog_cache is not None else None,
+            f"{dataset_id} at {erddap_server}"
+        )
+        if isinstance(erddap_dataset, dict):
+            erddap_dataset = ErddapDataset.from_record(erddap_dataset, self.transport)
+        logger.debug(f"Loaded {dataset_id} in {time.time() - start} seconds.")
+        return erddap_dataset
+
+    async def fetch_dataset_async(self, erddap_server, dataset_id) -> ErddapDataset:
+        """
+        Coroutine version of MarineBroker.fetch_dataset() : the metadata (and WMS for griddap) of new datasets
+        is downloaded concurrently, and stale catalog cache entries are revalidated.
+        """
+        record = None
+        if self.catalog_cache is not None:
+            record = await run_blocking(self.catalog_cache.get_dataset, erddap_server, dataset_id, True)
+        summary = (await self.datasets_summaries_async(erddap_server)).get(dataset_id)
+        marker = None if summary is None else self.summary_marker(summary)
+        if self.bulk_metadata and summary is not None and (record is None or record["metadata"] is None):
+            erddap_dataset = ErddapDataset(erddap_server, dataset_id, transport=self.transport, summary=summary)
+            erddap_dataset.validators["marker"] = marker
+            return erddap_dataset
+        if record is not None:
+            erddap_dataset = ErddapDataset.from_record(record, self.transport)
+            await self.revalidate_dataset_async(erddap_dataset, marker)
+            return erddap_dataset
+
+        metadata_url = f"{erddap_server}/info/{dataset_id}/index.csv"
+        resp, validators = await conditional_get_async(metadata_url, self.async_transport, {"marker": marker})
+        metadata = pd.read_csv(io.BytesIO(resp.content))
+        griddap_attributes = await self.griddap_attributes_async(erddap_server, dataset_id, metadata)
+        erddap_dataset = ErddapDataset(erddap_server, dataset_id, metadata=metadata,
+                                       griddap_attributes=griddap_attributes, transport=self.transport)
+        erddap_dataset.validators = validators
+        return erddap_dataset
+
+    async def griddap_attributes_async(self, erddap_server, dataset_id, metadata):
+        """
+        Downloads the WMS values of a griddap dataset (see ErddapMarineRI.parse_wms_capabilities()) ;
+        returns None if its metadata DataFrame is not the one of a griddap dataset.
+        """
+        is_grid = ((metadata["Variable Name"] == "NC_GLOBAL") & (metadata["Attribute Name"] == "cdm_data_type")
+                   & (metadata["Value"] == "Grid")).any()
+        if not is_grid:
+            return None
+        wms_resp = await self.async_transport.get(
+            f"{erddap_server}/wms/{dataset_id}/request?service=WMS&request=GetCapabilities&version=1.3.0")
+        wms_resp.raise_for_status()
+        return parse_wms_capabilities(wms_resp.content)
+
+    async def revalidate_dataset_async(self, dataset, marker=None) -> bool:
+        """
+        Coroutine version of ErddapDataset.revalidate().
+        """
+        if dataset.marker_unchanged(marker):
+            return False
+        resp, validators = await conditional_get_async(dataset.metadata_url, self.async_transport, dataset.validators)
+        griddap_attributes = None
+        if resp is not None and validators.get("checksum") != dataset.validators.get("checksum"):
+            griddap_attributes = await self.griddap_attributes_async(dataset.server, dataset.name,
+                                                                     pd.read_csv(io.BytesIO(resp.content)))
+        return dataset.update_metadata(resp, validators, marker, griddap_attributes)
+
+    async def load_dataset_metadata_async(self, dataset):
+        """
+        Coroutine version of ErddapDataset.load_metadata().
+        """
+        resp, validators = await conditional_get_async(dataset.metadata_url, self.async_transport)
+        metadata = pd.read_csv(io.BytesIO(resp.content))
+        griddap_attributes = await self.griddap_attributes_async(dataset.server, dataset.name, metadata)
+        if dataset.metadata_loaded:
+            return
+        validators["marker"] = dataset.validators.get("marker")
+        dataset.apply_metadata(metadata, griddap_attributes)
+        dataset.validators = validators
+
+    async def load_datasets_metadata_async(self, datasets):
+        """
+        Coroutine version of MarineBroker.load_datasets_metadata() : the metadata of each dataset is downloaded
+        once, by the first coroutine needing it. Failures are reported in failed_datasets.
+        """
+        datasets = [dataset for dataset in datasets if not dataset.metadata_loaded]
+        if len(datasets) == 0:
+            return
+
+        async def load_metadata(dataset):
+            key = (dataset.server, dataset.name)
+            task = self._metadata_tasks.get(key)
+            if task is None:
+                task = self._metadata_tasks[key] = asyncio.ensure_future(self.load_dataset_metadata_async(dataset))
+                task.add_done_callback(lambda task: self._metadata_tasks.pop(key, None))
+            try:
+                await task
+            except Exception as e:
+                self.failed_datasets[key] = repr(e)
+                logger.warning(f"Could not load metadata of {dataset.name} from {dataset.server} : {repr(e)}")
+                return
+            if self.catalog_cache is not None:
+                await run_blocking(self.catalog_cache.put_dataset, dataset)
+
+        start = time.time()
+        await asyncio.gather(*[load_metadata(dataset) for dataset in datasets])
+        logger.debug(f"Loaded metadata of {len(datasets)} datasets in {time.time() - start} seconds.")
+
+    async def load_vocabularies_async(self, eovs):
+        """
+        Coroutine version of EovVocabularies.load() : the EOVs not resolved yet are resolved
+        in a single call to build_all_vocabularies_async(), shared by the coroutines needing them.
+        """
+        for eov in eovs:
+            if eov not in self.vocabularies:
+                raise KeyError(eov)
+        loaded = self.vocabularies.loaded()
+        missing = [eov for eov in dict.fromkeys(eovs) if eov not in loaded]
+        new = [eov for eov in missing if eov not in self._vocabularies_tasks]
+        if len(new) > 0:
+            async def resolve():
+                try:
+                    self.vocabularies.update(await self.build_all_vocabularies_async(new))
+                finally:
+                    for eov in new:
+                        self._vocabularies_tasks.pop(eov, None)
+            task = asyncio.ensure_future(resolve())
+            for eov in new:
+                self._vocabularies_tasks[eov] = task
+        tasks = {self._vocabularies_tasks[eov] for eov in missing if eov in self._vocabularies_tasks}
+        await asyncio.gather(*tasks)
+
+    async def build_all_vocabularies_async(self, eovs) -> dict:
+        """
+        Coroutine version of MarineBroker.build_all_vocabularies().
+        """
+        start = time.time()
+        vocabularies = {}
+        if self.catalog_cache is not None:
+            for eov in eovs:
+                rows = await run_blocking(self.catalog_cache.get_vocabulary, eov)
+                if rows is not None:
+                    vocabularies[eov] = rows
+        missing = [eov for eov in eovs if eov not in vocabularies]
+        if len(missing) == 0:
+            return vocabularies
+
+        try:
+            fetched = await self.query_all_vocabularies_async(missing)
+        except Exception as e:
+            if self.catalog_cache is None:
+                raise
+            fetched = {eov: await run_blocking(self.catalog_cache.get_vocabulary, eov, True) for eov in missing}
+            if any(rows is None for rows in fetched.values()):
+                raise
+            logger.warning(f"Failed to refresh {', '.join(missing)} vocabularies ({str(e)}), using stale catalog cache entries.")
+        else:
+            if self.catalog_cache is not None:
+                for eov, rows in fetched.items():
+                    await run_blocking(self.catalog_cache.put_vocabulary, eov, rows)
+        vocabularies.update(fetched)
+        logger.debug(f"Gathering vocabularies took {time.time() - start} seconds.")
+        return vocabularies
+
+    async def query_all_vocabularies_async(self, eovs) -> dict:
+        """
+        Coroutine version of MarineBroker.query_all_vocabularies() : the SPARQL query is sent to the vocabulary
+        server through the async transport, as a form-encoded POST like the synchronous KGSource (SPARQL protocol,
+        JSON results), so that the query length is not limited by the URL length.
+        """
+        query = sparql_builder().build_syntax("eov_batch_query.sparql", eovs=eovs)
+        resp = await self.async_transport.post(self.vocabularies_server, data={"query": query},
+                                               headers={"Accept": "application/sparql-results+json"})
+        resp.raise_for_status()
+        vocabularies = {eov: [] for eov in eovs}
+        for binding in json.loads(resp.content)["results"]["bindings"]:
+            row = {key: value["value"] for key, value in binding.items()}
+            vocabularies[row.pop("eov_code")].append(row)
+        return vocabularies
+
+    async def candidate_datasets_async(self, eovs, start, end,
+                                       query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> list:
+        """
+        Coroutine version of MarineBroker.candidate_datasets() : the vocabularies & the metadata of the candidates
+        are downloaded through the async transport, and the in-memory indexes are updated once they are loaded.
+        """
+        await self.load_vocabularies_async(eovs)
+        self.update_index()
+        candidates = self.index.candidates(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+        await self.load_datasets_metadata_async(candidates)
+        self.update_index()
+        eov_datasets = set()
+        for eov in eovs:
+            eov_datasets.update(self.eov_datasets.get(eov, {}).keys())
+        return [dataset for dataset in candidates if dataset in eov_datasets]
+
+    async def estimate_request_async(self, request, count_query=False):
+        """
+        Coroutine version of MarineBroker.estimate_request() : tabledap rows are counted through the async transport.
+        """
+        self.estimate_request(request)
+        if request.estimated_rows is None and count_query and request.dataset.protocol == "tabledap":
+            try:
+                df = await self.async_transport.read_csv(request.count_url(), skiprows=[1])
+                rows = int(df[request.count_variable()].iloc[0]) if len(df) > 0 else 0
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    logger.warning(f"Could not count the rows of {request.dataset.name} : {str(e)}")
+                    return request
+                rows = 0
+            request.estimated_rows = rows
+            request.estimated_bytes = rows * request.row_size()
+        return request
+
+    async def apply_budget_async(self, requests_list, max_rows=None, max_bytes=None, policy="split"):
+        """
+        Coroutine version of MarineBroker.apply_budget() : the requests sizes are estimated concurrently.
+        """
+        budgeted = max_rows is not None or max_bytes is not None
+        await asyncio.gather(*[self.estimate_request_async(request, count_query=budgeted) for request in requests_list])
+        return self.apply_budget(requests_list, max_rows, max_bytes, policy, estimated=True)
+
+    async def covers_spatiotemporal_query_async(self, dataset, start, end,
+                                                query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> bool:
+        """
+        Coroutine version of MarineBroker.covers_spatiotemporal_query().
+        """
+        if dataset.protocol != "tabledap":
+            return dataset.covers_griddap_query(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+
+        covered = self.grid_coverage(dataset, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+        if covered is not None:
+            return covered
+        key = self.coverage_cache.key(dataset, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+        covered = self.coverage_cache.get(key)
+        if covered is not None:
+            return covered
+        probe_url = dataset.coverage_probe_url(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+        try:
+            df = await self.async_transport.read_csv(probe_url)
+        except requests.HTTPError as e:
+            logger.debug(f"Query failed with exception {str(e)}")
+            # Erddap answers 404 when the query has no matching results ; other failed probes are not cached
+            if e.response is not None and e.response.status_code == 404:
+                self.coverage_cache.put(key, False)
+            return False
+        covered = df.size > 0
+        self.coverage_cache.put(key, covered)
+        return covered
+
+    async def setup_request_for_dataset_async(self,
+                                              dataset,
+                                              eovs,
+                                              query_start_date,
+                                              query_end_date,
+                                              query_min_lon,
+                                              query_min_lat,
+                                              query_max_lon,
+                                              query_max_lat,
+                                              output_format,
+                                              query_specific_variables=None,
+                                              **request_options):
+        """
+        Coroutine version of MarineBroker.setup_request_for_dataset().
+        """
+        variables_found = self.find_variables_in_dataset(dataset, eovs)
+        if len(variables_found) == 0:
+            return None
+
+        if await self.covers_spatiotemporal_query_async(dataset, query_start_date, query_end_date,
+                                                        query_min_lon, query_min_lat, query_max_lon, query_max_lat):
+            return ErddapRequest(dataset,
+                                 variables_found,
+                                 query_min_lon,
+                                 query_min_lat,
+                                 query_max_lon,
+                                 query_max_lat,
+                                 query_start_date,
+                                 query_end_date,
+                                 output_format,
+                                 query_specific_variables,
+                                 data_cache=self.data_cache,
+                                 **request_options)
+        return None
+
+    async def submit_request(self,
+                             eovs,
+                             query_start_date,
+                             query_end_date,
+                             query_min_lon,
+                             query_min_lat,
+                             query_max_lon,
+                             query_max_lat,
+                             output_format,
+                             depth_range=None,
+                             strides=None,
+                             resolution=None,
+                             aggregation=None,
+                             max_rows=None,
+                             max_bytes=None,
+                             budget_policy="split") -> BrokerResponse:
+        """
+        Coroutine version of MarineBroker.submit_request() : the datasets are checked concurrently.
+        """
+        if isinstance(eovs, str):
+            eovs = [eovs]
+
+        self.check_variables(eovs,
+                             query_start_date,
+                             query_end_date,
+                             query_min_lon,
+                             query_min_lat,
+                             query_max_lon,
+                             query_max_lat,
+                             output_format)
+
+        response = BrokerResponse(eovs)
+        candidates = await self.candidate_datasets_async(eovs, query_start_date, query_end_date,
+                                                         query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+        results = await asyncio.gather(*[
+            self.setup_request_for_dataset_async(dataset,
+                                                 eovs,
+                                                 query_start_date,
+                                                 query_end_date,
+                                                 query_min_lon,
+                                                 query_min_lat,
+                                                 query_max_lon,
+                                                 query_max_lat,
+                                                 output_format,
+                                                 depth_range=depth_range,
+                                                 strides=strides,
+                                                 resolution=resolution,
+                                                 aggregation=aggregation)
+            for dataset in candidates
+        ])
+        kept, response.dropped = await self.apply_budget_async([result for result in results if result is not None],
+                                                               max_rows, max_bytes, budget_policy)
+        for request in kept:
+            response.add_query(request)
+        return response
+
+    async def get_nc_data_async(self, request) -> io.BytesIO:
+        """
+        Coroutine version of ErddapRequest.get_nc_data() ; the data is kept in the request so that
+        its synchronous helpers (to_xarray(), to_pandas_dataframe()) do not download it again.
+        The data cache is read & written in the executor of the event loop.
+        """
+        if request.nc_data is None and request.data_cache is not None:
+            request.nc_data = await run_blocking(request.get_cached_nc_data)
+        if request.nc_data is None:
+            resp = await self.async_transport.get(request.build_url(output_format="nc"))
+            resp.raise_for_status()
+            request.nc_data = resp.content
+            if request.data_cache is not None:
+                await run_blocking(request.data_cache.put_bytes, request, resp.content)
+        return io.BytesIO(request.nc_data)
+
+    async def fetch_response_data_async(self, response, return_exceptions=True) -> list:
+        """
+        Downloads the NetCDF data of all the requests of a BrokerResponse concurrently.
+        Returns the list of exceptions raised by failed downloads.
+        """
+        requests_list = response.queries.query_object.tolist() if response.queries is not None else []
+        results = await asyncio.gather(*[self.get_nc_data_async(request) for request in requests_list],
+                                       return_exceptions=return_exceptions)
+        return [result for result in results if isinstance(result, Exception)]
+
+    async def download_async(self, request, output_format, filename=""):
+        """
+        Coroutine version of ErddapRequest.download().
+        """
+        if filename == "":
+            filename = f'{request.dataset.name}-{str(int(time.time()))}'
+        resp = await self.async_transport.get(request.build_url(output_format=output_format))
+        resp.raise_for_status()
+        await run_blocking(write_file, f"{filename}.{output_format}", resp.content)
+        return True
@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Default time (in seconds) after which a cached entry must be fetched again from the network.
+DEFAULT_CACHE_TTL = 24 * 3600
+
+
+class CatalogCache:
+    """
+    Persistent store for the broker catalog, kept in a SQLite database under a cache directory.
+    It holds :
+    - the datasets list of each Erddap server queried with a None datasets list
+    - the ErddapDataset records (metadata, griddap WMS values, bounding box)
+    - the vocabulary rows returned by NVS for each EOV
+    - the coverage grids of the tabledap datasets (see CoverageGrid)
+
+    Every entry is timestamped ; entries older than the TTL are considered stale and will be fetched again
+    by the broker. Stale entries are still returned by the get_*(allow_stale=True) calls so that the broker
+    can fall back on them when a server is unreachable.
+    """
+
+    def __init__(self, cache_dir, ttl=DEFAULT_CACHE_TTL):
+        """
+        Arguments:
+        cache_dir: directory where the catalog database is stored (created if missing)
+        ttl: time to live of the cached entries, in seconds
+        """
+        cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, "catalog.sqlite")
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS servers (
+                    server TEXT PRIMARY KEY,
+                    datasets TEXT NOT NULL,
+                    fetched_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS datasets (
+                    server TEXT NOT NULL,
+                    dataset_id TEXT NOT NULL,
+                    record TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (server, dataset_id)
+                );
+                CREATE TABLE IF NOT EXISTS vocabularies (
+                    eov TEXT PRIMARY KEY,
+                    rows TEXT NOT NULL,
+                    fetched_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS coverage_grids (
+                    server TEXT NOT NULL,
+                    dataset_id TEXT NOT NULL,
+                    record TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (server, dataset_id)
+                );
+            """)
+
+    def __repr__(self):
+        return f"CatalogCache at {self.path} (ttl={self.ttl}s)"
+
+    def is_fresh(self, fetched_at):
+        return self.ttl is None or time.time() - fetched_at < self.ttl
+
+    def _get(self, query, parameters, allow_stale):
+        with self._lock:
+            row = self._connection.execute(query, parameters).fetchone()
+        if row is None:
+            return None
+        value, fetched_at = row
+        if not allow_stale and not self.is_fresh(fetched_at):
+            return None
+        return json.loads(value)
+
+    def _put(self, query, parameters):
+        with self._lock, self._connection:
+            self._connection.execute(query, parameters)
+
+    def get_server_datasets(self, server, allow_stale=False):
+        """
+        Returns the cached list of dataset IDs for an Erddap server, or None.
+        """
+        return self._get("SELECT datasets, fetched_at FROM servers WHERE server = ?", (server,), allow_stale)
+
+    def put_server_datasets(self, server, dataset_ids):
+        self._put("INSERT OR REPLACE INTO servers VALUES (?, ?, ?)",
+                  (server, json.dumps(list(dataset_ids)), time.time()))
+
+    def get_dataset(self, server, dataset_id, allow_stale=False):
+        """
+        Returns the cached record of a dataset (see ErddapDataset.to_record()), or None.
+        """
+        return self._get("SELECT record, fetched_at FROM datasets WHERE server = ? AND dataset_id = ?",
+                         (server, dataset_id), allow_stale)
+
+    def put_dataset(self, dataset):
+        """
+        Stores an ErddapDataset object.
+        """
+        self._put("INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?)",
+                  (dataset.server, dataset.name, json.dumps(dataset.to_record()), time.time()))
+
+    def get_vocabulary(self, eov, allow_stale=False):
+        """
+        Returns the cached NVS rows for an EOV, or None.
+        """
+        return self._get("SELECT rows, fetched_at FROM vocabularies WHERE eov = ?", (eov,), allow_stale)
+
+    def put_vocabulary(self, eov, rows):
+        self._put("INSERT OR REPLACE INTO vocabularies VALUES (?, ?, ?)",
+                  (eov, json.dumps(rows), time.time()))
+
+    def get_coverage_grid(self, server, dataset_id, allow_stale=False):
+        """
+        Returns the cached record of a dataset coverage grid (see CoverageGrid.to_record()), or None.
+        """
+        return self._get("SELECT record, fetched_at FROM coverage_grids WHERE server = ? AND dataset_id = ?",
+                         (server, dataset_id), allow_stale)
+
+    def put_coverage_grid(self, server, dataset_id, grid):
+        self._put("INSERT OR REPLACE INTO coverage_grids VALUES (?, ?, ?, ?)",
+                  (server, dataset_id, json.dumps(grid.to_record()), time.time()))
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        with self._lock, self._connection:
+            self._connection.executescript("DELETE FROM servers; DELETE FROM datasets; DELETE FROM vocabularies; "
+                                           "DELETE FROM coverage_grids;")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
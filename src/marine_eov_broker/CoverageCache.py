@@ -0,0 +1,105 @@
+import collections
+import logging
+import threading
+import time
+
+from marine_eov_broker.ErddapMarineRI import to_datetime64
+
+logger = logging.getLogger(__name__)
+
+
+class CoverageCache:
+    """
+    LRU/TTL cache of the tabledap spatiotemporal coverage probes (see ErddapDataset.probe_tabledap_coverage()).
+
+    Results are keyed by server, dataset, bounding box quantized on a `resolution` degrees grid and time window.
+    When a query window is not cached, results of other windows of the same dataset are reused when they decide it :
+    - a window containing a window with data also has data
+    - a window contained in a window without data has no data either
+    """
+
+    def __init__(self, maxsize=4096, ttl=3600, resolution=0.001):
+        """
+        Keyword arguments:
+        maxsize -- maximum number of probe results kept
+        ttl -- time in seconds after which a probe result is dropped
+        resolution -- grid step in degrees used to quantize the bounding boxes
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.resolution = resolution
+        self._entries = collections.OrderedDict()
+        self._dataset_keys = collections.defaultdict(set)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.window_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f"CoverageCache with {len(self)} probe results ({self.stats()})"
+
+    def key(self, dataset, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> tuple:
+        bbox = tuple(int(round(float(value) / self.resolution))
+                     for value in (query_min_lon, query_min_lat, query_max_lon, query_max_lat))
+        window = tuple(to_datetime64(value) for value in (start, end))
+        return (dataset.server, dataset.name) + bbox + window
+
+    @staticmethod
+    def contains(outer_key, inner_key) -> bool:
+        o_min_lon, o_min_lat, o_max_lon, o_max_lat, o_start, o_end = outer_key[2:]
+        i_min_lon, i_min_lat, i_max_lon, i_max_lat, i_start, i_end = inner_key[2:]
+        if None in (o_start, o_end, i_start, i_end):
+            return False
+        return (o_min_lon <= i_min_lon and o_min_lat <= i_min_lat and o_max_lon >= i_max_lon and o_max_lat >= i_max_lat
+                and o_start <= i_start and o_end >= i_end)
+
+    def get(self, key):
+        """
+        Returns the cached coverage (True / False) for a key returned by key(), or None if it is unknown.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            for other_key in list(self._dataset_keys[key[:2]]):
+                covered, stored_at = self._entries[other_key]
+                if now - stored_at >= self.ttl:
+                    self._remove(other_key)
+                    continue
+                if (covered and self.contains(key, other_key)) or (not covered and self.contains(other_key, key)):
+                    self._entries.move_to_end(other_key)
+                    self.window_hits += 1
+                    return covered
+
+            self.misses += 1
+            return None
+
+    def put(self, key, covered):
+        with self._lock:
+            self._entries[key] = (covered, time.time())
+            self._entries.move_to_end(key)
+            self._dataset_keys[key[:2]].add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._dataset_keys[key[:2]].discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dataset_keys.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the hits (exact key), window hits (decided by another window), misses & size counters.
+        """
+        return {"hits": self.hits, "window_hits": self.window_hits, "misses": self.misses, "size": len(self._entries)}
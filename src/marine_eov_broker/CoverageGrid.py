@@ -0,0 +1,127 @@
+import base64
+import io
+import logging
+import time
+
+import numpy as np
+
+from marine_eov_broker.ErddapMarineRI import to_datetime64
+
+logger = logging.getLogger(__name__)
+
+
+def month_index(value):
+    """
+    Returns the number of months between 1970-01 and a datetime64 value.
+    """
+    return value.astype("datetime64[M]").astype(int)
+
+
+class CoverageGrid:
+    """
+    Coarse space-time occupancy grid of a tabledap dataset : number of values for each month and each
+    `resolution` x `resolution` degrees cell, computed once by the Erddap server with an orderByCount query.
+
+    Only the occupied cells are stored (sparse arrays of month, latitude cell, longitude cell & count),
+    so that a query window is answered with a few numpy comparisons instead of a request.
+    """
+
+    def __init__(self, months, lat_cells, lon_cells, counts, resolution=1.0, built_at=None):
+        """
+        Arguments:
+        months: months since 1970-01 of the occupied cells
+        lat_cells / lon_cells: floor(latitude / resolution) & floor(longitude / resolution) of the occupied cells
+        counts: number of values in the occupied cells
+
+        Keyword arguments:
+        resolution: cells size in degrees
+        built_at: timestamp of the grid computation ; data added afterwards is not in the grid
+        """
+        self.months = np.asarray(months, dtype=np.int32)
+        self.lat_cells = np.asarray(lat_cells, dtype=np.int32)
+        self.lon_cells = np.asarray(lon_cells, dtype=np.int32)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.resolution = resolution
+        self.built_at = built_at if built_at is not None else time.time()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __repr__(self):
+        return f"CoverageGrid with {len(self)} occupied cells of {self.resolution} degrees x 1 month"
+
+    @staticmethod
+    def count_query_url(dataset, count_variables, resolution=1.0) -> str:
+        variables = "%2C".join(count_variables)
+        return (f"{dataset.data_url}.csv?time%2Clatitude%2Clongitude%2C{variables}"
+                f"&orderByCount(%22time/1month,latitude/{resolution},longitude/{resolution}%22)")
+
+    @classmethod
+    def build(cls, dataset, resolution=1.0):
+        """
+        Computes the occupancy grid of a tabledap dataset with an orderByCount query on its Erddap server.
+        The non-null values of each variable of the dataset having a "sdn_parameter_urn" are counted, and a cell
+        holds the largest of these counts : a cell is occupied as soon as one of the variables has data in it.
+        Returns None if the dataset has no such variable.
+        """
+        if len(dataset.parameters) == 0:
+            return None
+        count_variables = list(dict.fromkeys(dataset.parameters.values()))
+        start = time.time()
+        df = dataset.transport.read_csv(cls.count_query_url(dataset, count_variables, resolution), skiprows=[1])
+        df = df.dropna(subset=["time", "latitude", "longitude"])
+        times = np.array([to_datetime64(value) for value in df["time"]], dtype="datetime64[s]")
+        grid = cls(month_index(times),
+                   np.floor(df["latitude"].to_numpy(dtype=float) / resolution + 1e-9),
+                   np.floor(df["longitude"].to_numpy(dtype=float) / resolution + 1e-9),
+                   df[count_variables].fillna(0).max(axis=1).to_numpy(),
+                   resolution)
+        logger.debug(f"Built coverage grid of {dataset.name} with {len(grid)} cells in {time.time() - start} seconds.")
+        return grid
+
+    def count(self, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> int:
+        """
+        Returns the number of values in the cells intersecting the query constraints.
+        """
+        mask = ((self.lat_cells * self.resolution <= float(query_max_lat))
+                & ((self.lat_cells + 1) * self.resolution >= float(query_min_lat))
+                & (self.lon_cells * self.resolution <= float(query_max_lon))
+                & ((self.lon_cells + 1) * self.resolution >= float(query_min_lon)))
+        query_start = to_datetime64(start)
+        query_end = to_datetime64(end)
+        if query_start is not None:
+            mask &= self.months >= month_index(query_start)
+        if query_end is not None:
+            mask &= self.months <= month_index(query_end)
+        return int(self.counts[mask].sum())
+
+    def covers(self, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat):
+        """
+        Checks if the dataset has data within the query constraints according to the grid.
+
+        Returns True if an occupied cell intersects the query, False if none does,
+        or None if the query window reaches the month the grid was built in (newer data may exist).
+        """
+        if self.count(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) > 0:
+            return True
+        query_end = to_datetime64(end)
+        if query_end is None or month_index(query_end) >= month_index(np.datetime64(int(self.built_at), "s")):
+            return None
+        return False
+
+    def to_record(self) -> dict:
+        """
+        Returns a JSON-serializable description of the grid, see CoverageGrid.from_record().
+        """
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, months=self.months, lat_cells=self.lat_cells,
+                            lon_cells=self.lon_cells, counts=self.counts)
+        return {"resolution": self.resolution,
+                "built_at": self.built_at,
+                "cells": base64.b64encode(buffer.getvalue()).decode("ascii")}
+
+    @classmethod
+    def from_record(cls, record):
+        cells = np.load(io.BytesIO(base64.b64decode(record["cells"])))
+        return cls(cells["months"], cells["lat_cells"], cells["lon_cells"], cells["counts"],
+                   record["resolution"], record["built_at"])
@@ -0,0 +1,298 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+from marine_eov_broker.ErddapMarineRI import coordinate_slice, to_datetime64
+from marine_eov_broker.LazyImport import LazyModule
+
+# xarray is imported on first use, see LazyModule
+xr = LazyModule("xarray")
+
+logger = logging.getLogger(__name__)
+
+# Default maximum size (in bytes) of the downloaded data kept on disk.
+DEFAULT_DATA_CACHE_SIZE = 5 * 1024 ** 3
+
+
+def canonical_url(url) -> str:
+    """
+    Normalizes an Erddap query URL so that equivalent URLs share a cache entry :
+    scheme & host are lowercased and the query is percent-decoded.
+    """
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"),
+                                    urllib.parse.unquote(parts.query), ""))
+
+
+def url_variables(url) -> list:
+    """
+    Returns the variables requested by an Erddap query URL, e.g. ["time", "latitude", "longitude", "platform_number", "temp"]
+    for a tabledap query or ["TEMP"] for a griddap query.
+    """
+    query = urllib.parse.unquote(urllib.parse.urlsplit(url).query).split("&")[0]
+    return [variable.split("[")[0] for variable in query.split(",") if variable.split("[")[0] != ""]
+
+
+def dataset_version(dataset) -> str:
+    """
+    Returns the version marker of a dataset : its revalidation validators (ETag, Last-Modified,
+    metadata checksum, allDatasets time coverage), so that cached data is not reused once the dataset changed.
+    """
+    return json.dumps(dataset.validators, sort_keys=True)
+
+
+class DataCache:
+    """
+    Content-addressed disk cache of the NetCDF results of the ErddapRequest objects.
+
+    Files are named after the hash of the canonical query URL and of the dataset version marker,
+    and indexed in a SQLite database with the query constraints. The cache is bounded in size :
+    least recently used files are evicted first.
+
+    A request which is not cached can also be answered by slicing a cached request on the same dataset & version
+    whose constraints contain the requested ones (sub-window reuse).
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_DATA_CACHE_SIZE, ttl=None, subset_reuse=True):
+        """
+        Arguments:
+        cache_dir: directory where the data files & their index are stored (created if missing)
+
+        Keyword arguments:
+        max_bytes: maximum size of the cached files, in bytes
+        ttl: time in seconds after which a cached file is dropped ; None to only rely on the dataset version
+        subset_reuse: if True, requests contained in a cached request are sliced locally from it
+        """
+        cache_dir = os.path.expanduser(cache_dir)
+        self.data_dir = os.path.join(cache_dir, "data")
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, "data.sqlite")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.subset_reuse = subset_reuse
+        self.hits = 0
+        self.subset_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    server TEXT NOT NULL,
+                    dataset_id TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    constraints TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS entries_dataset ON entries (server, dataset_id, version);
+            """)
+
+    def __repr__(self):
+        return f"DataCache at {self.cache_dir} ({self.stats()})"
+
+    @staticmethod
+    def key(request) -> str:
+        url = canonical_url(request.build_url(output_format="nc"))
+        return hashlib.sha256(f"{url}\n{dataset_version(request.dataset)}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def constraints(request) -> dict:
+        """
+        Returns the query constraints of a request used to find the cached requests containing it.
+        """
+        start = to_datetime64(request.query_start_date)
+        end = to_datetime64(request.query_end_date)
+        return {
+            "protocol": request.dataset.protocol,
+            # All the variables of the query URL, including the ones added to every tabledap query (platform_number...)
+            "variables": sorted(set(url_variables(request.build_url(output_format="nc")))),
+            "specific_variable": request.query_specific_variable,
+            # Aggregated / strided / depth-restricted data can not be sliced to answer other requests
+            "subset": request.is_subset(),
+            "start": None if start is None else str(start.astype("datetime64[s]")),
+            "end": None if end is None else str(end.astype("datetime64[s]")),
+            "bbox": [float(request.query_min_lon), float(request.query_min_lat),
+                     float(request.query_max_lon), float(request.query_max_lat)],
+        }
+
+    @staticmethod
+    def contains(outer, inner) -> bool:
+        if None in (outer["start"], outer["end"], inner["start"], inner["end"]):
+            return False
+        if outer.get("subset", False) or inner.get("subset", False):
+            return False
+        return (outer["protocol"] == inner["protocol"]
+                and outer["specific_variable"] == inner["specific_variable"]
+                and set(inner["variables"]) <= set(outer["variables"])
+                and outer["start"] <= inner["start"] and outer["end"] >= inner["end"]
+                and outer["bbox"][0] <= inner["bbox"][0] and outer["bbox"][1] <= inner["bbox"][1]
+                and outer["bbox"][2] >= inner["bbox"][2] and outer["bbox"][3] >= inner["bbox"][3])
+
+    def file_path(self, key) -> str:
+        return os.path.join(self.data_dir, f"{key}.nc")
+
+    def is_fresh(self, created_at):
+        return self.ttl is None or time.time() - created_at < self.ttl
+
+    def _touch(self, key):
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+
+    def _remove(self, key):
+        # Called with the lock held
+        self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+        if os.path.exists(self.file_path(key)):
+            os.remove(self.file_path(key))
+
+    def get(self, request):
+        """
+        Returns the path of the cached NetCDF file of the request, or None if it is not cached.
+        """
+        key = self.key(request)
+        with self._lock:
+            row = self._connection.execute("SELECT created_at FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None or not self.is_fresh(row[0]) or not os.path.exists(self.file_path(key)):
+            return None
+        self._touch(key)
+        self.hits += 1
+        return self.file_path(key)
+
+    def get_subset(self, request):
+        """
+        Looks for a cached request on the same dataset version containing the request constraints,
+        and returns its data sliced to the request constraints in an xarray Dataset, or None (counted as a miss).
+        """
+        if not self.subset_reuse:
+            self.misses += 1
+            return None
+        constraints = self.constraints(request)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key, constraints, created_at FROM entries WHERE server = ? AND dataset_id = ? AND version = ?"
+                " ORDER BY size", (request.dataset.server, request.dataset.name, dataset_version(request.dataset))).fetchall()
+        for key, cached_constraints, created_at in rows:
+            if not self.is_fresh(created_at) or not self.contains(json.loads(cached_constraints), constraints):
+                continue
+            if not os.path.exists(self.file_path(key)):
+                continue
+            ds = xr.open_dataset(self.file_path(key))
+            if not set(constraints["variables"]) <= set(ds.variables):
+                ds.close()
+                continue
+            self._touch(key)
+            self.subset_hits += 1
+            logger.debug(f"Slicing cached data of {request.dataset.name} for {request.query_url}")
+            return self.slice(ds, constraints)
+        self.misses += 1
+        return None
+
+    @staticmethod
+    def slice(ds, constraints) -> "xr.Dataset":
+        """
+        Restricts the data of a cached request to the variables & constraints of a contained request.
+        """
+        start = np.datetime64(constraints["start"])
+        end = np.datetime64(constraints["end"])
+        min_lon, min_lat, max_lon, max_lat = constraints["bbox"]
+        variables = [variable for variable in constraints["variables"] if variable in ds.data_vars]
+        for coordinate in ("time", "latitude", "longitude"):
+            if coordinate in ds.data_vars and coordinate not in variables:
+                variables.append(coordinate)
+        ds = ds[variables]
+
+        if constraints["protocol"] == "tabledap":
+            mask = ((ds["time"].values >= start) & (ds["time"].values <= end)
+                    & (ds["latitude"].values >= min_lat) & (ds["latitude"].values <= max_lat)
+                    & (ds["longitude"].values >= min_lon) & (ds["longitude"].values <= max_lon))
+            return ds.isel({ds["time"].dims[0]: np.flatnonzero(mask)})
+
+        return ds.sel(time=coordinate_slice(ds["time"].values, start, end),
+                      latitude=coordinate_slice(ds["latitude"].values, min_lat, max_lat),
+                      longitude=coordinate_slice(ds["longitude"].values, min_lon, max_lon))
+
+    def put(self, request, path) -> str:
+        """
+        Moves a downloaded NetCDF file of the request into the cache.
+        Files larger than max_bytes are not cached.
+        Returns the path of the cached file, or path if the file is not cached.
+        """
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            logger.debug(f"{path} ({size} bytes) is larger than the data cache, it is not cached.")
+            return path
+        key = self.key(request)
+        cached_path = self.file_path(key)
+        constraints = json.dumps(self.constraints(request))
+        now = time.time()
+        with self._lock, self._connection:
+            os.replace(path, cached_path)
+            self._connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (key, canonical_url(request.build_url(output_format="nc")),
+                                      request.dataset.server, request.dataset.name, dataset_version(request.dataset),
+                                      constraints, size, now, now))
+            self._evict(keep=key)
+        return cached_path
+
+    def put_bytes(self, request, data) -> str:
+        """
+        Stores downloaded NetCDF data of the request in the cache.
+        Returns the path of the cached file, or None if the data is larger than max_bytes.
+        """
+        if len(data) > self.max_bytes:
+            return None
+        fd, path = tempfile.mkstemp(suffix=".part", dir=self.data_dir)
+        with os.fdopen(fd, "wb") as out:
+            out.write(data)
+        return self.put(request, path)
+
+    def evict(self):
+        """
+        Removes the least recently used files until the cache size is below max_bytes, and the expired ones.
+        """
+        with self._lock, self._connection:
+            self._evict()
+
+    def _evict(self, keep=None):
+        # Called with the lock held ; the entry keep (just inserted by put()) is never evicted
+        rows = self._connection.execute("SELECT key, size, created_at FROM entries ORDER BY key = ? DESC, last_access DESC",
+                                        (keep,)).fetchall()
+        total = 0
+        for key, size, created_at in rows:
+            total += size
+            if key != keep and (total > self.max_bytes or not self.is_fresh(created_at)):
+                self._remove(key)
+                self.evictions += 1
+                total -= size
+
+    def clear(self):
+        with self._lock, self._connection:
+            for (key,) in self._connection.execute("SELECT key FROM entries").fetchall():
+                self._remove(key)
+
+    def stats(self) -> dict:
+        """
+        Returns the hits, subset hits (sliced from a containing request), misses, evictions,
+        number of entries & size in bytes of the cache.
+        """
+        with self._lock:
+            entries, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"hits": self.hits, "subset_hits": self.subset_hits, "misses": self.misses,
+                "evictions": self.evictions, "entries": entries, "bytes": size}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
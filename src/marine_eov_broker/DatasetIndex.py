@@ -0,0 +1,74 @@
+import logging
+
+import numpy as np
+
+from marine_eov_broker.ErddapMarineRI import to_datetime64
+
+logger = logging.getLogger(__name__)
+
+
+class DatasetIndex:
+    """
+    In-memory index over the bounding boxes & time coverages of a list of ErddapDataset objects.
+    It discards the datasets which can not match a query before any request is sent to their server.
+
+    Coverages are stored as numpy arrays, so that a query is answered with a few vectorized comparisons.
+    The pruning is conservative : datasets with unknown coverage (missing metadata, longitudes
+    outside of [-180, 180]) are always kept as candidates.
+    """
+
+    def __init__(self, datasets):
+        """
+        Arguments:
+        datasets: list of ErddapDataset objects
+        """
+        self.datasets = list(datasets)
+
+        def coordinates(attribute):
+            return np.array([getattr(dataset, attribute) if getattr(dataset, attribute) is not None else np.nan
+                             for dataset in self.datasets], dtype=float)
+
+        def dates(attribute):
+            return np.array([getattr(dataset, attribute) if getattr(dataset, attribute) is not None else np.datetime64("NaT")
+                             for dataset in self.datasets], dtype="datetime64[s]")
+
+        self.min_lon = coordinates("min_lon")
+        self.max_lon = coordinates("max_lon")
+        self.min_lat = coordinates("min_lat")
+        self.max_lat = coordinates("max_lat")
+        self.start_date = dates("start_date")
+        self.end_date = dates("end_date")
+
+        # Longitudes in the 0-360 convention can not be compared with the query ones.
+        unknown_lon = (self.min_lon < -180) | (self.max_lon > 180)
+        self.min_lon[unknown_lon] = np.nan
+        self.max_lon[unknown_lon] = np.nan
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def __repr__(self):
+        return f"DatasetIndex over {len(self.datasets)} datasets"
+
+    def candidates(self, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> list:
+        """
+        Returns the datasets whose coverage may intersect the query constraints.
+
+        Arguments:
+        start / end: (str) start/end dates of the query
+        query_min/max_lon/lat : float
+        """
+        # Comparisons with NaN / NaT are False, so datasets with unknown coverage are never excluded.
+        excluded = ((self.max_lon < float(query_min_lon)) | (self.min_lon > float(query_max_lon))
+                    | (self.max_lat < float(query_min_lat)) | (self.min_lat > float(query_max_lat)))
+
+        query_start = to_datetime64(start)
+        query_end = to_datetime64(end)
+        if query_start is not None:
+            excluded |= self.end_date < query_start.astype("datetime64[s]")
+        if query_end is not None:
+            excluded |= self.start_date > query_end.astype("datetime64[s]")
+
+        candidates = [self.datasets[i] for i in np.flatnonzero(~excluded)]
+        logger.debug(f"Index kept {len(candidates)} candidate datasets out of {len(self.datasets)}.")
+        return candidates
@@ -1,19 +1,154 @@
+import hashlib
+import io
+import sys
 import time
-import pandas as pd
+import zlib
 import numpy as np
-import asyncio
-from shapely.geometry import box
 import logging
 
 import requests
 import xml.etree.ElementTree as ET
-from urllib.error import HTTPError
+
+from marine_eov_broker.HttpTransport import default_transport
+from marine_eov_broker.LazyImport import LazyModule
+
+# Heavy dependencies are imported on first use, see LazyModule
+pd = LazyModule("pandas")
+geometry = LazyModule("shapely.geometry")
 
 logger = logging.getLogger(__name__)
+
+
+def to_datetime64(value):
+    """
+    Converts a date string (any of the broker input formats or Erddap ISO 8601 dates) to a UTC numpy datetime64,
+    or returns None if the value can not be parsed.
+    """
+    if value is None:
+        return None
+    try:
+        timestamp = pd.Timestamp(value)
+    except (TypeError, ValueError):
+        return None
+    if timestamp is pd.NaT:
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp.to_datetime64()
+
+
+def to_datetime64_array(values) -> np.ndarray:
+    """
+    Converts a list of date strings to a sorted array of unique UTC datetime64[s] values ; unparseable values are dropped.
+    """
+    if isinstance(values, np.ndarray) and np.issubdtype(values.dtype, np.datetime64):
+        return np.unique(values[~np.isnat(values)].astype("datetime64[s]"))
+    times = pd.to_datetime(pd.Series(list(values), dtype=object), errors="coerce", utc=True)
+    times = times.dropna().dt.tz_localize(None).to_numpy(dtype="datetime64[s]")
+    return np.unique(times)
+
+
+# Size in bytes of the Erddap data types, used to estimate the size of the requests
+DATA_TYPE_SIZES = {"byte": 1, "ubyte": 1, "char": 2, "short": 2, "ushort": 2, "int": 4, "uint": 4,
+                   "long": 8, "ulong": 8, "float": 4, "double": 8, "String": 16}
+
+
+def coordinate_slice(values, low, high) -> slice:
+    """
+    Returns the slice selecting the coordinate values between low and high with xarray .sel(),
+    whether the coordinate is ascending or descending (e.g. latitudes of some grids).
+    """
+    return slice(high, low) if len(values) > 1 and values[0] > values[-1] else slice(low, high)
+
+
+def parse_wms_capabilities(data) -> dict:
+    """
+    Extracts the time & elevation dimensions values and the bounding box of a griddap dataset
+    from its Erddap WMS GetCapabilities document.
+    Returns a dict of keyword arguments for ErddapDataset.set_griddap_attributes().
+    """
+    root = ET.fromstring(data)
+    griddap_attributes = {"wms_time_values": [], "wms_elevation_values": [], "bbox": None}
+
+    # Erddap wms xml is not parseable with owslib, so we expect the dimensions to be available in the matrix below :
+    for i in root[1][2][2]:
+        if i.tag.endswith("Dimension"):
+            if i.attrib.get("name", "") == "time":
+                griddap_attributes["wms_time_values"] = to_datetime64_array(i.text.split(','))
+            elif i.attrib.get("name", "") == "elevation":
+                wms_elevation_values = [float(elevation_value) for elevation_value in i.text.split(',')]
+                griddap_attributes["wms_elevation_values"] = [abs(ev) if ev < 0 else ev for ev in wms_elevation_values]
+    # Also retrieve the bounding box for the dataset
+    for i in root[1][2][2]:
+        if i.tag == "{http://www.opengis.net/wms}BoundingBox":
+            griddap_attributes["bbox"] = [float(i.attrib.get("minx", -180.0)),
+                                          float(i.attrib.get("miny", -90.0)),
+                                          float(i.attrib.get("maxx", 180.0)),
+                                          float(i.attrib.get("maxy", 90.0))]
+    return griddap_attributes
+
+
+def conditional_get(url, validators=None, transport=None):
+    """
+    GET request revalidating a previous response with its ETag / Last-Modified validators.
     
+    Arguments:
+    url: requested url
+    validators: dict returned by a previous call for the same url, or None
+    transport: HttpTransport used for the request (shared default transport if None)
+    
+    Returns a tuple (response, validators) where response is None if the content did not change.
+    """
+    validators = validators or {}
+    resp = (transport or default_transport()).get(url, headers=conditional_headers(validators))
+    if resp.status_code == 304:
+        return None, dict(validators)
+    resp.raise_for_status()
+    return resp, response_validators(resp, validators.get("marker"))
+
+
+def conditional_headers(validators) -> dict:
+    """
+    Returns the If-None-Match / If-Modified-Since headers revalidating a previous response, see conditional_get().
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def response_validators(resp, marker=None) -> dict:
+    """
+    Returns the validators of a metadata response, see conditional_get().
+    """
+    return {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "checksum": hashlib.sha1(resp.content).hexdigest(),
+        "marker": marker,
+    }
+
+
+# Columns of the Erddap allDatasets table used to describe a dataset without downloading its metadata
+SUMMARY_COLUMNS = ["datasetID", "dataStructure", "cdm_data_type", "minLongitude", "maxLongitude",
+                   "minLatitude", "maxLatitude", "minTime", "maxTime"]
+# Attributes parsed from the info metadata ; they are only downloaded when needed by datasets created from a summary
+METADATA_ATTRIBUTES = {"global_attributes", "variables", "data_types", "dimensions", "parameters", "depth_variables",
+                       "wms_capabilities", "wms_time_values", "wms_elevation_values"}
+
 
 class ErddapDataset:
-    def __init__(self, erddap_server, name):
+    # The metadata table is parsed once in plain dicts and only kept as compressed CSV,
+    # the datasets of large Erddap servers being numerous.
+    __slots__ = ("server", "transport", "name", "data_url", "metadata_url", "protocol",
+                 "start_date", "end_date", "min_lon", "max_lon", "min_lat", "max_lat",
+                 "validators", "summary", "metadata_loaded", "_metadata_csv",
+                 "global_attributes", "variables", "data_types", "dimensions", "parameters", "depth_variables",
+                 "found_eovs", "wms_capabilities", "wms_time_values", "wms_elevation_values")
+
+    def __init__(self, erddap_server, name, metadata=None, griddap_attributes=None, transport=None, summary=None):
         """
         Create a new Erddap dataset based on an existing dataset.
         The dataset metadata will be downloaded and extracted to provide spatio-temporal information on the dataset.
@@ -21,8 +156,17 @@ class ErddapDataset:
         Arguments:
         erddap_server: url string to the erddap server base
         name: dataset ID
+        
+        Keyword arguments:
+        metadata: already known info/index.csv table for the dataset (CSV text or DataFrame) ; it is downloaded if None
+        griddap_attributes: already known griddap WMS values (see to_record()) ; they are downloaded if None
+        transport: HttpTransport used for all the requests on the dataset (shared default transport if None)
+        summary: row of the Erddap allDatasets table for the dataset (dict with SUMMARY_COLUMNS keys) ;
+                 if given without metadata, the protocol, time coverage & bounding box are read from it and
+                 the metadata is only downloaded when it is needed (see load_metadata())
         """
         self.server = erddap_server
+        self.transport = transport or default_transport()
         self.name = name
         self.data_url = None
         self.metadata_url = f"{erddap_server}/info/{self.name}/index.csv"
@@ -35,31 +179,177 @@ class ErddapDataset:
         self.max_lon = None
         self.min_lat = None
         self.max_lat = None
-        self.metadata = self.get_metadata()
+        
+        # HTTP validators (ETag, Last-Modified, checksum & Erddap allDatasets time marker) of the metadata,
+        # used to revalidate the dataset without downloading & parsing it again.
+        self.validators = {}
+        self.summary = summary
+        if metadata is None and summary is not None:
+            self.metadata_loaded = False
+            self.parse_summary(summary)
+        else:
+            if metadata is None:
+                metadata = self.get_metadata()
+                if metadata is None:
+                    raise Exception(f"Could not get the metadata of {self.name} from {self.server}")
+            self.metadata_loaded = True
+            self.set_metadata(metadata)
+            self.parse_metadata(griddap_attributes)
+
+    def __getattr__(self, name):
+        # Only called for missing attributes : the metadata of datasets created from a summary is loaded on first use
+        if name in METADATA_ATTRIBUTES and getattr(self, "metadata_loaded", True) is False:
+            self.load_metadata()
+            return getattr(self, name)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    @property
+    def metadata(self) -> "pd.DataFrame":
+        """
+        info/index.csv table of the dataset. It is parsed again from the compressed CSV at each access :
+        prefer the global_attributes, variables, data_types & dimensions dicts.
+        """
+        if not self.metadata_loaded:
+            self.load_metadata()
+        return pd.read_csv(io.BytesIO(zlib.decompress(self._metadata_csv)))
+
+    @property
+    def metadata_csv(self) -> str:
+        """
+        info/index.csv table of the dataset as CSV text.
+        """
+        if not self.metadata_loaded:
+            self.load_metadata()
+        return zlib.decompress(self._metadata_csv).decode("utf-8")
+
+    def set_metadata(self, metadata):
+        """
+        Parses an info/index.csv table (CSV text / bytes or DataFrame) in dicts :
+        - global_attributes: NC_GLOBAL attribute name -> value
+        - variables: variable (or dimension) name -> dict of its attributes
+        - data_types: variable (or dimension) name -> Erddap data type
+        - dimensions: griddap dimension name -> description, e.g. "nValues=720, evenlySpaced=true, averageSpacing=0.25"
+        Missing values are left out. The table itself is kept as compressed CSV.
+        """
+        if isinstance(metadata, pd.DataFrame):
+            table = metadata
+            csv = metadata.to_csv(index=False).encode("utf-8")
+        else:
+            csv = metadata.encode("utf-8") if isinstance(metadata, str) else bytes(metadata)
+            table = pd.read_csv(io.BytesIO(csv))
+        self._metadata_csv = zlib.compress(csv)
+        
+        global_attributes, variables, data_types, dimensions = {}, {}, {}, {}
+        rows = table[["Row Type", "Variable Name", "Attribute Name", "Data Type", "Value"]].itertuples(index=False, name=None)
+        for row_type, variable_name, attribute_name, data_type, value in rows:
+            if pd.isna(variable_name):
+                continue
+            if row_type == "attribute":
+                if pd.isna(value) or pd.isna(attribute_name):
+                    continue
+                # Attribute names are shared by all the datasets
+                attribute_name = sys.intern(str(attribute_name))
+                if variable_name == "NC_GLOBAL":
+                    global_attributes[attribute_name] = value
+                else:
+                    variables.setdefault(variable_name, {})[attribute_name] = value
+            elif row_type in ("variable", "dimension"):
+                variables.setdefault(variable_name, {})
+                if not pd.isna(data_type):
+                    data_types[variable_name] = sys.intern(str(data_type))
+                if row_type == "dimension" and not pd.isna(value):
+                    dimensions[variable_name] = value
+        self.global_attributes = global_attributes
+        self.variables = variables
+        self.data_types = data_types
+        self.dimensions = dimensions
+
+    def parse_summary(self, summary):
+        """
+        Extracts the protocol, the time coverage & the bounding box of the dataset from its allDatasets summary.
+        """
+        is_grid = summary.get("dataStructure") == "grid" or summary.get("cdm_data_type") == "Grid"
+        self.protocol = "griddap" if is_grid else "tabledap"
+        self.data_url = f"{self.server}/{self.protocol}/{self.name}"
+        self.start_date = to_datetime64(summary.get("minTime"))
+        self.end_date = to_datetime64(summary.get("maxTime"))
+        try:
+            bbox = [float(summary[key]) for key in ["minLongitude", "minLatitude", "maxLongitude", "maxLatitude"]]
+        except (KeyError, TypeError, ValueError):
+            bbox = [np.nan]
+        if np.isnan(bbox).any():
+            bbox = [None, None, None, None]
+        self.min_lon, self.min_lat, self.max_lon, self.max_lat = bbox
+        self.found_eovs = {}
+
+    def load_metadata(self):
+        """
+        Downloads & parses the metadata (and the WMS values of griddap datasets) of a dataset created from a summary.
+        The summary time coverage & bounding box are kept when the metadata does not provide them.
+        """
+        if self.metadata_loaded:
+            return
+        marker = self.validators.get("marker")
+        metadata = self.get_metadata()
+        if metadata is None:
+            raise Exception(f"Could not get the metadata of {self.name} from {self.server}")
+        if marker is not None:
+            self.validators["marker"] = marker
+        self.apply_metadata(metadata)
+
+    def apply_metadata(self, metadata, griddap_attributes=None):
+        """
+        Parses the metadata downloaded for a dataset created from a summary, see load_metadata().
+        
+        Keyword arguments:
+        griddap_attributes: already downloaded griddap WMS values ; they are downloaded if None
+        """
+        start_date, end_date = self.start_date, self.end_date
+        bbox = [self.min_lon, self.min_lat, self.max_lon, self.max_lat]
+        self.set_metadata(metadata)
+        self.parse_metadata(griddap_attributes)
+        self.start_date = self.start_date if self.start_date is not None else start_date
+        self.end_date = self.end_date if self.end_date is not None else end_date
+        if None in [self.min_lon, self.min_lat, self.max_lon, self.max_lat]:
+            self.min_lon, self.min_lat, self.max_lon, self.max_lat = bbox
+        self.metadata_loaded = True
+
+    def parse_metadata(self, griddap_attributes=None):
+        """
+        Extracts the protocol, the parameters & the griddap WMS values from the dataset metadata.
+        
+        Keyword arguments:
+        griddap_attributes: already known griddap WMS values (see to_record()) ; they are downloaded if None
+        """
+        self.min_lon, self.min_lat, self.max_lon, self.max_lat = None, None, None, None
         
         # Only used for griddap datasets
         self.wms_capabilities = None
-        self.wms_time_values = []
+        self.wms_time_values = np.array([], dtype="datetime64[s]")
         self.wms_elevation_values = []
         
         # Griddap datasets do not behave the same way as tabledap.
         # - Query syntax is different
         # - Querying outside of bounding box & timeframe will fail
         # - Query must include the elevation
-        if self.metadata[self.metadata["Attribute Name"] == "cdm_data_type"].Value.iloc[0] == "Grid":
+        if self.global_attributes.get("cdm_data_type") == "Grid":
             self.protocol = "griddap"
-            self.data_url = f"{erddap_server}/griddap/{self.name}"
-            self.process_griddap_attributes()         
+            self.data_url = f"{self.server}/griddap/{self.name}"
+            if griddap_attributes is None:
+                self.process_griddap_attributes()
+            else:
+                self.set_griddap_attributes(**griddap_attributes)
         else:
             self.protocol = "tabledap"
-            self.data_url = f"{erddap_server}/tabledap/{self.name}"
+            self.data_url = f"{self.server}/tabledap/{self.name}"
+        
+        self.parse_coverage_attributes()
         
         # Extract parameters which have the "sdn_parameter_urn" variable attribute :
         self.parameters = {}
-        for i, r in self.metadata[
-                            (self.metadata["Attribute Name"] == "sdn_parameter_urn")
-                        ].iterrows():
-            self.parameters[r["Value"]] = r["Variable Name"]
+        for variable_name, attributes in self.variables.items():
+            if "sdn_parameter_urn" in attributes:
+                self.parameters[attributes["sdn_parameter_urn"]] = variable_name
             
         # This will be used later if EOVs were found among the available parameters.
         self.found_eovs = {}
@@ -70,50 +360,203 @@ class ErddapDataset:
             self.depth_variables.append(self.parameters["SDN:P01::ADEPZZ01"])
         if "SDN:P01::PRESPR01" in self.parameters.keys():
             self.depth_variables.append(self.parameters["SDN:P01::PRESPR01"])
+
+    def get_global_attribute(self, attribute_name, default=None):
+        """
+        Returns the value of a NC_GLOBAL attribute of the dataset metadata, or default if it is not defined.
+        """
+        return self.global_attributes.get(attribute_name, default)
+
+    def dimension_info(self, dimension_name) -> dict:
+        """
+        Returns the description of a griddap dimension found in the dataset metadata, e.g.
+        {"nValues": "720", "evenlySpaced": "true", "averageSpacing": "0.25"}, or an empty dict.
+        """
+        if dimension_name not in self.dimensions:
+            return {}
+        return dict(item.strip().split("=", 1) for item in str(self.dimensions[dimension_name]).split(",") if "=" in item)
+
+    def dimension_spacing(self, dimension_name):
+        """
+        Returns the average spacing of a griddap dimension as a float, or None if it is unknown or not numeric (e.g. "30 days").
+        """
+        try:
+            return abs(float(self.dimension_info(dimension_name)["averageSpacing"]))
+        except (KeyError, ValueError):
+            return None
+
+    def variable_size(self, variable_name) -> int:
+        """
+        Returns the size in bytes of a value of a variable, from its data type in the dataset metadata (8 if unknown).
+        """
+        return DATA_TYPE_SIZES.get(self.data_types.get(variable_name), 8)
+
+    def memory_size(self) -> int:
+        """
+        Returns the approximate memory used by the dataset description, in bytes.
+        """
+        def size(value):
+            if isinstance(value, dict):
+                return sys.getsizeof(value) + sum(size(k) + size(v) for k, v in value.items())
+            if isinstance(value, (list, tuple)):
+                return sys.getsizeof(value) + sum(size(v) for v in value)
+            if isinstance(value, np.ndarray):
+                return value.nbytes + sys.getsizeof(value)
+            return sys.getsizeof(value)
+
+        def slot_value(name):
+            # Not loading the metadata of datasets created from a summary
+            try:
+                return object.__getattribute__(self, name)
+            except AttributeError:
+                return None
+
+        return sys.getsizeof(self) + sum(size(slot_value(name)) for name in self.__slots__ if name != "transport")
+
+    def parse_coverage_attributes(self):
+        """
+        Fills the time coverage & the bounding box of the dataset from its global attributes
+        (time_coverage_start/end, geospatial_lon/lat_min/max). Values found in the griddap WMS are kept.
+        """
+        self.start_date = to_datetime64(self.get_global_attribute("time_coverage_start"))
+        self.end_date = to_datetime64(self.get_global_attribute("time_coverage_end"))
         
+        if None in [self.min_lon, self.min_lat, self.max_lon, self.max_lat]:
+            try:
+                self.min_lon = float(self.get_global_attribute("geospatial_lon_min"))
+                self.min_lat = float(self.get_global_attribute("geospatial_lat_min"))
+                self.max_lon = float(self.get_global_attribute("geospatial_lon_max"))
+                self.max_lat = float(self.get_global_attribute("geospatial_lat_max"))
+            except (TypeError, ValueError):
+                self.min_lon, self.min_lat, self.max_lon, self.max_lat = None, None, None, None
+
     def process_griddap_attributes(self):
-        wms_capabilities = f"{self.server}/wms/{self.name}/request?service=WMS&request=GetCapabilities&version=1.3.0"
-        data = requests.get(wms_capabilities).content
-        root = ET.fromstring(data)
-
-        # Erddap wms xml is not parseable with owslib, so we expect the dimensions to be available in the matrix below :
-        for i in root[1][2][2]:
-            if i.tag.endswith("Dimension"):
-                if i.attrib.get("name", "") == "time":
-                    wms_time_values = [str(time_value)[0:10] for time_value in i.text.split(',')]
-                    self.wms_time_values = np.unique(wms_time_values)
-                    logger.debug(f"Griddap wms for {self.name} returned {len(self.wms_time_values)} time values.")
-                elif i.attrib.get("name", "") == "elevation":
-                    wms_elevation_values = [float(elevation_value) for elevation_value in i.text.split(',')]
-                    self.wms_elevation_values = [abs(ev) if ev < 0 else ev for ev in wms_elevation_values]
-                    logger.debug(f"Griddap wms for {self.name} returned {len(self.wms_elevation_values)} elevation values.")
-        # Also retrieve the bounding box for the dataset
-        for i in root[1][2][2]:
-            if i.tag == "{http://www.opengis.net/wms}BoundingBox":
-                self.min_lon = float(i.attrib.get("minx", -180.0))
-                self.min_lat = float(i.attrib.get("miny", -90.0))
-                self.max_lon = float(i.attrib.get("maxx", 180.0))
-                self.max_lat = float(i.attrib.get("maxy", 90.0))
+        data = self.transport.get(self.wms_capabilities_url).content
+        self.set_griddap_attributes(**parse_wms_capabilities(data))
+        logger.debug(f"Griddap wms for {self.name} returned {len(self.wms_time_values)} time values "
+                     f"and {len(self.wms_elevation_values)} elevation values.")
+
+    @property
+    def wms_capabilities_url(self):
+        return f"{self.server}/wms/{self.name}/request?service=WMS&request=GetCapabilities&version=1.3.0"
                 
+    def set_griddap_attributes(self, wms_time_values, wms_elevation_values, bbox):
+        self.wms_time_values = to_datetime64_array(wms_time_values)
+        self.wms_elevation_values = list(wms_elevation_values)
+        if bbox is not None:
+            self.min_lon, self.min_lat, self.max_lon, self.max_lat = bbox
+
+    def to_record(self) -> dict:
+        """
+        Returns a JSON-serializable description of the dataset, used to rebuild it without network calls
+        with ErddapDataset.from_record().
+        """
+        if not self.metadata_loaded:
+            return {"server": self.server, "name": self.name, "metadata": None, "validators": self.validators,
+                    "griddap_attributes": None, "summary": self.summary}
+        record = {
+            "server": self.server,
+            "name": self.name,
+            "metadata": self.metadata_csv,
+            "validators": self.validators,
+            "griddap_attributes": None,
+        }
+        if self.protocol == "griddap":
+            bbox = [self.min_lon, self.min_lat, self.max_lon, self.max_lat]
+            record["griddap_attributes"] = {
+                "wms_time_values": np.datetime_as_string(self.wms_time_values, unit="s").tolist(),
+                "wms_elevation_values": [float(elevation_value) for elevation_value in self.wms_elevation_values],
+                "bbox": None if None in bbox else bbox,
+            }
+        return record
+
+    @classmethod
+    def from_record(cls, record, transport=None):
+        """
+        Creates an ErddapDataset from a record returned by to_record().
+        """
+        dataset = cls(record["server"],
+                      record["name"],
+                      metadata=record["metadata"],
+                      griddap_attributes=record["griddap_attributes"],
+                      transport=transport,
+                      summary=record.get("summary"))
+        dataset.validators = record.get("validators", {})
+        return dataset
+
     def __repr__(self):
         return f"{self.name} Erddap dataset at {self.server}"
         
     def get_metadata(self):
         start = time.time()
         try:
-            metadata = pd.read_csv(self.metadata_url)
-        except HTTPError as http_error:
-            logger.warning(f"{self.server} Erddap server answered with HTTP code {http_error.code} and reason {http_error.reason}")
+            resp, self.validators = conditional_get(self.metadata_url, transport=self.transport)
+        except requests.HTTPError as http_error:
+            logger.warning(f"{self.server} Erddap server answered with HTTP code {http_error.response.status_code} and reason {http_error.response.reason}")
             return None
-        return metadata
+        return resp.content
+
+    def revalidate(self, marker=None) -> bool:
+        """
+        Checks if the dataset metadata changed on the Erddap server, and parses it again if so.
+        
+        Keyword arguments:
+        marker: change marker of the dataset found in the Erddap allDatasets table (minTime/maxTime) ;
+                if it matches the marker known for the dataset, no request is made at all.
+        
+        Returns:
+        True if the metadata changed & was parsed again, otherwise False.
+        """
+        if self.marker_unchanged(marker):
+            return False
+        resp, validators = conditional_get(self.metadata_url, self.validators, self.transport)
+        return self.update_metadata(resp, validators, marker)
+
+    def marker_unchanged(self, marker) -> bool:
+        """
+        Returns True if the allDatasets marker matches the one known for the dataset, see revalidate().
+        """
+        if marker is not None and marker == self.validators.get("marker"):
+            logger.debug(f"{self.name} allDatasets marker is unchanged, skipping revalidation.")
+            return True
+        return False
+
+    def update_metadata(self, resp, validators, marker=None, griddap_attributes=None) -> bool:
+        """
+        Applies the answer of a metadata revalidation request (see revalidate()) : the metadata is parsed again
+        only if its content changed.
+        
+        Arguments:
+        resp: response with the metadata, None if the server answered it did not change (304)
+        validators: validators of the response, see conditional_get()
+        
+        Keyword arguments:
+        marker: allDatasets marker of the dataset
+        griddap_attributes: griddap WMS values of the new metadata ; they are downloaded if None
+        
+        Returns True if the metadata changed & was parsed again, otherwise False.
+        """
+        if marker is not None:
+            validators["marker"] = marker
+        if resp is None or validators.get("checksum") == self.validators.get("checksum"):
+            logger.debug(f"{self.name} metadata is unchanged.")
+            self.validators = validators
+            return False
+        
+        logger.info(f"{self.name} metadata changed on {self.server}, parsing it again.")
+        self.set_metadata(resp.content)
+        self.validators = validators
+        self.parse_metadata(griddap_attributes)
+        self.metadata_loaded = True
+        return True
 
     
     def covers_geospatial_query(self, query_min_lon, query_min_lat, query_max_lon, query_max_lat):
         # If metadata does not provide geospatial information, the dataset will be queried anyway
         if None in [self.min_lon, self.min_lat, self.max_lon, self.max_lat]:
             return True
-        dataset_bbox = box(self.min_lon, self.min_lat, self.max_lon, self.max_lat)
-        query_bbox = box(query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+        dataset_bbox = geometry.box(self.min_lon, self.min_lat, self.max_lon, self.max_lat)
+        query_bbox = geometry.box(query_min_lon, query_min_lat, query_max_lon, query_max_lat)
         
         if query_bbox.intersection(dataset_bbox) or query_bbox.contains(dataset_bbox):
             return True
@@ -123,38 +566,77 @@ class ErddapDataset:
 
     def covers_spatiotemporal_query(self, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> bool:
         """
-        Checks if the dataset covers the time range between start and end.
-        In order to avoid asking for the full period, this function splits the date range into a daily range.
+        Checks if the dataset has data within the query time range & bounding box.
+        - griddap : the WMS time values (a sorted datetime64 axis) are searched with np.searchsorted for a value
+          within the time range, and the bounding box is checked against the WMS one ; no request is sent.
+        - tabledap : the Erddap server is probed for at most one time value every 6 months (see probe_tabledap_coverage()).
+        MarineBroker.covers_spatiotemporal_query() looks up the coverage grid & the coverage cache of tabledap datasets
+        before calling this probe.
         
         Returns:
-        True if data is found for the time range.
-        or False.
+        True if data is found within the constraints,
+        or False (also when the tabledap probe fails).
         """
 
         if self.protocol == "tabledap":
-            time_query_order_by_limit = f"{self.data_url}.csv?time&time%3E={start}&time%3C={end}&latitude%3E={query_min_lat}&latitude%3C={query_max_lat}&longitude%3E={query_min_lon}&longitude%3C={query_max_lon}&orderByLimit(%22time/6months,1%22)"
-            logger.debug(f"Will check spatiotemporal constraints from query {time_query_order_by_limit}")
             try:
-                df = pd.read_csv(time_query_order_by_limit)
-            except HTTPError as e:
+                return self.probe_tabledap_coverage(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+            except requests.HTTPError as e:
                 logger.debug(f"Query failed with exception {str(e)}")
-                logger.debug(f"Failed query is : {time_query_order_by_limit}")
-                return False
-
-            if df.size > 0:
-                return True
-            else:
                 return False
         # Griddap
         # Informations about time values are available in griddap WMS, we just check the information extracted from WMS getcapabilities
         else:
-            # First check time values
-            date_range = [str(i)[0:10] for i in np.arange(start, end,np.timedelta64(1,'D'), dtype='datetime64')]
-            # find common dates between available time values and date range in query/
-            # If not, abort querying the dataset
-            if len(list(set(self.wms_time_values).intersection(date_range))) == 0:
+            return self.covers_griddap_query(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+
+    def probe_tabledap_coverage(self, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> bool:
+        """
+        Asks the Erddap server if the tabledap dataset has data within the query constraints.
+        
+        Returns True if data is found, False if the server answered that the query has no matching results.
+        Other HTTP errors are raised (requests.HTTPError).
+        """
+        time_query_order_by_limit = self.coverage_probe_url(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+        logger.debug(f"Will check spatiotemporal constraints from query {time_query_order_by_limit}")
+        try:
+            df = self.transport.read_csv(time_query_order_by_limit)
+        except requests.HTTPError as e:
+            # Erddap answers 404 when the query has no matching results
+            if e.response is not None and e.response.status_code == 404:
                 return False
-            
-            # Check spatial coverage of the query:
-            if self.covers_geospatial_query(query_min_lon, query_min_lat, query_max_lon, query_max_lat):
-                return True
+            logger.debug(f"Failed query is : {time_query_order_by_limit}")
+            raise
+        return df.size > 0
+
+    def coverage_probe_url(self, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> str:
+        """
+        Returns the tabledap query used to check if the dataset has data within the query constraints :
+        it asks for at most one time value every 6 months.
+        """
+        return f"{self.data_url}.csv?time&time%3E={start}&time%3C={end}&latitude%3E={query_min_lat}&latitude%3C={query_max_lat}&longitude%3E={query_min_lon}&longitude%3C={query_max_lon}&orderByLimit(%22time/6months,1%22)"
+
+    def griddap_time_indices(self, start, end) -> tuple:
+        """
+        Finds the griddap time values (from the WMS) between start and end, both included.
+        
+        Returns:
+        (first, last) indices such that self.wms_time_values[first:last] are the matching time values ;
+        first == last if there is none.
+        """
+        query_start = to_datetime64(start)
+        query_end = to_datetime64(end)
+        first = 0 if query_start is None else int(np.searchsorted(self.wms_time_values, query_start.astype("datetime64[s]"), side="left"))
+        last = len(self.wms_time_values) if query_end is None else int(np.searchsorted(self.wms_time_values, query_end.astype("datetime64[s]"), side="right"))
+        return first, max(first, last)
+
+    def covers_griddap_query(self, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> bool:
+        """
+        Checks the query constraints against the time values & bounding box found in the griddap WMS, without any request.
+        """
+        # First check time values, if none is within the query, abort querying the dataset
+        first, last = self.griddap_time_indices(start, end)
+        if first == last:
+            return False
+        
+        # Check spatial coverage of the query:
+        return self.covers_geospatial_query(query_min_lon, query_min_lat, query_max_lon, query_max_lat)
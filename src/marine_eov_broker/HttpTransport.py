@@ -0,0 +1,121 @@
+import io
+import logging
+import threading
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from marine_eov_broker.LazyImport import LazyModule
+
+# pandas is imported on first use, see LazyModule
+pd = LazyModule("pandas")
+
+logger = logging.getLogger(__name__)
+
+
+class HttpTransport:
+    """
+    HTTP layer shared by the broker, its datasets and requests.
+    - connections are pooled & kept alive for each host through a single requests Session
+    - the number of requests in flight is limited for each host
+    - failed connections and transient server errors are retried with an exponential backoff
+    """
+
+    # Status codes worth retrying ; Erddap answers 404 / 500 for queries without results or invalid queries.
+    RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+    def __init__(self, max_per_host=8, timeout=(10, 300), retries=3, backoff_factor=0.5, pool_maxsize=20):
+        """
+        Keyword arguments:
+        max_per_host -- maximum number of requests in flight for each host
+        timeout -- (connect, read) timeouts in seconds for each request
+        retries -- number of retries for failed connections & transient server errors
+        backoff_factor -- retries are spaced by backoff_factor * 2 ** (retry number - 1) seconds
+        pool_maxsize -- number of connections kept alive for each host
+        """
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=self.RETRY_STATUS_CODES,
+                      allowed_methods=frozenset(["GET", "HEAD"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(pool_maxsize, max_per_host), max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __repr__(self):
+        return f"HttpTransport ({self.max_per_host} requests per host, timeout={self.timeout})"
+
+    def host_semaphore(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._semaphores[host]
+
+    def get(self, url, stream=False, **kwargs) -> requests.Response:
+        """
+        GET request on the shared session, waiting for a free slot on the url host.
+        When stream is True, the slot is kept until the response is closed.
+        """
+        semaphore = self.host_semaphore(url)
+        semaphore.acquire()
+        try:
+            kwargs.setdefault("timeout", self.timeout)
+            logger.debug(f"GET {url}")
+            resp = self.session.get(url, stream=stream, **kwargs)
+        except Exception:
+            semaphore.release()
+            raise
+
+        if not stream:
+            semaphore.release()
+            return resp
+
+        close = resp.close
+        released = threading.Event()
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released.is_set():
+                    released.set()
+                    semaphore.release()
+        resp.close = close_and_release
+        return resp
+
+    def read_csv(self, url, **kwargs) -> "pd.DataFrame":
+        """
+        Downloads a CSV file and loads it in a DataFrame ; raises requests.HTTPError on HTTP errors.
+        Keyword arguments are passed to pandas.read_csv().
+        """
+        resp = self.get(url)
+        resp.raise_for_status()
+        return pd.read_csv(io.BytesIO(resp.content), **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+DEFAULT_TRANSPORT = None
+# Datasets are loaded from several threads : the shared transport must only be created once
+_DEFAULT_TRANSPORT_LOCK = threading.Lock()
+
+
+def default_transport():
+    """
+    Returns the transport shared by the objects created without an explicit transport.
+    """
+    global DEFAULT_TRANSPORT
+    with _DEFAULT_TRANSPORT_LOCK:
+        if DEFAULT_TRANSPORT is None:
+            DEFAULT_TRANSPORT = HttpTransport()
+        return DEFAULT_TRANSPORT
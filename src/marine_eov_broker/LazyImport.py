@@ -0,0 +1,39 @@
+import importlib
+import importlib.util
+import threading
+
+
+class LazyModule:
+    """
+    Stand-in for a module which is only imported when one of its attributes is first used, so that importing
+    the broker modules stays fast for the tools which never need pandas, xarray, shapely or pykg2tbl.
+
+    Usage :
+    pd = LazyModule("pandas")
+    pd.DataFrame()  # pandas is imported here
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return f"LazyModule({self._name}, {'imported' if self._module is not None else 'not imported'})"
+
+
+def module_available(name) -> bool:
+    """
+    Returns True if the module can be imported, without importing it (used for the optional dependencies).
+    """
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
@@ -1,31 +1,147 @@
+import collections.abc
 import concurrent.futures
 import datetime
 # from urllib.error import HTTPError
 import io
 import logging
+import os
+import re
+import shutil
 import sys
+import tempfile
+import threading
 import time
 import traceback
 
 import numpy as np
-import pandas as pd
 import requests
-import xarray as xr
-from pykg2tbl import KGSource
 
-from marine_eov_broker.ErddapMarineRI import ErddapDataset
-from marine_eov_broker.NVSQueries import DEFAULT_QUERY_STRINGS, EOV_LIST, j2sqb
+from marine_eov_broker.CatalogCache import DEFAULT_CACHE_TTL, CatalogCache
+from marine_eov_broker.CoverageCache import CoverageCache
+from marine_eov_broker.CoverageGrid import CoverageGrid
+from marine_eov_broker.DatasetIndex import DatasetIndex
+from marine_eov_broker.ErddapMarineRI import SUMMARY_COLUMNS, ErddapDataset, coordinate_slice, to_datetime64
+from marine_eov_broker.HttpTransport import HttpTransport
+from marine_eov_broker.LazyImport import LazyModule, module_available
+from marine_eov_broker.NVSQueries import EOV_LIST, sparql_builder
+from marine_eov_broker.VocabularyBundle import VocabularyBundle
+
+# Heavy dependencies are imported on first use, see LazyModule
+pd = LazyModule("pandas")
+xr = LazyModule("xarray")
+pykg2tbl = LazyModule("pykg2tbl")
+# Optional dependency, see the parquet extra
+pa = LazyModule("pyarrow")
+pq = LazyModule("pyarrow.parquet")
 
 INPUT_DATE_FORMATS = ["%Y%m%dT%H%M%SZ", "%Y-%m-%dT%H:%M:%SZ", 
                       "%Y%m%dT%H:%M:%SZ", "%Y-%m-%dT%H%M%SZ", 
                       "%Y%m%d", "%Y-%m-%d"]
 
 ERDDAP_OUTPUT_FORMATS = ["csv", "geoJson", "json", "nc", "ncCF", "odvTxt"]
+# Size of the blocks written to disk by the streaming downloads
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Time in seconds given to each Erddap server to list & load its datasets when the broker starts
+DEFAULT_SERVER_TIMEOUT = 300
+# Number of datasets descriptions downloaded concurrently, all servers included
+DATASETS_LOADING_WORKERS = 8
+# Estimated number of rows above which a request is split (see MarineBroker.split_request())
+DEFAULT_MAX_ROWS_PER_REQUEST = 1000000
+# Number of rows of the Arrow record batches built from the downloaded data
+ARROW_BATCH_ROWS = 1000000
+# Griddap dimensions which can be subset with strides
+GRIDDAP_DIMENSIONS = ["time", "depth", "latitude", "longitude"]
+# Server-side aggregation functions (Erddap tabledap orderBy<Function> filters)
+AGGREGATION_FUNCTIONS = {"mean": "orderByMean", "count": "orderByCount"}
+AGGREGATION_KEYS = ["time", "latitude", "longitude", "depth", "function"]
+# What submit_request does with the requests exceeding the max_rows / max_bytes budget
+BUDGET_POLICIES = ["drop", "split", "downsample"]
+# Durations of the Erddap time periods units, in seconds
+TIME_PERIOD_UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400, "week": 7 * 86400,
+                     "month": 30.4375 * 86400, "year": 365.25 * 86400}
 # EOV_LIST = ['EV_OXY', 'EV_SEATEMP', 'EV_SALIN', 'EV_CURR', 'EV_CHLA', 'EV_CO2', 'EV_NUTS']
 
 logger = logging.getLogger(__name__)
 
 
+def period_to_seconds(period) -> float:
+    """
+    Converts an Erddap time period (e.g. "1day", "3months") to seconds.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)?\s*([a-zA-Z]+?)s?\s*", str(period))
+    if match is None or match.group(2).lower() not in TIME_PERIOD_UNITS:
+        raise Exception(f"Invalid time period {period}, expected a number followed by one of {list(TIME_PERIOD_UNITS)}")
+    return float(match.group(1) or 1) * TIME_PERIOD_UNITS[match.group(2).lower()]
+
+
+class EovVocabularies(collections.abc.Mapping):
+    """
+    Read-only dict of the vocabulary server rows of each EOV, resolved the first time an EOV is looked up
+    and then kept : adding EOVs costs nothing until they are requested.
+    Each EOV has its own lock, so that an EOV being resolved does not hold back the lookups of the other ones.
+    """
+
+    def __init__(self, resolve, eovs=EOV_LIST):
+        """
+        Arguments:
+        resolve: callable(list of EOVs) returning a dict of the rows of each EOV (e.g. MarineBroker.build_all_vocabularies)
+        eovs: EOVs which can be looked up
+        """
+        self.resolve = resolve
+        self._rows = {}
+        self._locks = {eov: threading.Lock() for eov in eovs}
+
+    def __getitem__(self, eov):
+        if eov not in self._rows:
+            self.load([eov])
+        return self._rows[eov]
+
+    def __contains__(self, eov):
+        return eov in self._locks
+
+    def __iter__(self):
+        return iter(self._locks)
+
+    def __len__(self):
+        return len(self._locks)
+
+    def __repr__(self):
+        return f"EovVocabularies({', '.join(f'{eov}: {len(self._rows[eov]) if eov in self._rows else None}' for eov in self)})"
+
+    def load(self, eovs):
+        """
+        Resolves the EOVs which were not resolved yet, in a single call to resolve().
+        """
+        for eov in eovs:
+            if eov not in self._locks:
+                raise KeyError(eov)
+        # Locks are always taken in the same order so that concurrent loads cannot deadlock.
+        locks = [self._locks[eov] for eov in sorted(set(eovs)) if eov not in self._rows]
+        for lock in locks:
+            lock.acquire()
+        try:
+            missing = [eov for eov in dict.fromkeys(eovs) if eov not in self._rows]
+            if len(missing) > 0:
+                self._rows.update(self.resolve(missing))
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def update(self, vocabularies):
+        """
+        Sets the rows of EOVs resolved elsewhere (e.g. read from a VocabularyBundle).
+        """
+        for eov, rows in vocabularies.items():
+            self._locks.setdefault(eov, threading.Lock())
+            self._rows[eov] = rows
+
+    def loaded(self) -> dict:
+        """
+        Returns the rows of the EOVs resolved so far.
+        """
+        return dict(self._rows)
+
+
 class MarineBroker:
     
     vocabularies_server = "https://vocab.nerc.ac.uk/sparql/"
@@ -49,44 +165,185 @@ class MarineBroker:
         "Argo": "https://sparql.ifremer.fr/argo/query"
     }
 
-    def __init__(self, erddap_servers=DEFAULT_ERDDAP_SERVERS, sparql_endpoints=DEFAULT_SPARQL_ENDPOINTS):
+    def __init__(self, erddap_servers=DEFAULT_ERDDAP_SERVERS, sparql_endpoints=DEFAULT_SPARQL_ENDPOINTS,
+                 cache_dir=None, cache_ttl=DEFAULT_CACHE_TTL, transport=None, coverage_cache=None, data_cache=None,
+                 server_timeout=DEFAULT_SERVER_TIMEOUT, wait=True, bulk_metadata=True, vocabularies_bundle=None):
         """Create a new broker and automatically scan Erddap servers provided.
         
+        The Erddap servers are scanned concurrently, and each dataset can be queried as soon as it is loaded.
+        
         Keyword arguments:
         erddap_servers -- Dict containing Erddap servers URL as keys and lists of dataset IDs as values 
                           (if value is None, then all datasets will be collected by the broker)
+        cache_dir -- directory of the persistent catalog cache (datasets descriptions & vocabularies) ;
+                     if None, the catalog is fetched from the network at each start
+        cache_ttl -- time in seconds after which a cached catalog entry is fetched again
+        transport -- HttpTransport used for all the requests made by the broker & its datasets ;
+                     configures connections pooling, requests in flight per host, timeouts & retries
+        coverage_cache -- CoverageCache keeping the tabledap spatiotemporal coverage probes results
+        data_cache -- DataCache keeping the data downloaded by the requests of the broker on disk ; no data is cached if None
+        server_timeout -- time in seconds given to each Erddap server to list & load its datasets ;
+                          servers exceeding it are reported in failed_servers (None to wait without limit)
+        wait -- if False, the broker is returned while the Erddap servers are still being scanned
+                (see the ready attribute & wait_ready())
+        bulk_metadata -- if True, the datasets of each server are described by its allDatasets table in a single request,
+                         and their metadata is only downloaded when an EOV search needs it (see load_datasets_metadata())
+        vocabularies_bundle -- path of a VocabularyBundle (JSON or Turtle file, see export_vocabularies()) providing
+                               the EOVs vocabularies ; the EOVs missing from the bundle are queried from NVS
+                               when they are first requested
         """
-#         self.erddap_servers = erddap_servers        
+        self.init_state(erddap_servers, cache_dir, cache_ttl, transport, coverage_cache, data_cache,
+                        server_timeout, bulk_metadata, vocabularies_bundle)
+        
+        # The Erddap servers are scanned in background ;
+        # ready holds a future for each server, whose result is the number of datasets loaded.
+        self._datasets_executor = concurrent.futures.ThreadPoolExecutor(DATASETS_LOADING_WORKERS)
+        servers_executor = concurrent.futures.ThreadPoolExecutor(max(1, len(erddap_servers)))
+        self.ready = {erddap_server: servers_executor.submit(self.load_erddap_server, erddap_server)
+                      for erddap_server in erddap_servers}
+        servers_executor.shutdown(wait=False)
+        for future in self.ready.values():
+            future.add_done_callback(self.loading_done)
+
+        if wait:
+            self.wait_ready(self.server_timeout)
+        self.update_index()
+
+    def init_state(self, erddap_servers, cache_dir, cache_ttl, transport, coverage_cache, data_cache,
+                   server_timeout, bulk_metadata, vocabularies_bundle):
+        """
+        Sets up the state shared by the broker variants (see __init__() for the arguments),
+        without loading anything from the Erddap servers.
+        """
+        self.transport = transport if transport is not None else HttpTransport()
+        self.coverage_cache = coverage_cache if coverage_cache is not None else CoverageCache()
+        self.data_cache = data_cache
+        self.coverage_grids = {}
+        self.erddap_servers = erddap_servers
+        self.catalog_cache = CatalogCache(cache_dir, cache_ttl) if cache_dir is not None else None
+        self.server_timeout = server_timeout
+        self.bulk_metadata = bulk_metadata
+        self._summaries = {}
+        self._summaries_locks = {}
+        self._summaries_lock = threading.Lock()
         self.datasets_list = []
         self.datasets = []
-        self.vocabularies = {}
-        
-        with concurrent.futures.ThreadPoolExecutor(10) as executor:
-            futures = []
-            for eov in EOV_LIST:
-                futures.append(executor.submit(self.build_vocabularies, eov))
-                
-            for future in concurrent.futures.as_completed(futures):
-                eov, eov_result = future.result()
-                self.vocabularies[eov] = eov_result
-#                 executor.submit(self.build_vocabularies, eov)
+        # EOVs vocabularies are resolved on their first lookup, see EovVocabularies
+        self.vocabularies = EovVocabularies(self.build_all_vocabularies)
+        self._vocabularies_source = None
+        self._vocabularies_source_lock = threading.Lock()
+        # Errors of the Erddap servers & datasets which could not be loaded
+        self.failed_servers = {}
+        self.failed_datasets = {}
+        self._datasets_lock = threading.RLock()
+        self._index_outdated = True
+        if vocabularies_bundle is not None:
+            self.vocabularies.update(self.import_vocabularies(vocabularies_bundle))
 
-        for erddap_server in erddap_servers.keys():
-            if erddap_servers[erddap_server] is not None:
-                self.datasets_list.extend([(erddap_server, dataset_id) for dataset_id in erddap_servers[erddap_server]])
+    def load_erddap_server(self, erddap_server) -> int:
+        """
+        Lists the datasets of an Erddap server and loads them concurrently, each dataset being registered
+        as soon as it is loaded. Datasets not loaded within server_timeout seconds are left out,
+        and the server is reported in failed_servers.
+        
+        Returns the number of datasets loaded.
+        """
+        start = time.time()
+        try:
+            if self.erddap_servers[erddap_server] is not None:
+                with self._datasets_lock:
+                    self.datasets_list.extend([(erddap_server, dataset_id) for dataset_id in self.erddap_servers[erddap_server]
+                                               if (erddap_server, dataset_id) not in self.datasets_list])
             else:
                 self.find_datasets_in_erddap_server(erddap_server)
+        except Exception as e:
+            self.failed_servers[erddap_server] = f"Could not get datasets list : {repr(e)}"
+            logger.warning(f"Could not get datasets list of {erddap_server} : {repr(e)}")
+            raise
         
-        with concurrent.futures.ThreadPoolExecutor(5) as executor:
-            futures = []
-            for erddap_server, dataset_id in self.datasets_list:
-                futures.append(executor.submit(self.get_dataset, erddap_server, dataset_id))
-                
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    self.datasets.append(future.result())
-                except:
-                    pass
+        with self._datasets_lock:
+            dataset_ids = [dataset_id for server, dataset_id in self.datasets_list if server == erddap_server]
+        futures = [self._datasets_executor.submit(self.load_dataset, erddap_server, dataset_id) for dataset_id in dataset_ids]
+        timeout = None if self.server_timeout is None else max(0, self.server_timeout - (time.time() - start))
+        done, not_done = concurrent.futures.wait(futures, timeout)
+        for future in not_done:
+            future.cancel()
+        loaded = sum(future.result() is not None for future in done)
+        
+        if len(not_done) > 0:
+            self.failed_servers[erddap_server] = (f"Timed out after {self.server_timeout} seconds, "
+                                                  f"{len(not_done)} datasets out of {len(dataset_ids)} not loaded")
+            logger.warning(f"{erddap_server} : {self.failed_servers[erddap_server]}")
+        else:
+            self.failed_servers.pop(erddap_server, None)
+        logger.info(f"Loaded {loaded} datasets out of {len(dataset_ids)} from {erddap_server} in {time.time() - start} seconds.")
+        return loaded
+
+    def load_dataset(self, erddap_server, dataset_id):
+        """
+        Loads a dataset & registers it in the broker ; errors are reported in failed_datasets.
+        Returns the ErddapDataset object, or None if it could not be loaded.
+        """
+        try:
+            dataset = self.get_dataset(erddap_server, dataset_id)
+        except Exception as e:
+            self.failed_datasets[(erddap_server, dataset_id)] = repr(e)
+            logger.warning(f"Could not load {dataset_id} from {erddap_server} : {repr(e)}")
+            return None
+        self.register_dataset(dataset)
+        return dataset
+
+    def register_dataset(self, dataset):
+        """
+        Adds a loaded dataset to the broker ; the indexes are updated at the next query.
+        """
+        with self._datasets_lock:
+            self.datasets.append(dataset)
+            self._index_outdated = True
+        self.failed_datasets.pop((dataset.server, dataset.name), None)
+
+    def loading_done(self, future=None):
+        # Frees the loading threads once all the servers are scanned
+        if all(server_future.done() for server_future in self.ready.values()):
+            self._datasets_executor.shutdown(wait=False)
+
+    def wait_ready(self, timeout=None) -> dict:
+        """
+        Waits until the Erddap servers are scanned, or for timeout seconds.
+        Servers still loading afterwards are reported in failed_servers ; their datasets keep being
+        registered in background as they are loaded.
+        
+        Returns the failed_servers dict.
+        """
+        done, not_done = concurrent.futures.wait(self.ready.values(), timeout)
+        for erddap_server, future in self.ready.items():
+            if future in not_done:
+                self.failed_servers.setdefault(erddap_server, f"Still loading after {timeout} seconds")
+                logger.warning(f"{erddap_server} is still loading after {timeout} seconds, its datasets are registered as they are loaded.")
+        self.update_index()
+        return self.failed_servers
+
+    def servers_status(self) -> "pd.DataFrame":
+        """
+        Returns the loading status of each Erddap server ("loading", "ready" or "failed"),
+        with its numbers of loaded & failed datasets and its error, indexed by server URL.
+        """
+        with self._datasets_lock:
+            loaded = [dataset.server for dataset in self.datasets]
+        status = []
+        for erddap_server, future in self.ready.items():
+            if not future.done():
+                status.append("loading")
+            elif erddap_server in self.failed_servers:
+                status.append("failed")
+            else:
+                status.append("ready")
+        return pd.DataFrame({"status": status,
+                             "datasets": [loaded.count(erddap_server) for erddap_server in self.ready],
+                             "failed_datasets": [sum(server == erddap_server for server, _ in list(self.failed_datasets))
+                                                 for erddap_server in self.ready],
+                             "error": [self.failed_servers.get(erddap_server) for erddap_server in self.ready]},
+                            index=list(self.ready))
                     
     
             
@@ -99,17 +356,56 @@ class MarineBroker:
 
         """
         start = time.time()
-        erddap_datasets_list = []
-        
-        erddap_datasets_list = pd.read_csv(f"{erddap_server}/info/index.csv")
-        erddap_datasets_list = erddap_datasets_list[erddap_datasets_list["Dataset ID"] != "allDatasets"]["Dataset ID"].to_list()
+        erddap_datasets_list = self.cached(
+            lambda allow_stale: self.catalog_cache.get_server_datasets(erddap_server, allow_stale),
+            lambda: self.fetch_datasets_list(erddap_server),
+            lambda datasets_list: self.catalog_cache.put_server_datasets(erddap_server, datasets_list),
+            erddap_server
+        )
             
-        for dataset_id in erddap_datasets_list:
-            if (erddap_server, dataset_id) not in self.datasets_list:
-#                 self.datasets.append(ErddapMarineRI.ErddapDataset(erddap_server, dataset_id))
-                self.datasets_list.append((erddap_server, dataset_id))
+        with self._datasets_lock:
+            for dataset_id in erddap_datasets_list:
+                if (erddap_server, dataset_id) not in self.datasets_list:
+#                     self.datasets.append(ErddapMarineRI.ErddapDataset(erddap_server, dataset_id))
+                    self.datasets_list.append((erddap_server, dataset_id))
         
         logger.debug(f"Took {time.time() - start} seconds to get datasets list for {erddap_server}")
+
+    def fetch_datasets_list(self, erddap_server) -> list:
+        """
+        Downloads the list of dataset IDs hosted by an Erddap server.
+        """
+        if self.bulk_metadata and len(self.datasets_summaries(erddap_server)) > 0:
+            return list(self.datasets_summaries(erddap_server))
+        erddap_datasets_list = self.transport.read_csv(f"{erddap_server}/info/index.csv")
+        return erddap_datasets_list[erddap_datasets_list["Dataset ID"] != "allDatasets"]["Dataset ID"].to_list()
+
+    def cached(self, get_cached, fetch, put_cached, description):
+        """
+        Reads an entry from the catalog cache, or fetches it & stores it in the cache if missing or stale.
+        If fetching fails and a stale entry is available, the stale entry is returned.
+
+        Arguments:
+        get_cached: callable(allow_stale) returning the cached value or None
+        fetch: callable returning the value from the network
+        put_cached: callable(value) storing the value in the cache
+        description: (str) name of the entry, used for logging
+        """
+        if self.catalog_cache is None:
+            return fetch()
+        value = get_cached(False)
+        if value is not None:
+            return value
+        try:
+            value = fetch()
+        except Exception as e:
+            value = get_cached(True)
+            if value is None:
+                raise
+            logger.warning(f"Failed to refresh {description} ({str(e)}), using stale catalog cache entry.")
+            return value
+        put_cached(value)
+        return value
         
     def get_dataset(self, erddap_server, dataset_id):
         """
@@ -119,23 +415,272 @@ class MarineBroker:
         dataset_id : (str) Erddap dataset ID
         """
         start = time.time()
-        erddap_dataset = ErddapDataset(erddap_server, dataset_id)
+        erddap_dataset = self.cached(
+            lambda allow_stale: self.catalog_cache.get_dataset(erddap_server, dataset_id, allow_stale),
+            lambda: self.fetch_dataset(erddap_server, dataset_id),
+            self.catalog_cache.put_dataset if self.catalog_cache is not None else None,
+            f"{dataset_id} at {erddap_server}"
+        )
+        if isinstance(erddap_dataset, dict):
+            erddap_dataset = ErddapDataset.from_record(erddap_dataset, self.transport)
         logger.debug(f"Loaded {dataset_id} in {time.time() - start} seconds.")
         return erddap_dataset  
+
+    def build_index(self):
+        """
+        Builds the indexes used to prune the datasets checked by submit_request() :
+        - the spatial & temporal index of the datasets
+        - the inverted index of the datasets parameters, with "sdn_parameter_urn" values as keys and
+          lists of (dataset, variable name) as values
+        - the datasets & variables matching each EOV
+        """
+        with self._datasets_lock:
+            self.index = DatasetIndex(self.datasets)
+            parameter_index = {}
+            for dataset in self.datasets:
+                if not dataset.metadata_loaded:
+                    # Matched once its metadata is loaded, see load_datasets_metadata()
+                    continue
+                for sdn_parameter_urn, variable_name in dataset.parameters.items():
+                    parameter_index.setdefault(sdn_parameter_urn, []).append((dataset, variable_name))
+            self.parameter_index = parameter_index
+            self.eov_datasets = {eov: self.match_eov(eov_vocabs, parameter_index)
+                                 for eov, eov_vocabs in self.vocabularies.loaded().items()}
+            self._index_outdated = False
+            self._indexed_metadata = sum(dataset.metadata_loaded for dataset in self.datasets)
+
+    def update_index(self):
+        """
+        Rebuilds the indexes if datasets were registered, or datasets metadata loaded, since they were built.
+        EOVs whose vocabularies were resolved since then are matched with the parameters index.
+        """
+        with self._datasets_lock:
+            if self._index_outdated or self._indexed_metadata != sum(dataset.metadata_loaded for dataset in self.datasets):
+                self.build_index()
+            for eov, eov_vocabs in self.vocabularies.loaded().items():
+                if eov not in self.eov_datasets:
+                    self.eov_datasets[eov] = self.match_eov(eov_vocabs, self.parameter_index)
+
+    def fetch_dataset(self, erddap_server, dataset_id):
+        """
+        Downloads an Erddap dataset description. If a stale catalog cache entry exists for the dataset,
+        it is only revalidated, and the metadata is parsed again only if it changed on the server.
+        When bulk_metadata is enabled, the dataset is created from its allDatasets summary instead.
+        The allDatasets marker of the dataset is stored in its validators, so that a stale entry (or a later
+        refresh()) is skipped without any request if the marker did not change.
+        """
+        record = None
+        if self.catalog_cache is not None:
+            record = self.catalog_cache.get_dataset(erddap_server, dataset_id, allow_stale=True)
+        summary = self.datasets_summaries(erddap_server).get(dataset_id)
+        marker = None if summary is None else self.summary_marker(summary)
+        if self.bulk_metadata and summary is not None and (record is None or record["metadata"] is None):
+            erddap_dataset = ErddapDataset(erddap_server, dataset_id, transport=self.transport, summary=summary)
+            erddap_dataset.validators["marker"] = marker
+            return erddap_dataset
+        if record is None:
+            erddap_dataset = ErddapDataset(erddap_server, dataset_id, transport=self.transport)
+            erddap_dataset.validators["marker"] = marker
+            return erddap_dataset
+        erddap_dataset = ErddapDataset.from_record(record, self.transport)
+        erddap_dataset.revalidate(marker)
+        return erddap_dataset
+
+    def datasets_summaries(self, erddap_server) -> dict:
+        """
+        Returns the allDatasets table of an Erddap server as a dict with dataset IDs as keys and
+        summaries (dicts of SUMMARY_COLUMNS values) as values, downloaded in a single request the first time
+        it is needed ; an empty dict if the table is not available.
+        """
+        with self._summaries_lock:
+            server_lock = self._summaries_locks.setdefault(erddap_server, threading.Lock())
+        with server_lock:
+            if erddap_server not in self._summaries:
+                self._summaries[erddap_server] = self.fetch_datasets_summaries(erddap_server)
+            return self._summaries[erddap_server]
+
+    def fetch_datasets_summaries(self, erddap_server) -> dict:
+        """
+        Downloads the allDatasets table of an Erddap server, see datasets_summaries().
+        """
+        start = time.time()
+        try:
+            all_datasets = self.transport.read_csv(f"{erddap_server}/tabledap/allDatasets.csv?{'%2C'.join(SUMMARY_COLUMNS)}",
+                                                   skiprows=[1])
+        except Exception as e:
+            logger.warning(f"Could not get allDatasets table from {erddap_server} : {str(e)}")
+            return {}
+        summaries = self.summaries_from_table(all_datasets)
+        logger.debug(f"Got {len(summaries)} datasets summaries from {erddap_server} in {time.time() - start} seconds.")
+        return summaries
+
+    @staticmethod
+    def summaries_from_table(all_datasets) -> dict:
+        """
+        Converts an allDatasets table DataFrame to a dict of datasets summaries, see datasets_summaries().
+        """
+        all_datasets = all_datasets[all_datasets["datasetID"] != "allDatasets"]
+        all_datasets = all_datasets.astype(object).where(all_datasets.notna(), None)
+        return {summary["datasetID"]: summary for summary in all_datasets.to_dict("records")}
+
+    @staticmethod
+    def summary_marker(summary) -> str:
+        """
+        Returns the allDatasets change marker of a dataset summary, see refresh().
+        """
+        return f"{summary['minTime']}/{summary['maxTime']}"
+
+    def load_datasets_metadata(self, datasets, max_workers=DATASETS_LOADING_WORKERS):
+        """
+        Downloads concurrently the metadata of the datasets created from their allDatasets summary,
+        so that their parameters can be matched with the EOVs. Failures are reported in failed_datasets.
+        """
+        datasets = [dataset for dataset in datasets if not dataset.metadata_loaded]
+        if len(datasets) == 0:
+            return
+
+        def load_metadata(dataset):
+            try:
+                dataset.load_metadata()
+            except Exception as e:
+                self.failed_datasets[(dataset.server, dataset.name)] = repr(e)
+                logger.warning(f"Could not load metadata of {dataset.name} from {dataset.server} : {repr(e)}")
+                return
+            if self.catalog_cache is not None:
+                self.catalog_cache.put_dataset(dataset)
+
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            list(executor.map(load_metadata, datasets))
+        logger.debug(f"Loaded metadata of {len(datasets)} datasets in {time.time() - start} seconds.")
+
+    def datasets_markers(self, erddap_server) -> dict:
+        """
+        Returns a dict with the dataset IDs of an Erddap server as keys and their allDatasets change markers
+        (see summary_marker()) as values, from the allDatasets table downloaded once by datasets_summaries() ;
+        an empty dict if the table is not available.
+        """
+        return {dataset_id: self.summary_marker(summary) for dataset_id, summary in self.datasets_summaries(erddap_server).items()}
+
+    def refresh(self) -> list:
+        """
+        Revalidates the datasets known by the broker against their Erddap servers :
+        - the datasets lists of servers configured with None are downloaded again, new datasets are loaded
+          and removed datasets are dropped
+        - datasets whose allDatasets minTime/maxTime marker did not change are skipped without any request
+        - other datasets metadata are revalidated with conditional requests (ETag / Last-Modified) and
+          parsed again only if their content changed
+        The catalog cache, if any, is updated.
+        
+        Returns the list of ErddapDataset objects that were loaded or whose metadata changed.
+        """
+        start = time.time()
+        self.wait_ready()
+        with self._summaries_lock:
+            self._summaries.clear()
+        for erddap_server, dataset_ids in self.erddap_servers.items():
+            if dataset_ids is not None:
+                continue
+            try:
+                erddap_datasets_list = self.fetch_datasets_list(erddap_server)
+            except Exception as e:
+                logger.warning(f"Could not refresh datasets list of {erddap_server} : {str(e)}")
+                continue
+            if self.catalog_cache is not None:
+                self.catalog_cache.put_server_datasets(erddap_server, erddap_datasets_list)
+            with self._datasets_lock:
+                self.datasets_list = [(server, dataset_id) for server, dataset_id in self.datasets_list
+                                      if server != erddap_server or dataset_id in erddap_datasets_list]
+                self.datasets = [dataset for dataset in self.datasets
+                                 if dataset.server != erddap_server or dataset.name in erddap_datasets_list]
+            self.find_datasets_in_erddap_server(erddap_server)
+
+        markers = {erddap_server: self.datasets_markers(erddap_server) for erddap_server in self.erddap_servers}
+        loaded = {(dataset.server, dataset.name) for dataset in self.datasets}
+        changed = []
+        with concurrent.futures.ThreadPoolExecutor(5) as executor:
+            futures = {}
+            for dataset in self.datasets:
+                futures[executor.submit(dataset.revalidate, markers[dataset.server].get(dataset.name))] = dataset
+            for erddap_server, dataset_id in self.datasets_list:
+                if (erddap_server, dataset_id) not in loaded:
+                    futures[executor.submit(self.fetch_dataset, erddap_server, dataset_id)] = None
+            
+            for future in concurrent.futures.as_completed(futures):
+                dataset = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning(f"Could not refresh {dataset if dataset is not None else 'new dataset'} : {str(e)}")
+                    continue
+                if dataset is None:
+                    dataset = result
+                    self.register_dataset(dataset)
+                    changed.append(dataset)
+                elif result:
+                    changed.append(dataset)
+                if self.catalog_cache is not None:
+                    self.catalog_cache.put_dataset(dataset)
+        
+        self.build_index()
+        logger.info(f"Refreshed {len(self.datasets)} datasets in {time.time() - start} seconds, {len(changed)} changed.")
+        return changed
     
     def build_vocabularies(self, eov) -> dict:
         """
-        Wrapper for query_vocabularies()
+        Wrapper for query_vocabularies(), reading the result from the catalog cache when available.
         Argument :
         eov: (str) Essential Ocean Variable name
         """
+        return eov, self.build_all_vocabularies([eov])[eov]
+
+    def build_all_vocabularies(self, eovs) -> dict:
+        """
+        Gathers the vocabularies of several EOVs : the EOVs missing from the catalog cache (or stale)
+        are queried from the vocabulary server in a single request (see query_all_vocabularies()).
+        If the vocabulary server cannot be reached, stale cache entries are used when available.
+        Argument :
+        eovs: list of Essential Ocean Variable names
+
+        Returns a dict of the vocabulary server rows of each EOV.
+        """
         start = time.time()
         vocabularies = {}
-        
-        eov_result = self.query_vocabularies(eov)
+        if self.catalog_cache is not None:
+            for eov in eovs:
+                rows = self.catalog_cache.get_vocabulary(eov)
+                if rows is not None:
+                    vocabularies[eov] = rows
+        missing = [eov for eov in eovs if eov not in vocabularies]
+        if len(missing) == 0:
+            return vocabularies
+
+        try:
+            fetched = self.query_all_vocabularies(missing)
+        except Exception as e:
+            if self.catalog_cache is None:
+                raise
+            fetched = {eov: self.catalog_cache.get_vocabulary(eov, allow_stale=True) for eov in missing}
+            if any(rows is None for rows in fetched.values()):
+                raise
+            logger.warning(f"Failed to refresh {', '.join(missing)} vocabularies ({str(e)}), using stale catalog cache entries.")
+        else:
+            if self.catalog_cache is not None:
+                for eov, rows in fetched.items():
+                    self.catalog_cache.put_vocabulary(eov, rows)
+        vocabularies.update(fetched)
         logger.debug(f"Gathering vocabularies took {time.time() - start} seconds.")
-        return eov, eov_result
-        
+        return vocabularies
+
+    @property
+    def vocabularies_source(self):
+        """
+        KGSource of the vocabulary server, built once and shared by the vocabularies queries.
+        """
+        with self._vocabularies_source_lock:
+            if self._vocabularies_source is None:
+                self._vocabularies_source = pykg2tbl.KGSource.build(self.vocabularies_server)
+            return self._vocabularies_source
     
     def query_vocabularies(self, eov) -> dict:
         """
@@ -145,9 +690,42 @@ class MarineBroker:
         Arguments :
         eov: variable string
         """
-        kgsource = KGSource.build(self.vocabularies_server)
-        query_result = kgsource.query(DEFAULT_QUERY_STRINGS[eov])
-        return query_result.to_list()
+        return self.query_all_vocabularies([eov])[eov]
+
+    def query_all_vocabularies(self, eovs) -> dict:
+        """
+        Queries the vocabulary server for the P01 parameters corresponding to several A05 EOV terms,
+        in a single SPARQL query (eov_batch_query.sparql).
+
+        Arguments :
+        eovs: list of EOV names
+
+        Returns a dict of the vocabulary server rows of each EOV.
+        """
+        query = sparql_builder().build_syntax("eov_batch_query.sparql", eovs=eovs)
+        vocabularies = {eov: [] for eov in eovs}
+        for row in self.vocabularies_source.query(query).to_list():
+            vocabularies[row.pop("eov_code")].append(row)
+        return vocabularies
+
+    def export_vocabularies(self, path):
+        """
+        Saves the broker vocabularies to a VocabularyBundle file (Turtle if path ends with .ttl, JSON otherwise),
+        which can be given to the vocabularies_bundle argument of the next brokers to start without querying NVS.
+        The vocabularies of all the EOVs are resolved first.
+        """
+        self.vocabularies.load(list(self.vocabularies))
+        bundle = VocabularyBundle(self.vocabularies.loaded(), source=self.vocabularies_server)
+        bundle.save(path)
+        return bundle
+
+    def import_vocabularies(self, path) -> dict:
+        """
+        Reads the vocabularies of a VocabularyBundle file written by export_vocabularies().
+        """
+        bundle = VocabularyBundle.load(path)
+        logger.info(f"Loaded {', '.join(bundle.vocabularies)} vocabularies from {path} ({bundle.created})")
+        return bundle.vocabularies
 
 
     
@@ -155,6 +733,8 @@ class MarineBroker:
         """
         Looks through the dataset metadata to find a matching variable name.
         The match is made on the "sdn_parameter_urn" variable attribute.
+        This is a lookup in the EOV index : candidate_datasets() loads the metadata of the datasets
+        and updates the index once per request beforehand.
 
         Arguments:
         dataset: ErddapDataset object
@@ -163,64 +743,76 @@ class MarineBroker:
         Returns : variable name if a match is made, otherwise False.
         """
 
-        found_eov = ""
-        P01 = [v["P01not"] for v in eov_vocabs]
-        P02 = [v["P02not"] for v in eov_vocabs]
+        eov_datasets = self.eov_datasets.get(eov)
+        if eov_vocabs is self.vocabularies.get(eov) and eov_datasets is not None and dataset.metadata_loaded:
+            found_vars = eov_datasets.get(dataset, [])
+        else:
+            # Vocabularies other than the broker ones, or datasets not indexed yet, are matched against this dataset only.
+            parameter_index = {sdn_parameter_urn: [(dataset, variable_name)]
+                               for sdn_parameter_urn, variable_name in dataset.parameters.items()}
+            found_vars = self.match_eov(eov_vocabs, parameter_index).get(dataset, [])
 
-        # found_vars = [dataset.parameters[i] for i in P01 if i in dataset.parameters.keys()]
-        found_vars = []
-        for i in P01:
-            if i in dataset.parameters.keys():
-                eov_param_name_in_dataset = dataset.parameters[i]
-                found_vars.append(eov_param_name_in_dataset)
-                if eov in dataset.found_eovs.keys():
-                    if eov_param_name_in_dataset not in dataset.found_eovs[eov]:
-                        dataset.found_eovs[eov].append(eov_param_name_in_dataset)
-                    else:
-                        continue
-                else:
-                    dataset.found_eovs[eov] = [eov_param_name_in_dataset]
-
-        if len(found_vars) == 0:
-            found_vars = [
-                dataset.parameters[i]
-                for i in P02
-                if i in dataset.parameters.keys()
-            ]
-            for i in P02:
-                # if dataset.name == "SDC_GLO_AGG_V2":
-                #     logging.debug(f"{dataset.name} :: P02 param : {i}")
-                if i in dataset.parameters.keys():
-                    eov_param_name_in_dataset = dataset.parameters[i]
-                    found_vars.append(eov_param_name_in_dataset)
-                    if eov in dataset.found_eovs.keys():
-                        if (
-                            eov_param_name_in_dataset
-                            not in dataset.found_eovs[eov]
-                        ):
-                            dataset.found_eovs[eov].append(
-                                eov_param_name_in_dataset
-                            )
-                        else:
-                            continue
-                    else:
-                        dataset.found_eovs[eov] = [eov_param_name_in_dataset]
-                # if i in dataset.parameters.keys():
-                #     found_vars.append(dataset.parameters[i])
-                #     if eov in dataset.found_eovs.keys():
-                #         dataset.found_eovs[eov].append(dataset.parameters[i])
-                #     else:
-                #         dataset.found_eovs[eov] = [dataset.parameters[i]]
-
-        if found_vars is not None and len(found_vars) > 0:
-            # logging.debug(f"Found vars for dataset {dataset.name} : {np.unique(found_vars)}")
+        for eov_param_name_in_dataset in found_vars:
+            if eov in dataset.found_eovs.keys():
+                if eov_param_name_in_dataset not in dataset.found_eovs[eov]:
+                    dataset.found_eovs[eov].append(eov_param_name_in_dataset)
+            else:
+                dataset.found_eovs[eov] = [eov_param_name_in_dataset]
+
+        if len(found_vars) > 0:
             return np.unique(found_vars)
         else:
-            # logging.debug(f"No vars found for dataset {dataset.name}")
             return []
 
-        # Nothing was found while looping through vocabularies:
-        return None
+    def match_eov(self, eov_vocabs, parameter_index) -> dict:
+        """
+        Matches the vocabulary server response for an EOV with an inverted index of datasets parameters.
+        P01 codes are matched first ; P02 codes are only used for the datasets without any P01 match.
+
+        Arguments:
+        eov_vocabs: dictionnary containing vocabulary server response.
+        parameter_index: dict with "sdn_parameter_urn" values as keys and lists of (dataset, variable name) as values
+
+        Returns a dict with ErddapDataset objects as keys and lists of matching variables names as values.
+        """
+        datasets_variables = {}
+        for vocabulary_key in ["P01not", "P02not"]:
+            matches = {}
+            for code in dict.fromkeys(v.get(vocabulary_key) for v in eov_vocabs):
+                for dataset, variable_name in parameter_index.get(code, []):
+                    if dataset in datasets_variables:
+                        continue
+                    variables = matches.setdefault(dataset, [])
+                    if variable_name not in variables:
+                        variables.append(variable_name)
+            datasets_variables.update(matches)
+        return datasets_variables
+
+    def datasets_for_eov(self, eov) -> dict:
+        """
+        Returns a dict with the datasets containing the EOV as keys and the matching variables names as values.
+        The metadata of all the datasets, and the EOV vocabularies, are loaded if needed.
+        """
+        self.vocabularies.load([eov])
+        self.load_datasets_metadata(list(self.datasets))
+        self.update_index()
+        return self.eov_datasets.get(eov, {})
+
+    def candidate_datasets(self, eovs, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> list:
+        """
+        Returns the datasets containing at least one of the EOVs and whose coverage may intersect the query constraints.
+        This is answered by the spatial/temporal & EOV indexes ; only the metadata of the datasets
+        within the query constraints which was not loaded yet is downloaded, as well as the vocabularies of the EOVs.
+        """
+        self.vocabularies.load(eovs)
+        self.update_index()
+        candidates = self.index.candidates(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+        self.load_datasets_metadata(candidates)
+        self.update_index()
+        eov_datasets = set()
+        for eov in eovs:
+            eov_datasets.update(self.eov_datasets.get(eov, {}).keys())
+        return [dataset for dataset in candidates if dataset in eov_datasets]
     
     def validate_datetime(self, input_date):
         """
@@ -253,7 +845,8 @@ class MarineBroker:
                                   query_max_lon, 
                                   query_max_lat,
                                   output_format,
-                                  query_specific_variables=None):
+                                  query_specific_variables=None,
+                                  **request_options):
         """
         Searches for EOVs in the provided ErddapDataset metadata.
         Checks if the query constraints is valid for the provided ErddapDataset object
@@ -265,23 +858,15 @@ class MarineBroker:
         query_min/max_lon/lat : float
         output_format : (str)
         
+        Other keyword arguments are passed to ErddapRequest (e.g. griddap subsetting options).
+        
         Returns a ErddapRequest object.
         """
-        variables_found = []
-
-        start = time.time()
-        for eov in eovs:
-            variables_found.extend(self.find_eov_in_dataset(dataset, eov, self.vocabularies[eov]))
-        logger.debug(f"Looking for eovs in {dataset.name} took {time.time() - start} seconds with result : {variables_found}")
-
-        # Filter out None values
-        variables_found = [v for v in variables_found if v]
-
+        variables_found = self.find_variables_in_dataset(dataset, eovs)
         if len(variables_found) == 0:
-            logger.debug(f"Will discard dataset {dataset.name} because no variables found.")
             return None
 
-        if dataset.covers_spatiotemporal_query(query_start_date, query_end_date, query_min_lon, query_min_lat, query_max_lon, query_max_lat):
+        if self.covers_spatiotemporal_query(dataset, query_start_date, query_end_date, query_min_lon, query_min_lat, query_max_lon, query_max_lat):
             
             request = ErddapRequest(dataset,
                                     variables_found,
@@ -292,12 +877,239 @@ class MarineBroker:
                                     query_start_date,
                                     query_end_date,
                                     output_format,
-                                    query_specific_variables
+                                    query_specific_variables,
+                                    data_cache=self.data_cache,
+                                    **request_options
                                    )
             return request
         else:
             return None
 
+    def find_variables_in_dataset(self, dataset, eovs) -> list:
+        """
+        Returns the list of the dataset variables matching the EOVs.
+        
+        Arguments:
+        dataset : ErddapDataset object
+        eovs: (list(str)) : list of EOVs requested
+        """
+        variables_found = []
+
+        start = time.time()
+        for eov in eovs:
+            variables_found.extend(self.find_eov_in_dataset(dataset, eov, self.vocabularies[eov]))
+        logger.debug(f"Looking for eovs in {dataset.name} took {time.time() - start} seconds with result : {variables_found}")
+
+        # Filter out None values
+        variables_found = [v for v in variables_found if v]
+
+        if len(variables_found) == 0:
+            logger.debug(f"Will discard dataset {dataset.name} because no variables found.")
+        return variables_found
+
+    def covers_spatiotemporal_query(self, dataset, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> bool:
+        """
+        Checks if the dataset has data within the query constraints (see ErddapDataset.covers_spatiotemporal_query()).
+        For tabledap datasets, the coverage grid of the dataset is looked up first (see build_coverage_grids()),
+        then the coverage cache, and the server is only probed if neither of them can answer.
+        """
+        if dataset.protocol != "tabledap":
+            return dataset.covers_spatiotemporal_query(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+        
+        covered = self.grid_coverage(dataset, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+        if covered is not None:
+            return covered
+        key = self.coverage_cache.key(dataset, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+        covered = self.coverage_cache.get(key)
+        if covered is None:
+            try:
+                covered = dataset.probe_tabledap_coverage(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+            except requests.HTTPError as e:
+                # Failed probes are not cached
+                logger.debug(f"Coverage probe of {dataset.name} failed with exception {str(e)}")
+                return False
+            self.coverage_cache.put(key, covered)
+        return covered
+
+    def grid_coverage(self, dataset, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat):
+        """
+        Checks the query constraints against the coverage grid of the dataset.
+        Returns True / False, or None if the dataset has no coverage grid or if the grid can not decide.
+        """
+        grid = self.coverage_grids.get((dataset.server, dataset.name))
+        if grid is None:
+            return None
+        return grid.covers(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat)
+
+    def build_coverage_grids(self, resolution=1.0, background=True, max_workers=2):
+        """
+        Builds the coverage grids of the tabledap datasets (see CoverageGrid), used afterwards by
+        covers_spatiotemporal_query() instead of probing the Erddap servers.
+        Grids found in the catalog cache are reused ; the new ones are stored in it.
+        
+        Keyword arguments:
+        resolution: cells size in degrees
+        background: if True, return immediately a concurrent.futures.Future completed once all the grids are built
+        max_workers: number of grids computed at the same time
+        
+        Returns the dict of the coverage grids, or a Future of it in background mode.
+        """
+        def build_grid(dataset):
+            key = (dataset.server, dataset.name)
+            if self.catalog_cache is not None:
+                record = self.catalog_cache.get_coverage_grid(dataset.server, dataset.name)
+                if record is not None and record["resolution"] == resolution:
+                    self.coverage_grids[key] = CoverageGrid.from_record(record)
+                    return
+            grid = CoverageGrid.build(dataset, resolution)
+            if grid is None:
+                return
+            self.coverage_grids[key] = grid
+            if self.catalog_cache is not None:
+                self.catalog_cache.put_coverage_grid(dataset.server, dataset.name, grid)
+
+        def build_grids():
+            with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+                futures = {executor.submit(build_grid, dataset): dataset
+                           for dataset in self.datasets if dataset.protocol == "tabledap"}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.warning(f"Could not build coverage grid of {futures[future].name} : {str(e)}")
+            return self.coverage_grids
+
+        if not background:
+            return build_grids()
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        future = executor.submit(build_grids)
+        executor.shutdown(wait=False)
+        return future
+
+    def rank_datasets(self, eovs, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) -> list:
+        """
+        Ranks the datasets containing the EOVs by the number of values their coverage grid has within the query constraints.
+        Returns a list of (ErddapDataset, count) tuples sorted by decreasing count ; datasets without coverage grid
+        come last with a None count.
+        """
+        if isinstance(eovs, str):
+            eovs = [eovs]
+        ranking = []
+        for dataset in self.candidate_datasets(eovs, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat):
+            grid = self.coverage_grids.get((dataset.server, dataset.name))
+            count = grid.count(start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat) if grid is not None else None
+            ranking.append((dataset, count))
+        return sorted(ranking, key=lambda dataset_count: -1 if dataset_count[1] is None else dataset_count[1], reverse=True)
+
+    def estimate_rows(self, request, count_query=False):
+        """
+        Estimates the number of rows returned by an ErddapRequest (see ErddapRequest.estimate_rows()),
+        using the coverage grid of tabledap datasets when it has been built.
+        Without coverage grid, tabledap rows are counted by the Erddap server if count_query is True
+        (see ErddapRequest.count_rows()).
+        Returns None if the size can not be estimated.
+        """
+        rows = request.estimate_rows(self.coverage_grids.get((request.dataset.server, request.dataset.name)))
+        if rows is None and count_query and request.dataset.protocol == "tabledap":
+            try:
+                rows = request.count_rows()
+            except requests.HTTPError as e:
+                logger.warning(f"Could not count the rows of {request.dataset.name} : {str(e)}")
+        return rows
+
+    def estimate_request(self, request, count_query=False):
+        """
+        Sets the estimated_rows & estimated_bytes attributes of an ErddapRequest (see estimate_rows()).
+        """
+        request.estimated_rows = self.estimate_rows(request, count_query)
+        request.estimated_bytes = None
+        if request.estimated_rows is not None:
+            request.estimated_bytes = request.estimated_rows * request.row_size()
+        return request
+
+    def apply_budget(self, requests_list, max_rows=None, max_bytes=None, policy="split", estimated=False):
+        """
+        Estimates the size of the requests and handles the ones exceeding the max_rows / max_bytes budget :
+        - drop: the request is discarded
+        - split: the request is replaced by sub-requests within the budget (see split_request()) ;
+                 griddap requests which can not be split (single time value) are downsampled, and
+                 tabledap ones (e.g. aggregated requests, whose bins would be cut) are dropped
+        - downsample: griddap requests are decimated with strides until they fit the budget ;
+                      tabledap requests are split
+        Requests whose size can not be estimated are kept as is. The reason why a request is dropped
+        is set in its dropped_reason attribute.
+        If estimated is True, the sizes of the requests were already estimated (see estimate_request()).
+        
+        Returns the (kept requests, dropped requests) lists.
+        """
+        if policy not in BUDGET_POLICIES:
+            raise Exception(f"Budget policy {policy} not in {BUDGET_POLICIES}")
+        budgeted = max_rows is not None or max_bytes is not None
+        kept, dropped = [], []
+        for request in requests_list:
+            if not estimated:
+                self.estimate_request(request, count_query=budgeted)
+            if not budgeted or request.estimated_rows is None:
+                if budgeted:
+                    logger.warning(f"Size of the request on {request.dataset.name} is unknown, it is kept.")
+                kept.append(request)
+                continue
+            row_budget = request.row_budget(max_rows, max_bytes)
+            if request.estimated_rows <= row_budget:
+                kept.append(request)
+            elif policy == "drop":
+                request.dropped_reason = f"{request.estimated_rows} rows exceed the budget of {row_budget} rows"
+                logger.warning(f"Request on {request.dataset.name} ({request.estimated_rows} rows) exceeds the budget, it is dropped.")
+                dropped.append(request)
+            elif policy == "downsample" and request.dataset.protocol == "griddap":
+                request.downsample(row_budget)
+                kept.append(self.estimate_request(request))
+            else:
+                time_chunks = int(np.ceil(request.estimated_rows / max(1, row_budget)))
+                sub_requests = self.split_request(request, time_chunks=time_chunks).sub_requests
+                if len(sub_requests) == 1 and request.dataset.protocol == "griddap":
+                    logger.warning(f"Request on {request.dataset.name} ({request.estimated_rows} rows) can not be split, it is downsampled.")
+                    request.downsample(row_budget)
+                    kept.append(self.estimate_request(request))
+                    continue
+                if len(sub_requests) == 1:
+                    request.dropped_reason = (f"{request.estimated_rows} rows exceed the budget of {row_budget} rows "
+                                              f"and the request can not be split")
+                    logger.warning(f"Request on {request.dataset.name} ({request.estimated_rows} rows) exceeds the budget "
+                                   f"and can not be split, it is dropped.")
+                    dropped.append(request)
+                    continue
+                logger.debug(f"Request on {request.dataset.name} ({request.estimated_rows} rows) split into {len(sub_requests)}.")
+                for sub_request in sub_requests:
+                    if sub_request.dataset.protocol == "griddap":
+                        self.estimate_request(sub_request)
+                    else:
+                        sub_request.estimated_rows = request.estimated_rows // len(sub_requests)
+                        sub_request.estimated_bytes = sub_request.estimated_rows * sub_request.row_size()
+                kept.extend(sub_requests)
+        return kept, dropped
+
+    def split_request(self, request, max_rows=DEFAULT_MAX_ROWS_PER_REQUEST, time_chunks=None, space_chunks=1):
+        """
+        Splits an ErddapRequest into sub-requests small enough for the Erddap server response limits,
+        to be downloaded concurrently with SplitRequest.fetch().
+        
+        Keyword arguments:
+        max_rows -- estimated number of rows of each sub-request, used when time_chunks is None
+        time_chunks -- number of time windows ; estimated from max_rows if None
+        space_chunks -- number of longitude bands (tabledap only)
+        
+        Returns a SplitRequest.
+        """
+        if time_chunks is None:
+            rows = self.estimate_rows(request)
+            time_chunks = 1 if rows is None else max(1, int(np.ceil(rows / (max_rows * space_chunks))))
+        sub_requests = [space_request
+                        for time_request in request.split_time(time_chunks)
+                        for space_request in time_request.split_space(space_chunks)]
+        logger.debug(f"Split request on {request.dataset.name} into {len(sub_requests)} sub-requests.")
+        return SplitRequest(request, sub_requests)
+
     def check_variables(self,
                         eovs,
                         query_start_date,
@@ -346,7 +1158,14 @@ class MarineBroker:
                        query_min_lat, 
                        query_max_lon, 
                        query_max_lat,
-                       output_format) -> list:
+                       output_format,
+                       depth_range=None,
+                       strides=None,
+                       resolution=None,
+                       aggregation=None,
+                       max_rows=None,
+                       max_bytes=None,
+                       budget_policy="split") -> list:
         """
         Create Erddap queries according to arguments provided as input.
         Returns a list of ErddapRequest objects
@@ -360,6 +1179,17 @@ class MarineBroker:
         query_max_lon: max longitude float
         query_max_lat: max latitude float
         output_format: output format string
+        
+        Keyword arguments (griddap datasets only, see ErddapRequest) :
+        depth_range: (min, max) depths requested
+        strides: dict of dimension ("time", "depth", "latitude", "longitude") -> stride
+        resolution: target latitude / longitude resolution in degrees
+        
+        aggregation: dict reducing the data on the Erddap servers (see ErddapRequest.set_aggregation()), e.g.
+                     {"time": "1month", "latitude": 1, "longitude": 1, "function": "mean"}
+        
+        max_rows / max_bytes: estimated size budget of each request (see apply_budget())
+        budget_policy: "drop", "split" or "downsample" the requests exceeding the budget
         """
         request_datasets = []
 
@@ -379,7 +1209,8 @@ class MarineBroker:
 
         with concurrent.futures.ThreadPoolExecutor(20) as executor:
             futures = []
-            for dataset in self.datasets:
+            for dataset in self.candidate_datasets(eovs, query_start_date, query_end_date,
+                                                   query_min_lon, query_min_lat, query_max_lon, query_max_lat):
                 futures.append(
                     executor.submit(self.setup_request_for_dataset,
                                     dataset,
@@ -390,7 +1221,11 @@ class MarineBroker:
                                     query_min_lat,
                                     query_max_lon,
                                     query_max_lat,
-                                    output_format
+                                    output_format,
+                                    depth_range=depth_range,
+                                    strides=strides,
+                                    resolution=resolution,
+                                    aggregation=aggregation,
                                     )
                 )
 
@@ -398,8 +1233,11 @@ class MarineBroker:
             for future in concurrent.futures.as_completed(futures):
                 result = future.result()
                 if result is not None:
-                    response.add_query(result)
+                    request_datasets.append(result)
 
+        request_datasets, response.dropped = self.apply_budget(request_datasets, max_rows, max_bytes, budget_policy)
+        for request in request_datasets:
+            response.add_query(request)
         return response
 
     def submit_sparql_named_query(
@@ -412,7 +1250,7 @@ class MarineBroker:
         linked_dataset,
         **variables
     ) -> list:
-        query = j2sqb.build_syntax(query_name, **variables)
+        query = sparql_builder().build_syntax(query_name, **variables)
 
         endpoint = source
         query_start_date = variables.get("start_date", None)
@@ -454,7 +1292,7 @@ class MarineBroker:
     ) -> list:
         # Build Knowledge source from endpoint
         #   (could be a list of endpoint, files)
-        kgsource = KGSource.build(endpoint)
+        kgsource = pykg2tbl.KGSource.build(endpoint)
         # Query response as a QueryResult class
         query_result = kgsource.query(query)
         # Get the contents of the linked_var as a list
@@ -506,7 +1344,27 @@ class ErddapRequest:
                  query_end_date,
                  output_format,
                  query_specific_variable=None,
+                 spool_dir=None,
+                 data_cache=None,
+                 depth_range=None,
+                 strides=None,
+                 resolution=None,
+                 aggregation=None,
                 ):
+        """
+        Keyword arguments:
+        query_specific_variable -- {dataset variable: value} constraint added to tabledap queries
+        spool_dir -- directory of the files written by the streaming downloads (see get_nc_file()) ;
+                     the system temporary directory if None
+        data_cache -- DataCache where the downloaded NetCDF data is kept & looked up before any download
+        
+        Griddap subsetting (ignored for tabledap datasets) :
+        depth_range -- (min, max) depths requested ; all the depth levels if None
+        strides -- dict of dimension ("time", "depth", "latitude", "longitude") -> stride, 1 by default
+        resolution -- target latitude / longitude resolution in degrees, converted to strides
+                      from the dimensions spacing of the dataset
+        aggregation -- server-side aggregation, see set_aggregation()
+        """
         
         self.dataset = dataset
         self.query_variables = query_variables
@@ -539,10 +1397,29 @@ class ErddapRequest:
         self.query_start_date = query_start_date
         self.query_end_date = query_end_date
         self.output_format = output_format
-        
-        self.query_url = self.build_url(output_format=output_format)
+        self.depth_range = None
+        self.strides = dict.fromkeys(GRIDDAP_DIMENSIONS, 1)
+        self.resolution = None
+        self.aggregation = None
+        # Set by MarineBroker.estimate_request()
+        self.estimated_rows = None
+        self.estimated_bytes = None
+        # Set by MarineBroker.apply_budget() when the request is dropped
+        self.dropped_reason = None
+        # Also build the query URL
+        self.set_subsetting(depth_range, strides, resolution)
+        if aggregation is not None:
+            self.set_aggregation(aggregation)
             
         self.nc_data = None
+        self.spool_dir = spool_dir
+        self.data_cache = data_cache
+        self.nc_file = None
+        # Cached files are not removed by close()
+        self.nc_file_cached = False
+        # Progress of the current / last streaming download
+        self.bytes_downloaded = 0
+        self.bytes_total = None
     
     def build_url(self, output_format=""):
         """
@@ -557,30 +1434,159 @@ class ErddapRequest:
         
         if self.dataset.protocol == "tabledap":
             if self.query_specific_variable is None:
+                # Aggregated values are not linked to a platform
+                platform = "" if self.aggregation is not None else "platform_number%2C"
                 query_string = (f"{self.dataset.data_url}.{output_format}"
-                                f"?time%2Clatitude%2Clongitude%2Cplatform_number%2C{'%2C'.join(self.query_variables)}"
-                                f"&time%3E={self.query_start_date}&time%3C={self.query_end_date}"
-                                f"&latitude%3E={self.query_min_lat}&latitude%3C={self.query_max_lat}&longitude%3E={self.query_min_lon}&longitude%3C={self.query_max_lon}")
+                                f"?time%2Clatitude%2Clongitude%2C{platform}{'%2C'.join(self.query_variables)}"
+                                f"{self.tabledap_constraints()}")
             else:
-                s_var_dataset, s_var_value = next(iter(self.query_specific_variable.items()))
                 query_string = (f"{self.dataset.data_url}.{output_format}"
                                 f"?time%2Clatitude%2Clongitude%2C{'%2C'.join(self.query_variables)}"
-                                f"&time%3E={self.query_start_date}&time%3C={self.query_end_date}"
-                                f"&latitude%3E={self.query_min_lat}&latitude%3C={self.query_max_lat}&longitude%3E={self.query_min_lon}&longitude%3C={self.query_max_lon}"
-                                f"&{s_var_dataset}=\"{s_var_value}\"")
+                                f"{self.tabledap_constraints()}")
+            if self.aggregation is not None:
+                query_string += self.aggregation_filter()
 
         else:
             query_string = f"{self.dataset.data_url}.{output_format}?"
+            time_start, time_end = self.griddap_time_range()
+            depth_start, depth_end = self.griddap_depth_range()
             for variable in self.query_variables:
-                query_string += f'{variable}[({self.query_start_date}):1:({self.query_end_date})]'
-                if len(self.dataset.wms_elevation_values) > 0:
-                    query_string += f'[({self.dataset.wms_elevation_values[0]}):1:({self.dataset.wms_elevation_values[-1]})]'
-                query_string += f'[({self.query_min_lat}):1:({self.query_max_lat})]'
-                query_string += f'[({self.query_min_lon}):1:({self.query_max_lon})],'
+                query_string += f'{variable}[({time_start}):{self.strides["time"]}:({time_end})]'
+                if depth_start is not None:
+                    query_string += f'[({depth_start}):{self.strides["depth"]}:({depth_end})]'
+                query_string += f'[({self.query_min_lat}):{self.strides["latitude"]}:({self.query_max_lat})]'
+                query_string += f'[({self.query_min_lon}):{self.strides["longitude"]}:({self.query_max_lon})],'
                 
             query_string = query_string.rstrip(',')
         return query_string
 
+    def tabledap_constraints(self) -> str:
+        """
+        Returns the tabledap constraints of the query : time window, bounding box and specific variable value.
+        """
+        constraints = (f"&time%3E={self.query_start_date}&time%3C={self.query_end_date}"
+                       f"&latitude%3E={self.query_min_lat}&latitude%3C={self.query_max_lat}&longitude%3E={self.query_min_lon}&longitude%3C={self.query_max_lon}")
+        if self.query_specific_variable is not None:
+            s_var_dataset, s_var_value = next(iter(self.query_specific_variable.items()))
+            constraints += f"&{s_var_dataset}=\"{s_var_value}\""
+        return constraints
+
+    def set_subsetting(self, depth_range=None, strides=None, resolution=None):
+        """
+        Sets the griddap subsetting options (see __init__()) and updates the query URL.
+        """
+        strides = dict(strides or {})
+        unknown = set(strides) - set(GRIDDAP_DIMENSIONS)
+        if len(unknown) > 0:
+            raise Exception(f"Unknown griddap dimensions {unknown}, strides must be given for : {GRIDDAP_DIMENSIONS}")
+        if resolution is not None:
+            for dimension in ("latitude", "longitude"):
+                spacing = self.dataset.dimension_spacing(dimension)
+                if spacing and dimension not in strides:
+                    strides[dimension] = max(1, int(round(float(resolution) / spacing)))
+        for dimension, stride in strides.items():
+            if int(stride) < 1:
+                raise Exception(f"Stride of {dimension} must be a positive integer, got {stride}")
+        self.depth_range = None if depth_range is None else (float(min(depth_range)), float(max(depth_range)))
+        self.strides = {dimension: int(strides.get(dimension, 1)) for dimension in GRIDDAP_DIMENSIONS}
+        self.resolution = resolution
+        self.query_url = self.build_url(output_format=self.output_format)
+
+    def set_aggregation(self, aggregation):
+        """
+        Asks the Erddap server to reduce the data before sending it, and updates the query URL.
+        
+        Arguments:
+        aggregation -- dict with the keys :
+                       - time: Erddap time period of the bins, e.g. "1day", "1month"
+                       - latitude / longitude: size of the bins in degrees
+                       - depth: size of the bins in the unit of the depth variable (tabledap only)
+                       - function: "mean" (default) or "count"
+                       None to remove the aggregation.
+        
+        Tabledap values are averaged / counted in each bin with the Erddap orderByMean / orderByCount filters.
+        Griddap data is decimated instead : the bins sizes are converted to strides (see set_subsetting()).
+        """
+        if aggregation is None:
+            self.aggregation = None
+            self.query_url = self.build_url(output_format=self.output_format)
+            return
+        aggregation = dict(aggregation)
+        unknown = set(aggregation) - set(AGGREGATION_KEYS)
+        if len(unknown) > 0:
+            raise Exception(f"Unknown aggregation keys {unknown}, allowed keys are : {AGGREGATION_KEYS}")
+        aggregation.setdefault("function", "mean")
+        if aggregation["function"] not in AGGREGATION_FUNCTIONS:
+            raise Exception(f"Aggregation function {aggregation['function']} not in {list(AGGREGATION_FUNCTIONS)}")
+        if "time" in aggregation:
+            period_to_seconds(aggregation["time"])
+
+        if self.dataset.protocol == "griddap":
+            strides = dict(self.strides)
+            if "time" in aggregation and len(self.dataset.wms_time_values) > 1:
+                spacing = np.median(np.diff(self.dataset.wms_time_values).astype("timedelta64[s]").astype(float))
+                strides["time"] = max(1, int(round(period_to_seconds(aggregation["time"]) / spacing)))
+            for dimension in ("latitude", "longitude"):
+                spacing = self.dataset.dimension_spacing(dimension)
+                if dimension in aggregation and spacing:
+                    strides[dimension] = max(1, int(round(float(aggregation[dimension]) / spacing)))
+            self.aggregation = aggregation
+            self.set_subsetting(self.depth_range, strides)
+            return
+        self.aggregation = aggregation
+        self.query_url = self.build_url(output_format=self.output_format)
+
+    def aggregation_filter(self) -> str:
+        """
+        Returns the Erddap orderBy filter of the tabledap aggregation, e.g. &orderByMean("time/1month,latitude/1,longitude/1").
+        """
+        groups = [f"{dimension}/{self.aggregation[dimension]}"
+                  for dimension in ("time", "latitude", "longitude") if dimension in self.aggregation]
+        if "depth" in self.aggregation and len(self.dataset.depth_variables) > 0:
+            groups.append(f"{self.dataset.depth_variables[0]}/{self.aggregation['depth']}")
+        return f"&{AGGREGATION_FUNCTIONS[self.aggregation['function']]}(%22{','.join(groups)}%22)"
+
+    def is_subset(self) -> bool:
+        """
+        Returns True if the data is aggregated, or if the griddap subsetting options restrict the depth levels or use strides.
+        """
+        return (self.aggregation is not None or self.depth_range is not None
+                or any(stride != 1 for stride in self.strides.values()))
+
+    def griddap_depth_values(self) -> list:
+        """
+        Returns the depth levels (from the WMS) within the depth range, with the depth stride applied.
+        """
+        depths = self.dataset.wms_elevation_values
+        if self.depth_range is not None:
+            selected = [depth for depth in depths if self.depth_range[0] <= depth <= self.depth_range[1]]
+            if len(selected) == 0 and len(depths) > 0:
+                # Same as Erddap : the closest level is used
+                selected = [min(depths, key=lambda depth: abs(depth - self.depth_range[0]))]
+            depths = selected
+        return list(depths)[::self.strides["depth"]]
+
+    def griddap_depth_range(self) -> tuple:
+        """
+        Returns the first & last depth levels requested, or (None, None) if the dataset has no depth dimension.
+        """
+        depths = self.griddap_depth_values()
+        if len(depths) == 0:
+            return None, None
+        return depths[0], depths[-1]
+
+    def griddap_time_range(self) -> tuple:
+        """
+        Returns the first & last griddap time values within the query dates (see ErddapDataset.griddap_time_indices()),
+        so that the request does not reach outside of the dataset time axis.
+        Falls back to the query dates when the dataset time values are unknown or none matches.
+        """
+        first, last = self.dataset.griddap_time_indices(self.query_start_date, self.query_end_date)
+        if first == last:
+            return self.query_start_date, self.query_end_date
+        time_values = np.datetime_as_string(self.dataset.wms_time_values[[first, last - 1]], unit="s")
+        return f"{time_values[0]}Z", f"{time_values[1]}Z"
+
     def get_nc_data(self):
         if self.nc_data is None:
             # Tabledap offers ncCF output format which will provide with better dimensions :
@@ -589,75 +1595,578 @@ class ErddapRequest:
             # Griddap will only offer nc output format :
             # else:
             #     resp = requests.get(self.build_url(output_format="nc"))
-            resp = requests.get(self.build_url(output_format="nc"))
-            self.nc_data = resp.content
+            if self.data_cache is not None:
+                self.nc_data = self.get_cached_nc_data()
+            if self.nc_data is None:
+                resp = self.dataset.transport.get(self.build_url(output_format="nc"))
+                self.nc_data = resp.content
+                if self.data_cache is not None and resp.ok:
+                    self.data_cache.put_bytes(self, resp.content)
         return io.BytesIO(self.nc_data)
+
+    def get_cached_nc_data(self):
+        """
+        Returns the NetCDF data of the request from the data cache : cached as is, or sliced from a cached request
+        containing it (see DataCache.get_subset()). Returns None if the data cache can not answer.
+        """
+        path = self.data_cache.get(self)
+        if path is not None:
+            with open(path, 'rb') as cached:
+                return cached.read()
+        subset = self.data_cache.get_subset(self)
+        if subset is not None:
+            with subset:
+                return subset.to_netcdf()
+        return None
     
-    def to_pandas_dataframe(self):
-        return self.to_xarray().to_dataframe()
+    def sub_request(self, start, end, query_min_lon, query_min_lat, query_max_lon, query_max_lat):
+        """
+        Returns a request on the same dataset & variables with other constraints.
+        """
+        variables = [variable for variable in self.query_variables if variable not in self.dataset.depth_variables]
+        return ErddapRequest(self.dataset, variables,
+                             query_min_lon, query_min_lat, query_max_lon, query_max_lat,
+                             start, end, self.output_format, self.query_specific_variable, self.spool_dir, self.data_cache,
+                             self.depth_range, self.strides, aggregation=self.aggregation)
+
+    def split_time(self, n):
+        """
+        Splits the request into at most n requests on consecutive, non-overlapping time windows.
+        Griddap requests are split on the dataset time values ; tabledap ones in windows of equal duration.
+        """
+        bbox = (self.query_min_lon, self.query_min_lat, self.query_max_lon, self.query_max_lat)
+        # Aggregation bins would be cut by the windows
+        if n <= 1 or (self.aggregation is not None and self.dataset.protocol == "tabledap"):
+            return [self]
+        if self.dataset.protocol == "griddap":
+            first, last = self.dataset.griddap_time_indices(self.query_start_date, self.query_end_date)
+            if last - first <= 1:
+                return [self]
+            # Windows start on time values kept by the time stride, so that the sub-requests have the same values
+            time_values = np.datetime_as_string(self.dataset.wms_time_values[first:last:self.strides["time"]], unit="s")
+            if len(time_values) <= 1:
+                return [self]
+            return [self.sub_request(f"{group[0]}Z", f"{group[-1]}Z", *bbox)
+                    for group in np.array_split(time_values, min(n, len(time_values)))]
+
+        start = to_datetime64(self.query_start_date)
+        end = to_datetime64(self.query_end_date)
+        if start is None or end is None or end <= start:
+            return [self]
+        start, end = start.astype("datetime64[s]"), end.astype("datetime64[s]")
+        edges = start + ((end - start) * np.arange(n + 1)) // n
+        edges = np.unique(edges)
+        # Tabledap time constraints include both bounds : windows end just before the next one starts,
+        # at the millisecond precision of the Erddap times, so that no sub-second value falls between two windows
+        windows = [(edges[i], edges[i + 1].astype("datetime64[ms]") - np.timedelta64(1, "ms")) for i in range(len(edges) - 2)]
+        windows.append((edges[-2], end))
+        return [self.sub_request(f"{np.datetime_as_string(window_start)}Z", f"{np.datetime_as_string(window_end)}Z", *bbox)
+                for window_start, window_end in windows]
+
+    def split_space(self, n):
+        """
+        Splits a tabledap request into n requests on consecutive, non-overlapping longitude bands.
+        Griddap requests are returned as is.
+        """
+        if n <= 1 or self.dataset.protocol != "tabledap":
+            return [self]
+        edges = np.linspace(float(self.query_min_lon), float(self.query_max_lon), n + 1)
+        # Tabledap constraints include both bounds : bands start just after the end of the previous one
+        return [self.sub_request(self.query_start_date, self.query_end_date,
+                                 float(edges[i]) if i == 0 else float(np.nextafter(edges[i], np.inf)),
+                                 self.query_min_lat, float(edges[i + 1]), self.query_max_lat)
+                for i in range(n)]
+
+    def estimate_rows(self, coverage_grid=None):
+        """
+        Estimates the number of rows returned by the request :
+        - griddap : number of grid points within the constraints, from the time values & the dimensions spacing
+        - tabledap : number of values counted by the coverage grid of the dataset (see CoverageGrid)
+        Returns None if the size can not be estimated.
+        """
+        if self.dataset.protocol == "tabledap":
+            if coverage_grid is None:
+                return None
+            rows = coverage_grid.count(self.query_start_date, self.query_end_date,
+                                       self.query_min_lon, self.query_min_lat, self.query_max_lon, self.query_max_lat)
+            if self.aggregation is not None:
+                rows = min(rows, self.aggregation_bins())
+            return rows
+
+        first, last = self.dataset.griddap_time_indices(self.query_start_date, self.query_end_date)
+        rows = max(1, len(range(first, last, self.strides["time"]))) * max(1, len(self.griddap_depth_values()))
+        for dimension, span in (("latitude", self.query_max_lat - self.query_min_lat),
+                                ("longitude", self.query_max_lon - self.query_min_lon)):
+            spacing = self.dataset.dimension_spacing(dimension)
+            if not spacing:
+                return None
+            rows *= int(abs(span) / spacing) // self.strides[dimension] + 1
+        return rows
+
+    def aggregation_bins(self):
+        """
+        Returns the maximum number of bins of the tabledap aggregation within the query constraints.
+        """
+        bins = 1
+        start = to_datetime64(self.query_start_date)
+        end = to_datetime64(self.query_end_date)
+        if "time" in self.aggregation and start is not None and end is not None:
+            bins *= int((end - start) / np.timedelta64(1, "s") // period_to_seconds(self.aggregation["time"])) + 1
+        for dimension, span in (("latitude", self.query_max_lat - self.query_min_lat),
+                                ("longitude", self.query_max_lon - self.query_min_lon)):
+            if dimension in self.aggregation:
+                bins *= int(abs(span) // float(self.aggregation[dimension])) + 1
+        if "depth" in self.aggregation:
+            return np.inf
+        return bins
+
+    def count_rows(self):
+        """
+        Asks the Erddap server for the number of values of the first variable of a tabledap request (orderByCount).
+        Returns 0 if the query has no matching results ; raises requests.HTTPError on other errors.
+        """
+        try:
+            df = self.dataset.transport.read_csv(self.count_url(), skiprows=[1])
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return 0
+            raise
+        return int(df[self.count_variable()].iloc[0]) if len(df) > 0 else 0
+
+    def count_variable(self) -> str:
+        """
+        Returns the variable whose values are counted by count_rows() : the first variable which is not a depth.
+        """
+        return next(variable for variable in self.query_variables if variable not in self.dataset.depth_variables)
+
+    def count_url(self) -> str:
+        """
+        Returns the CSV query counting the values of a tabledap request, see count_rows().
+        """
+        return f"{self.dataset.data_url}.csv?{self.count_variable()}{self.tabledap_constraints()}&orderByCount(%22%22)"
+
+    def row_size(self) -> int:
+        """
+        Returns the estimated size in bytes of a row of the request, from the variables data types.
+        """
+        variables = list(self.query_variables)
+        if self.dataset.protocol == "tabledap":
+            variables += ["time", "latitude", "longitude"]
+        else:
+            variables += ["time", "latitude", "longitude"] + (["depth"] if len(self.dataset.wms_elevation_values) > 0 else [])
+        return sum(self.dataset.variable_size(variable) for variable in variables)
+
+    def row_budget(self, max_rows=None, max_bytes=None):
+        """
+        Returns the number of rows allowed by the max_rows / max_bytes budget.
+        """
+        budget = np.inf
+        if max_rows is not None:
+            budget = min(budget, max_rows)
+        if max_bytes is not None:
+            budget = min(budget, max_bytes // self.row_size())
+        return budget
+
+    def estimate_bytes(self, coverage_grid=None):
+        """
+        Estimates the size of the data returned by the request, from the estimated rows & the variables data types.
+        Returns None if the size can not be estimated.
+        """
+        rows = self.estimate_rows(coverage_grid)
+        if rows is None:
+            return None
+        return rows * self.row_size()
+
+    def downsample(self, max_rows):
+        """
+        Increases the strides of a griddap request until its estimated number of rows is below max_rows :
+        latitude & longitude strides first, then the time stride.
+        """
+        rows = self.estimate_rows()
+        if rows is None or rows <= max_rows:
+            return
+        strides = dict(self.strides)
+        factor = int(np.ceil(np.sqrt(rows / max(1, max_rows))))
+        strides["latitude"] *= factor
+        strides["longitude"] *= factor
+        self.set_subsetting(self.depth_range, strides)
+        rows = self.estimate_rows()
+        if rows > max_rows:
+            strides["time"] *= int(np.ceil(rows / max(1, max_rows)))
+            self.set_subsetting(self.depth_range, strides)
+        logger.debug(f"Request on {self.dataset.name} downsampled with strides {self.strides}.")
+
+    def stream_to_file(self, path, output_format="nc", progress=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """
+        Downloads the query result to a file by chunks, without keeping it in memory.
+        The data is written to `path`.part, which is renamed to `path` once complete, or removed if the download fails.
+        
+        Keyword arguments:
+        output_format -- Erddap output format of the file
+        progress -- callable called after each chunk with the bytes downloaded and the total bytes (None if unknown)
+        chunk_size -- size in bytes of the blocks written to disk
+        
+        Raises requests.HTTPError if the server answers with an error.
+        """
+        resp = self.dataset.transport.get(self.build_url(output_format=output_format), stream=True)
+        try:
+            resp.raise_for_status()
+            content_length = resp.headers.get("Content-Length")
+            self.bytes_total = int(content_length) if content_length is not None else None
+            self.bytes_downloaded = 0
+            try:
+                with open(f"{path}.part", 'wb') as out:
+                    for chunk in resp.iter_content(chunk_size=chunk_size):
+                        out.write(chunk)
+                        self.bytes_downloaded += len(chunk)
+                        if progress is not None:
+                            progress(self.bytes_downloaded, self.bytes_total)
+            except Exception:
+                if os.path.exists(f"{path}.part"):
+                    os.remove(f"{path}.part")
+                raise
+        finally:
+            resp.close()
+        os.replace(f"{path}.part", path)
+        logger.debug(f"Downloaded {self.bytes_downloaded} bytes of {self.dataset.name} to {path}")
+        return path
+
+    def get_nc_file(self, progress=None):
+        """
+        Streams the NetCDF query result to a file of the spool directory, once.
+        Returns the file path ; the file is removed by close().
+        
+        With a data cache, the cached file is returned if any, data sliced from a cached request containing
+        this one is written to the spool directory, and downloaded files are moved to the cache.
+        """
+        if self.nc_file is None:
+            if self.data_cache is not None:
+                self.nc_file = self.data_cache.get(self)
+                self.nc_file_cached = self.nc_file is not None
+                if self.nc_file is not None:
+                    return self.nc_file
+            fd, path = tempfile.mkstemp(prefix=f"{self.dataset.name}-", suffix=".nc", dir=self.spool_dir)
+            os.close(fd)
+            try:
+                subset = self.data_cache.get_subset(self) if self.data_cache is not None else None
+                if subset is not None:
+                    with subset:
+                        subset.to_netcdf(path)
+                    self.nc_file = path
+                else:
+                    self.nc_file = self.stream_to_file(path, output_format="nc", progress=progress)
+            except Exception:
+                os.remove(path)
+                raise
+            if subset is None and self.data_cache is not None:
+                self.nc_file = self.data_cache.put(self, self.nc_file)
+                # Files larger than the cache are left in the spool directory
+                self.nc_file_cached = self.nc_file != path
+        return self.nc_file
+
+    def close(self):
+        """
+        Releases the downloaded data : in-memory NetCDF data and spooled file (files of the data cache are kept).
+        """
+        self.nc_data = None
+        if self.nc_file is not None:
+            if not self.nc_file_cached and os.path.exists(self.nc_file):
+                os.remove(self.nc_file)
+            self.nc_file = None
+            self.nc_file_cached = False
+    
+    def to_dask_xarray(self, chunks=None):
+        """
+        Returns the query result in a dask-backed xarray Dataset : values are only fetched when they are computed,
+        so that selecting a depth level or a month of a griddap dataset only downloads that slab.
+        
+        Griddap data which is not downloaded yet is opened through the OPeNDAP endpoint of the dataset on the
+        Erddap server, restricted to the query constraints, depth range & strides. Data already downloaded, in the data cache,
+        or from a tabledap dataset is opened from disk.
+        
+        Keyword arguments:
+        chunks -- dict of dimension name -> chunk size ; by default, one chunk per value of each dimension
+                  but the last two (latitude & longitude of griddap datasets, e.g. one chunk per time & depth)
+        """
+        if not module_available("dask"):
+            raise ImportError("Lazy datasets require dask, install it with : pip install dask")
+        path = self.nc_file
+        if path is None and self.data_cache is not None:
+            path = self.data_cache.get(self)
+        if path is None and self.dataset.protocol != "griddap":
+            path = self.get_nc_file()
+
+        if path is not None:
+            ds = xr.open_dataset(path)
+        else:
+            variables = [variable for variable in self.query_variables if variable not in self.dataset.depth_variables]
+            ds = xr.open_dataset(self.dataset.data_url)[variables]
+            time_start, time_end = self.griddap_time_range()
+            ds = ds.sel(time=coordinate_slice(ds["time"].values, to_datetime64(time_start), to_datetime64(time_end)),
+                        latitude=coordinate_slice(ds["latitude"].values, self.query_min_lat, self.query_max_lat),
+                        longitude=coordinate_slice(ds["longitude"].values, self.query_min_lon, self.query_max_lon))
+            # Same subset as the query URL : depth levels within the depth range, then the strides of each dimension
+            strides = {dim: self.strides[dim] for dim in ("time", "latitude", "longitude")}
+            depth_dims = [dim for dim in ds[variables[0]].dims if dim not in strides] if len(variables) > 0 else []
+            depth_start, depth_end = self.griddap_depth_range()
+            if len(depth_dims) > 0:
+                depth = depth_dims[0]
+                strides[depth] = self.strides["depth"]
+                if depth_start is not None:
+                    # WMS elevations are positive depths, the dimension may hold altitudes
+                    levels = np.abs(ds[depth].values)
+                    positions = np.flatnonzero((levels >= min(depth_start, depth_end)) & (levels <= max(depth_start, depth_end)))
+                    if len(positions) > 0:
+                        ds = ds.isel({depth: slice(positions[0], positions[-1] + 1)})
+            ds = ds.isel({dim: slice(None, None, stride) for dim, stride in strides.items() if stride != 1})
+
+        default_chunks = {}
+        if self.dataset.protocol == "griddap" and len(ds.data_vars) > 0:
+            default_chunks = {dim: 1 for dim in ds[list(ds.data_vars)[0]].dims[:-2]}
+        default_chunks.update(chunks or {})
+        return ds.chunk(default_chunks)
+
+    def iter_arrow_batches(self, variables=None, dropna=True, batch_rows=ARROW_BATCH_ROWS):
+        """
+        Streams the NetCDF query result to disk (see get_nc_file()) and yields it as Arrow record batches,
+        built from the xarray arrays without any intermediate pandas DataFrame.
+        Gridded data is flattened to one row per grid point, with a column for each dimension coordinate.
+        
+        Keyword arguments:
+        variables -- only keep these variables, and the variables not linked to any EOV (coordinates, depth, platform...) ;
+                     all the variables if None
+        dropna -- drop the rows where all the kept variables are NaN (e.g. land points of climatologies)
+        batch_rows -- approximate number of values read at once ; batches are cut along the first dimension
+        """
+        if not module_available("pyarrow"):
+            raise ImportError("Arrow output requires pyarrow, install it with : pip install pyarrow")
+        eov_variables = {variable for found in self.dataset.found_eovs.values() for variable in found}
+        with xr.open_dataset(self.get_nc_file()) as ds:
+            data_vars = [variable for variable in ds.data_vars
+                         if variables is None or variable in variables or variable not in eov_variables]
+            if len(data_vars) == 0:
+                return
+            dims = ds[data_vars[0]].dims
+            data_vars = [variable for variable in data_vars if ds[variable].dims == dims]
+            mask_vars = [variable for variable in data_vars if variables is None or variable in variables]
+            coordinates = [dim for dim in dims if dim in ds.coords]
+            step = max(1, batch_rows // max(1, int(np.prod(ds[data_vars[0]].shape[1:]))))
+
+            for start in range(0, ds.sizes[dims[0]] if len(dims) > 0 else 1, step):
+                batch = ds.isel({dims[0]: slice(start, start + step)}) if len(dims) > 0 else ds
+                shape = batch[data_vars[0]].shape
+                values = {variable: batch[variable].values.ravel() for variable in data_vars}
+                rows = None
+                if dropna:
+                    present = np.zeros(int(np.prod(shape)), dtype=bool)
+                    for variable in mask_vars:
+                        present |= ~pd.isna(values[variable]) if values[variable].dtype.kind in "fcmMO" else True
+                    rows = np.flatnonzero(present)
+                    values = {variable: column[rows] for variable, column in values.items()}
+                    if len(rows) == 0:
+                        continue
+                positions = np.unravel_index(rows if rows is not None else np.arange(int(np.prod(shape))), shape)
+                columns = {dim: batch[dim].values[positions[dims.index(dim)]] for dim in coordinates}
+                columns.update(values)
+                yield pa.RecordBatch.from_arrays([pa.array(column) for column in columns.values()], names=list(columns))
+
+    def to_arrow(self, variables=None, dropna=True):
+        """
+        Returns the query result in an Arrow table (see iter_arrow_batches()).
+        """
+        batches = list(self.iter_arrow_batches(variables, dropna))
+        if len(batches) == 0:
+            return pa.table({})
+        return pa.Table.from_batches(batches)
+
+    def to_pandas_dataframe(self, streaming=False):
+        return self.to_xarray(streaming=streaming).to_dataframe()
     
-    def to_xarray(self):
-        return xr.open_dataset(self.get_nc_data())
+    def to_xarray(self, streaming=False, **kwargs):
+        """
+        Returns the query result in an xarray Dataset.
+        
+        Keyword arguments:
+        streaming -- if True, the data is streamed to a file of the spool directory (see get_nc_file()) which is opened lazily :
+                     variables are only read from disk when accessed. Otherwise the data is downloaded & kept in memory.
+        Other keyword arguments are passed to xarray.open_dataset().
+        """
+        if streaming:
+            return xr.open_dataset(self.get_nc_file(), **kwargs)
+        return xr.open_dataset(self.get_nc_data(), **kwargs)
+
+    def iter_csv_chunks(self, chunksize=100000, **kwargs):
+        """
+        Streams the query result in CSV and yields it as DataFrames of at most `chunksize` rows,
+        for row-oriented consumers that do not need the whole result at once.
+        Other keyword arguments are passed to pandas.read_csv().
+        
+        Raises requests.HTTPError if the server answers with an error.
+        """
+        resp = self.dataset.transport.get(self.build_url(output_format="csv"), stream=True)
+        try:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            # The second line of Erddap CSV files holds the units
+            kwargs.setdefault("skiprows", [1])
+            with pd.read_csv(resp.raw, chunksize=chunksize, **kwargs) as reader:
+                for chunk in reader:
+                    yield chunk
+        finally:
+            resp.close()
     
-    def download(self, output_format, filename=""):
+    def download(self, output_format, filename="", progress=None):
         if filename == "":
             filename = f'{self.dataset.name}-{str(int(time.time()))}'
-        with open(f"{filename}.{output_format}", 'wb') as out:
-            resp = requests.get(self.build_url(output_format=output_format))
-            out.write(resp.content)
+        self.stream_to_file(f"{filename}.{output_format}", output_format=output_format, progress=progress)
         return True
 
 
+class SplitRequest:
+    """
+    An ErddapRequest split into sub-requests (see MarineBroker.split_request()), downloaded concurrently
+    to files of the spool directory and merged into one xarray Dataset / DataFrame.
+    
+    Downloads are resumable : fetch() only downloads the sub-requests which are not done yet,
+    so it can be called again after failures.
+    """
+
+    def __init__(self, request, sub_requests):
+        self.request = request
+        self.sub_requests = sub_requests
+        # Index of the sub-requests done -> spooled file path, or None if the sub-request has no data
+        self.results = {}
+
+    def __repr__(self):
+        return f"SplitRequest on {self.request.dataset.name} : {len(self.results)} / {len(self.sub_requests)} sub-requests done."
+
+    @property
+    def done(self):
+        return len(self.results) == len(self.sub_requests)
+
+    def fetch_sub_request(self, index, progress=None):
+        sub_request = self.sub_requests[index]
+        try:
+            self.results[index] = sub_request.get_nc_file(progress=progress)
+        except requests.HTTPError as e:
+            # Erddap answers 404 when a tabledap query has no matching results
+            if e.response is None or e.response.status_code != 404:
+                raise
+            self.results[index] = None
+
+    def fetch(self, max_workers=4, progress=None):
+        """
+        Downloads the sub-requests not done yet, at most max_workers at the same time.
+        
+        Keyword arguments:
+        progress -- callable called with the number of sub-requests done and the number of sub-requests
+        
+        Returns the list of (sub-request, exception) of the failed downloads.
+        """
+        failures = []
+        pending = [index for index in range(len(self.sub_requests)) if index not in self.results]
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            futures = {executor.submit(self.fetch_sub_request, index): index for index in pending}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.warning(f"Sub-request {self.sub_requests[futures[future]].query_url} failed : {str(e)}")
+                    failures.append((self.sub_requests[futures[future]], e))
+                if progress is not None:
+                    progress(len(self.results), len(self.sub_requests))
+        return failures
+
+    def check_done(self):
+        if not self.done:
+            raise Exception(f"{len(self.sub_requests) - len(self.results)} sub-requests are not downloaded, call fetch() again.")
+
+    def to_xarray(self, **kwargs):
+        """
+        Merges the downloaded sub-requests into one xarray Dataset, opened lazily from the spooled files.
+        Other keyword arguments are passed to xarray.open_dataset().
+        """
+        self.check_done()
+        datasets = [xr.open_dataset(self.results[index], **kwargs)
+                    for index in range(len(self.sub_requests)) if self.results[index] is not None]
+        if len(datasets) == 0:
+            return xr.Dataset()
+        dim = "time" if self.request.dataset.protocol == "griddap" else "row"
+        return xr.concat(datasets, dim=dim, data_vars="minimal", coords="minimal", compat="override")
+
+    def to_pandas_dataframe(self):
+        """
+        Merges the downloaded sub-requests into one DataFrame.
+        """
+        self.check_done()
+        dfs = []
+        for index in range(len(self.sub_requests)):
+            if self.results[index] is not None:
+                with xr.open_dataset(self.results[index]) as ds:
+                    dfs.append(ds.to_dataframe())
+        if len(dfs) == 0:
+            return pd.DataFrame()
+        df = pd.concat(dfs)
+        return df.reset_index(drop=True) if self.request.dataset.protocol == "tabledap" else df
+
+    def close(self):
+        """
+        Removes the spooled files of the sub-requests.
+        """
+        for sub_request in self.sub_requests:
+            sub_request.close()
+        self.results = {}
+
+
 class BrokerResponse():
     
     def     __init__(self, eovs=None):
         self.eovs = eovs
-        self.queries = None
+        # One dict per request added, the queries DataFrame is built from them when it is first accessed
+        self.records = []
+        self._queries = None
         self.sparql_results = None
+        # Requests dropped because they exceeded the size budget of the query
+        self.dropped = []
+        # Requests whose download failed (see download_results()), the error is set in their dropped_reason attribute
+        self.failed = []
         
     def __repr__(self):
-        return f"BrokerResponse object with {len(self.queries)} results."
+        return f"BrokerResponse object with {len(self.records)} results."
+
+    @property
+    def queries(self):
+        """
+        DataFrame of the requests of the response indexed by dataset ID (see add_query()), or None if there is none.
+        """
+        if self._queries is None and len(self.records) > 0:
+            self._queries = pd.DataFrame(self.records,
+                                         index=[record["query_object"].dataset.name for record in self.records])
+        return self._queries
         
     def add_query(self, query):
         """
-        Add a query to the response. The query is a Pandas DataFrame.
+        Add a query to the response. Each query is a row of the queries DataFrame.
         It contains :
         - the query URL
         - the dataset global metadata
         - found variables in the dataset matching the EOVS
         - the ErddapRequest object containing the ErddapDataset object and the data access helpers
         """
-        
-        # Get the dataset url:
-        query_line = pd.DataFrame(
-            data={"query_url": [query.query_url]},
-            index=[query.dataset.name]
-        )
-        # Add dataset global metadata to the dataframe
-        dataset_global_attributes = query.dataset.metadata[
-            query.dataset.metadata["Variable Name"] == "NC_GLOBAL"][
-            ["Attribute Name", "Value"]
-        ]
-        for index, row in dataset_global_attributes.iterrows():
-            query_line[row["Attribute Name"]] = row["Value"]
+        logger.debug(f"Adding dataset {query.dataset.name} to the response.")
+        # Get the dataset url & add dataset global metadata:
+        record = {"query_url": query.query_url}
+        record.update(query.dataset.global_attributes)
         
         # Add the ErddapRequest object:
-        query_line["query_object"] = query
+        record["query_object"] = query
         
         # Add the EOVS columns with the variables found if any :
         for eov in EOV_LIST:
-            if eov in query.dataset.found_eovs.keys():
-                logger.debug(f"Will add variables found {query.dataset.found_eovs[eov]} in response for dataset {query.dataset.name}")
-                query_line[eov] = ", ".join(query.dataset.found_eovs[eov])
-            else:
-                query_line[eov] = ""
+            record[eov] = ", ".join(query.dataset.found_eovs.get(eov, []))
         
-        if not isinstance(self.queries, pd.DataFrame):
-            logger.debug(f"Creating DataFrame with dataset {query.dataset.name}")
-            self.queries = query_line
-        else:
-            logger.debug(f"Adding dataset {query.dataset.name} to existing dataframe.")
-            self.queries = pd.concat([self.queries, query_line])
+        self.records.append(record)
+        self._queries = None
 
     def add_sparql_result(self, result):
         if not isinstance(self.sparql_results, pd.DataFrame):
@@ -713,7 +2222,7 @@ class BrokerResponse():
         '''
         return self.queries.index.tolist()
     
-    def dataset_to_xarray(self, dataset_id, rename_vars=True, eov=""):
+    def dataset_to_xarray(self, dataset_id, rename_vars=True, eov="", streaming=False, lazy=False, chunks=None):
         """
         Get a dataset by its ID & retrieve the result of the query in an xarray dataset.
         The resulting dataset will contain all the variables linked with the EOV(s) queried to the broker.
@@ -725,6 +2234,9 @@ class BrokerResponse():
         Optional args:
         - rename_vars (bool): rename original variables in the dataset by their P01 parameter; if False, keep the original names
         - eov (str): only retrieve one specific EOV in the xarray dataset.
+        - streaming (bool): stream the data to disk and open it lazily instead of loading it in memory (see ErddapRequest.to_xarray())
+        - lazy (bool): return a dask-backed dataset whose chunks are fetched on demand (see ErddapRequest.to_dask_xarray())
+        - chunks (dict): chunk sizes of the lazy dataset
         """
         if not dataset_id in self.queries.index:
             raise Exception(f"Dataset id {dataset_id} was not found in queries.")
@@ -733,14 +2245,20 @@ class BrokerResponse():
                 if eov not in EOV_LIST:
                     raise Exception(f"EOV {eov} not in allowed EOV list : {EOV_LIST}")
                 eov_varname = self.queries.loc[dataset_id].query_object.dataset.found_eovs[eov]
-                ds = self.queries.loc[dataset_id].query_object.to_xarray()[eov_varname]
+                ds = self.dataset_request_to_xarray(dataset_id, streaming, lazy, chunks)[eov_varname]
             else:
-                ds = self.queries.loc[dataset_id].query_object.to_xarray()
+                ds = self.dataset_request_to_xarray(dataset_id, streaming, lazy, chunks)
             # Todo : code rename_vars
             # if rename_vars:
             #     varname = 
         return ds
             
+    def dataset_request_to_xarray(self, dataset_id, streaming=False, lazy=False, chunks=None):
+        request = self.queries.loc[dataset_id].query_object
+        if lazy:
+            return request.to_dask_xarray(chunks)
+        return request.to_xarray(streaming=streaming)
+
     def dataset_to_pandas_dataframe(self, dataset_id, eov=""):
         if not dataset_id in self.queries.index:
             raise Exception(f"Dataset id {dataset_id} was not found in queries.")
@@ -761,11 +2279,172 @@ class BrokerResponse():
         else:
             return self.queries.loc[dataset_id].query_object.download(output_format)
 
-    def compile_results(self):
-        dfs = []
-        for index in list(dict.fromkeys(self.queries.index.tolist())):
-            for dataset in self.queries.loc[index].query_object:
-                data = dataset.get_nc_data()
-                if not str(data.getvalue()).startswith("b'Error"):
-                    dfs.append(xr.open_dataset(data).to_dataframe())
-        return pd.concat(dfs)
\ No newline at end of file
+    def estimates(self) -> "pd.DataFrame":
+        """
+        Returns the estimated rows & bytes of each request (see MarineBroker.estimate_request()),
+        indexed by dataset ID ; None when the size could not be estimated.
+        """
+        requests_list = self.get_requests() if self.queries is not None else []
+        return pd.DataFrame({"query_url": [request.query_url for request in requests_list],
+                             "estimated_rows": [request.estimated_rows for request in requests_list],
+                             "estimated_bytes": [request.estimated_bytes for request in requests_list]},
+                            index=[request.dataset.name for request in requests_list])
+
+    def get_requests(self) -> list:
+        """
+        Returns the ErddapRequest objects of the response, grouped by dataset ID.
+        """
+        groups = {}
+        for record in self.records:
+            groups.setdefault(record["query_object"].dataset.name, []).append(record["query_object"])
+        return [request for requests_list in groups.values() for request in requests_list]
+
+    @staticmethod
+    def harmonise_columns(df, request) -> "pd.DataFrame":
+        """
+        Renames the columns of the variables matching an EOV with the EOV name (or EOV_variable when
+        several variables of the dataset match the EOV), and adds the dataset_id column.
+        """
+        columns = {}
+        for eov, variables in request.dataset.found_eovs.items():
+            for variable in variables:
+                columns[variable] = eov if len(variables) == 1 else f"{eov}_{variable}"
+        df = df.rename(columns=columns)
+        df["dataset_id"] = request.dataset.name
+        return df
+
+    def download_results(self, max_workers=4, requests_list=None):
+        """
+        Downloads the NetCDF data of the requests to the spool directory (see ErddapRequest.get_nc_file()),
+        at most max_workers at the same time. Requests failing with an HTTP or connection error (e.g. no matching results,
+        timeout) are skipped and listed in the failed attribute.
+        
+        Yields (ErddapRequest, file path) tuples as the downloads complete ; at most max_workers downloaded files
+        are waiting to be consumed, so that the disk & memory used stay bounded.
+        """
+        pending = list(self.get_requests() if requests_list is None else requests_list)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            futures = {}
+            while pending or futures:
+                while pending and len(futures) < max_workers:
+                    request = pending.pop(0)
+                    futures[executor.submit(request.get_nc_file)] = request
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    request = futures.pop(future)
+                    try:
+                        path = future.result()
+                    except requests.RequestException as e:
+                        logger.warning(f"No data for {request.dataset.name} : {str(e)}")
+                        request.dropped_reason = f"Download failed : {str(e)}"
+                        self.failed.append(request)
+                        continue
+                    yield request, path
+
+    def iter_results(self, max_workers=4, harmonise=False):
+        """
+        Downloads the data of all the requests concurrently and yields it as one DataFrame per request,
+        in completion order. Each spooled file is removed once converted.
+        
+        Keyword arguments:
+        max_workers -- number of concurrent downloads
+        harmonise -- rename the variables with their EOV & add a dataset_id column (see harmonise_columns())
+        """
+        for request, path in self.download_results(max_workers):
+            with xr.open_dataset(path) as ds:
+                df = ds.to_dataframe()
+            request.close()
+            yield self.harmonise_columns(df, request) if harmonise else df
+
+    def compile_results(self, max_workers=4, harmonise=False, output=None):
+        """
+        Downloads the data of all the requests concurrently and concatenates it.
+        
+        Keyword arguments:
+        max_workers -- number of concurrent downloads
+        harmonise -- rename the variables with their EOV & add a dataset_id column (see harmonise_columns())
+        output -- path of a Parquet file : the results are written to it one request at a time instead of
+                  being concatenated in memory (requires pyarrow)
+        
+        Returns the concatenated DataFrame, or the output path.
+        """
+        if output is not None:
+            return self.write_parquet(output, max_workers, harmonise)
+        dfs = list(self.iter_results(max_workers, harmonise))
+        return pd.concat(dfs) if len(dfs) > 0 else pd.DataFrame()
+
+    def to_parquet(self, path, max_workers=4, dropna=True, compression="zstd"):
+        """
+        Writes the data of all the requests to a Parquet dataset partitioned by dataset & EOV :
+        path/dataset_id=<dataset ID>/eov=<EOV>/part-<n>.parquet, readable by Spark, DuckDB, pyarrow.dataset...
+        Each EOV partition holds the variables of the EOV and the variables not linked to any EOV (coordinates, depth...).
+        
+        Requests are downloaded concurrently to the spool directory and written one record batch at a time
+        (see ErddapRequest.iter_arrow_batches()), without any pandas DataFrame.
+        
+        Returns the list of the files written.
+        """
+        if not module_available("pyarrow"):
+            raise ImportError("Parquet output requires pyarrow, install it with : pip install pyarrow")
+        files = []
+        parts = {}
+        for request, _ in self.download_results(max_workers):
+            part = parts[request.dataset.name] = parts.get(request.dataset.name, -1) + 1
+            for eov, variables in request.dataset.found_eovs.items():
+                if self.eovs is not None and eov not in self.eovs:
+                    continue
+                directory = os.path.join(path, f"dataset_id={request.dataset.name}", f"eov={eov}")
+                writer = None
+                try:
+                    for batch in request.iter_arrow_batches(variables, dropna):
+                        if writer is None:
+                            os.makedirs(directory, exist_ok=True)
+                            files.append(os.path.join(directory, f"part-{part}.parquet"))
+                            writer = pq.ParquetWriter(files[-1], batch.schema, compression=compression)
+                        writer.write_batch(batch)
+                finally:
+                    # Close the file (and write its footer) even if reading a batch fails
+                    if writer is not None:
+                        writer.close()
+            request.close()
+        return files
+
+    def write_parquet(self, output, max_workers=4, harmonise=False):
+        """
+        Writes the data of all the requests to a single Parquet file, one request at a time.
+        Each download is converted to a Parquet part file as soon as it completes, and released ;
+        the parts are then copied one row group at a time to the output file, with the schema unifying their columns.
+        """
+        if not module_available("pyarrow"):
+            raise ImportError("Parquet output requires pyarrow, install it with : pip install pyarrow")
+
+        parts_dir = tempfile.mkdtemp(prefix="parts-", dir=os.path.dirname(os.path.abspath(output)))
+        try:
+            parts = []
+            for request, path in self.download_results(max_workers):
+                with xr.open_dataset(path) as ds:
+                    df = ds.to_dataframe()
+                request.close()
+                df = df.reset_index(drop=list(df.index.names) == ["row"])
+                if harmonise:
+                    df = self.harmonise_columns(df, request)
+                parts.append(os.path.join(parts_dir, f"part-{len(parts)}.parquet"))
+                pq.write_table(pa.Table.from_pandas(df, preserve_index=False), parts[-1])
+                del df
+            if len(parts) == 0:
+                return None
+            schema = pa.unify_schemas([pq.read_schema(part) for part in parts], promote_options="permissive")
+
+            with pq.ParquetWriter(output, schema) as writer:
+                for part in parts:
+                    part_file = pq.ParquetFile(part)
+                    for row_group in range(part_file.num_row_groups):
+                        table = part_file.read_row_group(row_group)
+                        columns = [table.column(field.name).cast(field.type) if field.name in table.column_names
+                                   else pa.nulls(len(table), field.type)
+                                   for field in schema]
+                        writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+                    os.remove(part)
+        finally:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+        return output
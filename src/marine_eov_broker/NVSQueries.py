@@ -1,21 +1,45 @@
-from pykg2tbl import DefaultSparqlBuilder
+import functools
+import os
 
-DEFAULT_TEMPLATE_FOLDER = "src/marine_eov_broker/j2_templates"
+from marine_eov_broker.LazyImport import LazyModule
 
-j2sqb = DefaultSparqlBuilder(DEFAULT_TEMPLATE_FOLDER)
+pykg2tbl = LazyModule("pykg2tbl")
+
+# The templates are shipped with the package, they are found whatever the current directory is.
+DEFAULT_TEMPLATE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "j2_templates")
 
 
 EOV_LIST = [
     "EV_SEATEMP",
     "EV_SALIN",
     "EV_OXY",
-    # "EV_CURR",
-    # "EV_CHLA",
-    # "EV_CO2",
-    # "EV_NUTS",
+    "EV_CURR",
+    "EV_CHLA",
+    "EV_CO2",
+    "EV_NUTS",
 ]
 
 
-DEFAULT_QUERY_STRINGS = {
-    key: j2sqb.build_syntax("eov_query.sparql", **{"eov": key}) for key in EOV_LIST
-}
+@functools.lru_cache(maxsize=None)
+def sparql_builder():
+    """
+    Returns the SPARQL builder of the package templates, created on first use.
+    """
+    return pykg2tbl.DefaultSparqlBuilder(DEFAULT_TEMPLATE_FOLDER)
+
+
+@functools.lru_cache(maxsize=None)
+def default_query_strings() -> dict:
+    """
+    Returns the eov_query.sparql query of each EOV, rendered on first use.
+    """
+    return {key: sparql_builder().build_syntax("eov_query.sparql", **{"eov": key}) for key in EOV_LIST}
+
+
+def __getattr__(name):
+    # j2sqb & DEFAULT_QUERY_STRINGS used to be built at import, they are still available as module attributes.
+    if name == "j2sqb":
+        return sparql_builder()
+    if name == "DEFAULT_QUERY_STRINGS":
+        return default_query_strings()
+    raise AttributeError(f"module {__name__} has no attribute {name}")
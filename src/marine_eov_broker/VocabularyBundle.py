@@ -0,0 +1,151 @@
+import datetime
+import json
+import logging
+
+from marine_eov_broker.LazyImport import LazyModule
+
+# rdflib & pykg2tbl are only imported when a Turtle bundle is written or read, see LazyModule
+rdflib = LazyModule("rdflib")
+pykg2tbl = LazyModule("pykg2tbl")
+
+logger = logging.getLogger(__name__)
+
+# Version of the bundle format, increased when the structure of the rows changes.
+BUNDLE_VERSION = 1
+BUNDLE_FORMAT = "marine-eov-broker-vocabularies"
+# Columns of the NVS rows returned by the eov_query.sparql / eov_batch_query.sparql templates
+ROW_KEYS = ["p01_mem", "P01not", "p01lbl", "R03not", "P09not", "P02not"]
+
+MEB = "urn:marine-eov-broker:vocabularies#"
+BUNDLE_NODE = "urn:marine-eov-broker:vocabularies"
+
+TTL_ROWS_QUERY = f"""
+PREFIX meb: <{MEB}>
+SELECT ?row ?eov {" ".join("?" + key for key in ROW_KEYS)}
+WHERE {{
+  ?row a meb:Mapping ;
+       meb:eov ?eov .
+  {" ".join("OPTIONAL {{ ?row meb:{0} ?{0} . }}".format(key) for key in ROW_KEYS)}
+}}
+"""
+TTL_EOVS_QUERY = f"""
+PREFIX meb: <{MEB}>
+SELECT ?eov
+WHERE {{ <{BUNDLE_NODE}> meb:eov ?eov . }}
+"""
+TTL_HEADER_QUERY = f"""
+PREFIX meb: <{MEB}>
+SELECT ?format ?version ?created ?source
+WHERE {{
+  <{BUNDLE_NODE}> meb:format ?format ;
+                  meb:version ?version .
+  OPTIONAL {{ <{BUNDLE_NODE}> meb:created ?created . }}
+  OPTIONAL {{ <{BUNDLE_NODE}> meb:source ?source . }}
+}}
+"""
+
+
+class VocabularyBundle:
+    """
+    Local snapshot of the EOV -> P01/P02/P09/R03 mapping returned by the NVS vocabulary server,
+    so that a broker can be started without querying NVS (e.g. offline, or in tests).
+
+    A bundle is saved either as JSON or as a Turtle file (according to the file extension) ;
+    the Turtle file is read back through pykg2tbl's KGSource, like the NVS endpoint.
+    """
+
+    def __init__(self, vocabularies, source=None, created=None, version=BUNDLE_VERSION):
+        """
+        Arguments:
+        vocabularies: dict of the NVS rows of each EOV (see MarineBroker.vocabularies)
+        source: (str) vocabulary server the rows were gathered from
+        created: (str) ISO date of the snapshot, now if None
+        version: bundle format version
+        """
+        if version != BUNDLE_VERSION:
+            raise Exception(f"Unsupported vocabulary bundle version {version}, expected {BUNDLE_VERSION}")
+        self.vocabularies = {eov: [{key: row[key] for key in ROW_KEYS if row.get(key) is not None} for row in rows]
+                             for eov, rows in vocabularies.items()}
+        self.source = source
+        self.created = created if created is not None else datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.version = version
+
+    def __repr__(self):
+        return f"VocabularyBundle(v{self.version}, {self.created}, {', '.join(self.vocabularies)})"
+
+    def save(self, path):
+        """
+        Writes the bundle to path, as Turtle if path ends with .ttl, as JSON otherwise.
+        """
+        if str(path).endswith(".ttl"):
+            self.to_graph().serialize(destination=str(path), format="turtle")
+        else:
+            with open(path, "w") as f:
+                json.dump(self.to_record(), f, indent=1)
+        logger.info(f"Saved vocabularies of {len(self.vocabularies)} EOVs to {path}")
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a bundle written by save().
+        """
+        if str(path).endswith(".ttl"):
+            return cls.from_kgsource(pykg2tbl.KGSource.build(str(path)))
+        with open(path) as f:
+            return cls.from_record(json.load(f))
+
+    def to_record(self) -> dict:
+        return {
+            "format": BUNDLE_FORMAT,
+            "version": self.version,
+            "created": self.created,
+            "source": self.source,
+            "eovs": self.vocabularies,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        if record.get("format") != BUNDLE_FORMAT:
+            raise Exception(f"Not a vocabulary bundle : format {record.get('format')}")
+        return cls(record["eovs"], record.get("source"), record.get("created"), record.get("version"))
+
+    def to_graph(self) -> "rdflib.Graph":
+        """
+        Builds an RDF graph of the bundle : a meb:Mapping node for each row, carrying its EOV & the row values.
+        """
+        meb = rdflib.Namespace(MEB)
+        bundle_node = rdflib.URIRef(BUNDLE_NODE)
+        Literal = rdflib.Literal
+        graph = rdflib.Graph()
+        graph.bind("meb", meb)
+        graph.add((bundle_node, meb["format"], Literal(BUNDLE_FORMAT)))
+        graph.add((bundle_node, meb["version"], Literal(self.version, datatype=rdflib.XSD.integer)))
+        graph.add((bundle_node, meb["created"], Literal(self.created)))
+        if self.source is not None:
+            graph.add((bundle_node, meb["source"], Literal(self.source)))
+        for eov, rows in self.vocabularies.items():
+            # EOVs are also listed on the bundle node, as an EOV may have no rows
+            graph.add((bundle_node, meb["eov"], Literal(eov)))
+            for row in rows:
+                node = rdflib.BNode()
+                graph.add((node, rdflib.RDF.type, meb["Mapping"]))
+                graph.add((node, meb["eov"], Literal(eov)))
+                for key, value in row.items():
+                    graph.add((node, meb[key], Literal(value)))
+        return graph
+
+    @classmethod
+    def from_kgsource(cls, kgsource):
+        """
+        Reads a bundle from a KGSource built on its Turtle file.
+        """
+        # Unbound variables are returned as the "None" string by the pykg2tbl graph sources.
+        headers = kgsource.query(TTL_HEADER_QUERY).to_list()
+        if len(headers) == 0 or headers[0]["format"] != BUNDLE_FORMAT:
+            raise Exception("Not a vocabulary bundle : missing bundle format")
+        header = {key: None if value == "None" else value for key, value in headers[0].items()}
+        vocabularies = {row["eov"]: [] for row in kgsource.query(TTL_EOVS_QUERY).to_list()}
+        for row in kgsource.query(TTL_ROWS_QUERY).to_list():
+            vocabularies.setdefault(row["eov"], []).append(
+                {key: row[key] for key in ROW_KEYS if row.get(key) not in (None, "None")})
+        return cls(vocabularies, header["source"], header["created"], int(header["version"]))
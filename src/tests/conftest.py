@@ -0,0 +1,85 @@
+import hashlib
+
+import requests
+
+from marine_eov_broker.HttpTransport import HttpTransport
+
+# Erddap tables & stub transports shared by the test modules
+SERVER = "https://www.ifremer.fr/erddap"
+
+
+def table_metadata(title="Argo floats"):
+    """
+    Returns the info/index.csv table of a tabledap dataset with temperature & pressure variables.
+    """
+    return f"""Row Type,Variable Name,Attribute Name,Data Type,Value
+attribute,NC_GLOBAL,cdm_data_type,String,TrajectoryProfile
+attribute,NC_GLOBAL,title,String,{title}
+attribute,NC_GLOBAL,time_coverage_start,String,2000-01-01T00:00:00Z
+attribute,NC_GLOBAL,time_coverage_end,String,2023-01-01T00:00:00Z
+attribute,NC_GLOBAL,geospatial_lon_min,double,-60.0
+attribute,NC_GLOBAL,geospatial_lon_max,double,10.0
+attribute,NC_GLOBAL,geospatial_lat_min,double,20.0
+attribute,NC_GLOBAL,geospatial_lat_max,double,70.0
+variable,temp,,float,
+attribute,temp,sdn_parameter_urn,String,SDN:P01::TEMPPR01
+attribute,temp,units,String,degree_Celsius
+variable,pres,,float,
+attribute,pres,sdn_parameter_urn,String,SDN:P01::PRESPR01
+"""
+
+
+TABLE_METADATA = table_metadata()
+GRID_METADATA = """Row Type,Variable Name,Attribute Name,Data Type,Value
+attribute,NC_GLOBAL,cdm_data_type,String,Grid
+attribute,NC_GLOBAL,time_coverage_start,String,1960-01-16T00:00:00Z
+dimension,time,,double,"nValues=12, evenlySpaced=false, averageSpacing=30 days"
+dimension,depth,,double,"nValues=4, evenlySpaced=false, averageSpacing=50.0"
+dimension,latitude,,double,"nValues=11, evenlySpaced=true, averageSpacing=1.0"
+dimension,longitude,,double,"nValues=11, evenlySpaced=true, averageSpacing=1.0"
+variable,TEMP,,float,"time, depth, latitude, longitude"
+attribute,TEMP,sdn_parameter_urn,String,SDN:P01::TEMPPR01
+"""
+GRID_TIMES = [f"1960-{month:02d}-16T00:00:00Z" for month in range(1, 13)]
+GRID_ATTRIBUTES = {"wms_time_values": GRID_TIMES, "wms_elevation_values": [0.0, 50.0, 100.0, 150.0],
+                   "bbox": [-10.0, 40.0, 0.0, 50.0]}
+ALL_DATASETS = """datasetID,dataStructure,cdm_data_type,minLongitude,maxLongitude,minLatitude,maxLatitude,minTime,maxTime
+,,,degrees_east,degrees_east,degrees_north,degrees_north,UTC,UTC
+allDatasets,table,Other,,,,,,
+ArgoFloats,table,TrajectoryProfile,-60.0,10.0,20.0,70.0,2000-01-01T00:00:00Z,2023-01-01T00:00:00Z
+Ongoing,table,TrajectoryProfile,40.0,100.0,-60.0,20.0,2010-01-01T00:00:00Z,
+"""
+VOCABULARIES = {"EV_SEATEMP": [{"P01not": "SDN:P01::TEMPPR01", "P02not": "SDN:P02::TEMP"}], "EV_OXY": []}
+
+
+class StubTransport:
+    """
+    HttpTransport answering from a dict of pages (url path after the server URL -> text, or function of the url
+    returning the text), with ETags : 304 is answered if the ETag is sent back, 404 for unknown paths.
+    """
+
+    def __init__(self, pages):
+        self.pages = dict(pages)
+        self.urls = []
+        self.headers = []
+
+    def get(self, url, stream=False, headers=None, **kwargs):
+        self.urls.append(url)
+        self.headers.append(dict(headers or {}))
+        text = self.pages.get(url[len(SERVER):].split("?")[0])
+        if callable(text):
+            text = text(url)
+        resp = requests.Response()
+        resp.url = url
+        resp.status_code = 404 if text is None else 200
+        resp._content = (text or "Not Found").encode()
+        resp.headers["ETag"] = hashlib.sha1(resp._content).hexdigest()
+        if (headers or {}).get("If-None-Match") == resp.headers["ETag"]:
+            resp.status_code, resp._content = 304, b""
+        return resp
+
+    def read_csv(self, url, **kwargs):
+        return HttpTransport.read_csv(self, url, **kwargs)
+
+    def requested(self, path):
+        return [url for url in self.urls if url[len(SERVER):].split("?")[0] == path]
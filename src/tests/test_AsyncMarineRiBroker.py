@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import threading
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import test_utils, web
+
+from conftest import ALL_DATASETS, SERVER, TABLE_METADATA, VOCABULARIES, StubTransport
+from marine_eov_broker.AsyncMarineRiBroker import AsyncHttpTransport, AsyncMarineBroker, AsyncResponse
+from marine_eov_broker.CatalogCache import CatalogCache
+from marine_eov_broker.ErddapMarineRI import ErddapDataset
+
+
+async def serve(handler, coroutine):
+    """
+    Runs coroutine(url) against a local aiohttp server answering every request with handler.
+    """
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handler)
+    server = test_utils.TestServer(app)
+    await server.start_server()
+    try:
+        return await coroutine(str(server.make_url("/data")))
+    finally:
+        await server.close()
+
+
+def test_transport_retries_transient_errors():
+    calls = []
+
+    async def handler(request):
+        calls.append(request.path)
+        return web.Response(status=503 if len(calls) < 3 else 200, text="done")
+
+    async def get(url):
+        transport = AsyncHttpTransport(retries=3, backoff_factor=0)
+        try:
+            return await transport.get(url)
+        finally:
+            await transport.close()
+
+    resp = asyncio.run(serve(handler, get))
+    assert resp.status_code == 200 and resp.content == b"done" and len(calls) == 3
+
+    calls.clear()
+
+    async def get_without_retries(url):
+        transport = AsyncHttpTransport(retries=1, backoff_factor=0)
+        try:
+            return await transport.get(url)
+        finally:
+            await transport.close()
+
+    resp = asyncio.run(serve(handler, get_without_retries))
+    assert resp.status_code == 503 and len(calls) == 2
+
+
+def test_transport_bounds_requests_in_flight():
+    in_flight = {"now": 0, "max": 0}
+
+    async def handler(request):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.02)
+        in_flight["now"] -= 1
+        return web.Response(text="ok")
+
+    async def get_all(url):
+        transport = AsyncHttpTransport(max_in_flight=3, max_per_host=8)
+        try:
+            return await asyncio.gather(*[transport.get(f"{url}?{i}") for i in range(12)])
+        finally:
+            await transport.close()
+
+    responses = asyncio.run(serve(handler, get_all))
+    assert [resp.status_code for resp in responses] == [200] * 12
+    assert in_flight["max"] == 3
+
+
+class StubAsyncTransport:
+    """
+    AsyncHttpTransport answering from the ALL_DATASETS & TABLE_METADATA tables of a StubTransport, with ETags.
+    """
+
+    def __init__(self):
+        self.stub = StubTransport({"/tabledap/allDatasets.csv": ALL_DATASETS,
+                                   "/info/ArgoFloats/index.csv": TABLE_METADATA,
+                                   "/info/Ongoing/index.csv": TABLE_METADATA,
+                                   "/tabledap/ArgoFloats.csv": self.tabledap})
+        self.urls = self.stub.urls
+
+    @staticmethod
+    def tabledap(url):
+        if "orderByCount" in url:
+            return "temp\ncount\n42\n"
+        return "time\nUTC\n2022-01-16T12:00:00Z\n"
+
+    async def get(self, url, headers=None):
+        resp = self.stub.get(url, headers=headers)
+        return AsyncResponse(url, resp.status_code, resp.headers, resp.content)
+
+    async def read_csv(self, url, **kwargs):
+        return await AsyncHttpTransport.read_csv(self, url, **kwargs)
+
+    async def close(self):
+        pass
+
+
+class NoSyncTransport:
+    def get(self, url, **kwargs):
+        raise AssertionError(f"Synchronous request on the event loop : {url}")
+
+
+def test_submit_request_with_stub_transport():
+    transport = StubAsyncTransport()
+
+    async def submit():
+        broker = AsyncMarineBroker({SERVER: None}, transport=NoSyncTransport(), async_transport=transport)
+        broker.vocabularies.update(VOCABULARIES)
+        await broker.load_async()
+        assert not any(dataset.metadata_loaded for dataset in broker.datasets)
+        response = await broker.submit_request(["EV_SEATEMP"], "2022-01-16", "2022-01-17", -40, 35, 2, 62, "nc",
+                                               max_rows=100)
+        await broker.close()
+        return broker, response
+
+    broker, response = asyncio.run(submit())
+    assert response.get_datasets_list() == ["ArgoFloats"]
+    assert response.estimates().estimated_rows.tolist() == [42]
+    # Only the metadata of the dataset within the query bounding box is downloaded
+    assert [url for url in transport.urls if url.endswith("/index.csv")] == [f"{SERVER}/info/ArgoFloats/index.csv"]
+    assert sum("/tabledap/allDatasets.csv" in url for url in transport.urls) == 1
+
+
+def test_stale_dataset_revalidated(tmp_path):
+    transport = StubAsyncTransport()
+    cached = ErddapDataset(SERVER, "ArgoFloats", metadata=TABLE_METADATA)
+    cached.validators = {"etag": hashlib.sha1(TABLE_METADATA.encode()).hexdigest()}
+    catalog_cache = CatalogCache(str(tmp_path), ttl=0)
+    catalog_cache.put_dataset(cached)
+
+    cache_threads = []
+
+    async def load():
+        broker = AsyncMarineBroker({SERVER: ["ArgoFloats"]}, cache_dir=str(tmp_path), cache_ttl=0,
+                                   transport=NoSyncTransport(), async_transport=transport, bulk_metadata=False)
+        get_dataset = broker.catalog_cache.get_dataset
+
+        def recording_get_dataset(*args):
+            cache_threads.append(threading.get_ident())
+            return get_dataset(*args)
+        broker.catalog_cache.get_dataset = recording_get_dataset
+        await broker.load_async()
+        return broker
+
+    broker = asyncio.run(load())
+    # The SQLite catalog cache is not read on the event loop thread
+    assert len(cache_threads) > 0 and threading.get_ident() not in cache_threads
+    assert [url for url in transport.urls if "/info/" in url] == [f"{SERVER}/info/ArgoFloats/index.csv"]
+    assert broker.datasets[0].validators["marker"] == "2000-01-01T00:00:00Z/2023-01-01T00:00:00Z"
+    assert broker.datasets[0].metadata_loaded and broker.datasets[0].parameters == {"SDN:P01::TEMPPR01": "temp", "SDN:P01::PRESPR01": "pres"}
+
+
+def test_vocabularies_query_posted():
+    received = {}
+
+    async def handler(request):
+        received.update(method=request.method, accept=request.headers.get("Accept"), form=dict(await request.post()))
+        return web.json_response({"results": {"bindings": [
+            {"eov_code": {"value": "EV_SEATEMP"}, "P01not": {"value": "SDN:P01::TEMPPR01"}}]}})
+
+    async def query(url):
+        broker = AsyncMarineBroker({}, transport=NoSyncTransport(), async_transport=AsyncHttpTransport(retries=0))
+        broker.vocabularies_server = url
+        try:
+            return await broker.query_all_vocabularies_async(["EV_SEATEMP"])
+        finally:
+            await broker.close()
+
+    vocabularies = asyncio.run(serve(handler, query))
+    assert vocabularies == {"EV_SEATEMP": [{"P01not": "SDN:P01::TEMPPR01"}]}
+    assert received["method"] == "POST" and received["accept"] == "application/sparql-results+json"
+    assert "EV_SEATEMP" in received["form"]["query"]
@@ -0,0 +1,149 @@
+import io
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+import xarray as xr
+
+from conftest import SERVER, table_metadata
+from marine_eov_broker.ErddapMarineRI import ErddapDataset
+from marine_eov_broker.MarineRiBroker import BrokerResponse
+
+
+def dataset(name):
+    erddap_dataset = ErddapDataset(SERVER, name, metadata=pd.read_csv(io.StringIO(table_metadata(title=name))))
+    erddap_dataset.found_eovs = {"EV_SEATEMP": ["temp"]}
+    return erddap_dataset
+
+
+def request(erddap_dataset, start):
+    return SimpleNamespace(dataset=erddap_dataset, query_url=f"{erddap_dataset.data_url}.nc?temp&time%3E={start}")
+
+
+class FileRequest:
+    """
+    ErddapRequest whose NetCDF result is written to a local file instead of being downloaded.
+    """
+
+    def __init__(self, erddap_dataset, path, data=None, error=None):
+        self.dataset = erddap_dataset
+        self.query_url = f"{erddap_dataset.data_url}.nc?temp"
+        self.path = str(path)
+        self.data = data
+        self.error = error
+        self.spooled = []
+
+    def get_nc_file(self):
+        if self.error is not None:
+            raise self.error
+        if self.data is None:
+            raise requests.HTTPError("404 Not Found : Your query produced no matching results.")
+        self.spooled.extend(path for path in os.listdir(os.path.dirname(self.path)) if path.endswith(".nc"))
+        self.data.to_netcdf(self.path)
+        return self.path
+
+    def close(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def table(temp, **variables):
+    return xr.Dataset({"time": ("row", pd.date_range("2022-01-01", periods=len(temp), freq="D")), "temp": ("row", temp),
+                       **{name: ("row", values) for name, values in variables.items()}})
+
+
+def file_response(tmp_path):
+    response = BrokerResponse(["EV_SEATEMP"])
+    response.add_query(FileRequest(dataset("ArgoFloats"), tmp_path / "argo.nc",
+                                   table(np.array([10.5, 11.5], dtype="f4"))))
+    response.add_query(FileRequest(dataset("Empty"), tmp_path / "empty.nc"))
+    response.add_query(FileRequest(dataset("Gliders"), tmp_path / "gliders.nc",
+                                   table(np.array([12.25]), psal=np.array([35.1]))))
+    return response
+
+
+def test_global_attributes():
+    erddap_dataset = dataset("ArgoFloats")
+    assert erddap_dataset.global_attributes["title"] == "ArgoFloats"
+    assert "units" not in erddap_dataset.global_attributes
+    assert erddap_dataset.get_global_attribute("summary", "none") == "none"
+
+
+def test_queries_built_from_records():
+    response = BrokerResponse(["EV_SEATEMP"])
+    assert response.queries is None
+    argo, other = dataset("ArgoFloats"), dataset("Other")
+    response.add_query(request(argo, "2022-01-01"))
+    response.add_query(request(other, "2022-01-01"))
+    response.add_query(request(argo, "2022-02-01"))
+    queries = response.queries
+    assert queries.index.tolist() == ["ArgoFloats", "Other", "ArgoFloats"]
+    assert queries.loc["Other"].title == "Other"
+    assert (queries.EV_SEATEMP == "temp").all() and (queries.EV_OXY == "").all()
+    assert response.queries is queries
+    assert [r.query_url[-10:] for r in response.get_requests()] == ["2022-01-01", "2022-02-01", "2022-01-01"]
+
+    response.add_query(request(dataset("Third"), "2022-01-01"))
+    assert len(response.queries) == 4
+
+
+def test_harmonise_columns():
+    erddap_dataset = dataset("ArgoFloats")
+    df = BrokerResponse.harmonise_columns(pd.DataFrame({"time": [0], "temp": [10.5]}), request(erddap_dataset, "2022"))
+    assert df.columns.tolist() == ["time", "EV_SEATEMP", "dataset_id"] and df.dataset_id.tolist() == ["ArgoFloats"]
+
+    erddap_dataset.found_eovs = {"EV_SEATEMP": ["temp", "temp_adjusted"]}
+    df = BrokerResponse.harmonise_columns(pd.DataFrame({"temp": [10.5], "temp_adjusted": [10.4]}),
+                                          request(erddap_dataset, "2022"))
+    assert df.columns.tolist() == ["EV_SEATEMP_temp", "EV_SEATEMP_temp_adjusted", "dataset_id"]
+
+
+def test_iter_results(tmp_path):
+    response = file_response(tmp_path)
+    results = {df.temp.iloc[0]: df for df in response.iter_results(max_workers=1)}
+    # Requests without results are skipped, spooled files are removed once converted
+    assert sorted(results) == [10.5, 12.25]
+    assert results[12.25].psal.tolist() == [35.1] and "psal" not in results[10.5]
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_downloads_recorded(tmp_path):
+    response = file_response(tmp_path)
+    response.add_query(FileRequest(dataset("Offline"), tmp_path / "offline.nc",
+                                   error=requests.ConnectionError("Connection refused")))
+    results = list(response.iter_results(max_workers=2))
+    # Connection errors do not interrupt the other downloads
+    assert len(results) == 2
+    assert sorted(request.dataset.name for request in response.failed) == ["Empty", "Offline"]
+    reasons = {request.dataset.name: request.dropped_reason for request in response.failed}
+    assert reasons["Offline"] == "Download failed : Connection refused"
+
+
+def test_compile_results(tmp_path):
+    df = file_response(tmp_path).compile_results(max_workers=2, harmonise=True)
+    assert sorted(df.EV_SEATEMP.tolist()) == [10.5, 11.5, 12.25]
+    assert sorted(df.dataset_id.unique()) == ["ArgoFloats", "Gliders"]
+    assert df.psal.notna().sum() == 1
+    assert file_response(tmp_path).compile_results(max_workers=2).shape == (3, 3)
+
+
+def test_compile_results_to_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    (tmp_path / "spool").mkdir()
+    response = file_response(tmp_path / "spool")
+    output = str(tmp_path / "results.parquet")
+    assert response.compile_results(max_workers=1, harmonise=True, output=output) == output
+    # Each download is released before the next one is spooled
+    assert all(request.spooled == [] for request in response.get_requests())
+    assert sorted(os.listdir(tmp_path)) == ["results.parquet", "spool"] and os.listdir(tmp_path / "spool") == []
+
+    df = pd.read_parquet(output).sort_values("EV_SEATEMP")
+    assert df.EV_SEATEMP.tolist() == [10.5, 11.5, 12.25] and df.EV_SEATEMP.dtype == "float64"
+    assert df.dataset_id.tolist() == ["ArgoFloats", "ArgoFloats", "Gliders"]
+    assert df.psal.isna().tolist() == [True, True, False]
+    assert str(df.time.iloc[2].date()) == "2022-01-01"
+
+    assert BrokerResponse(["EV_SEATEMP"]).compile_results(output=output) is None
@@ -0,0 +1,19 @@
+from marine_eov_broker.CatalogCache import CatalogCache
+
+
+def test_vocabulary_roundtrip(tmp_path):
+    cache = CatalogCache(str(tmp_path))
+    rows = [{"P01not": "SDN:P01::TEMPPR01", "P02not": "SDN:P02::TEMP"}]
+    cache.put_vocabulary("EV_SEATEMP", rows)
+
+    assert cache.get_vocabulary("EV_SEATEMP") == rows
+    assert CatalogCache(str(tmp_path)).get_vocabulary("EV_SEATEMP") == rows
+    assert cache.get_vocabulary("EV_OXY") is None
+
+
+def test_stale_entries(tmp_path):
+    cache = CatalogCache(str(tmp_path), ttl=0)
+    cache.put_server_datasets("https://www.ifremer.fr/erddap", ["ArgoFloats"])
+
+    assert cache.get_server_datasets("https://www.ifremer.fr/erddap") is None
+    assert cache.get_server_datasets("https://www.ifremer.fr/erddap", allow_stale=True) == ["ArgoFloats"]
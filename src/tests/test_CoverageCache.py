@@ -0,0 +1,29 @@
+from types import SimpleNamespace
+
+from marine_eov_broker.CoverageCache import CoverageCache
+
+dataset = SimpleNamespace(server="https://www.ifremer.fr/erddap", name="ArgoFloats")
+
+
+def test_exact_and_window_hits():
+    cache = CoverageCache()
+    cache.put(cache.key(dataset, "2022-01-16", "2022-01-17", -40, 35, 2, 62), True)
+    cache.put(cache.key(dataset, "1990-01-01", "1995-01-01", -40, 35, 2, 62), False)
+
+    assert cache.get(cache.key(dataset, "2022-01-16", "2022-01-17", -40, 35, 2, 62)) is True
+    # Larger window than a window with data
+    assert cache.get(cache.key(dataset, "2022-01-01", "2022-02-01", -50, 30, 10, 65)) is True
+    # Smaller window than a window without data
+    assert cache.get(cache.key(dataset, "1991-01-01", "1992-01-01", -20, 40, 0, 50)) is False
+    # Undecidable
+    assert cache.get(cache.key(dataset, "2022-01-16", "2022-01-17", -20, 40, 0, 50)) is None
+    assert cache.stats() == {"hits": 1, "window_hits": 2, "misses": 1, "size": 2}
+
+
+def test_lru_eviction():
+    cache = CoverageCache(maxsize=1)
+    cache.put(cache.key(dataset, "2022-01-16", "2022-01-17", -40, 35, 2, 62), True)
+    cache.put(cache.key(dataset, "2021-01-16", "2021-01-17", -40, 35, 2, 62), True)
+
+    assert len(cache) == 1
+    assert cache.get(cache.key(dataset, "2022-01-16", "2022-01-17", -40, 35, 2, 62)) is None
@@ -0,0 +1,53 @@
+import io
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from marine_eov_broker.CoverageGrid import CoverageGrid, month_index
+
+# 2022-01 values at 45.5N 15.5W, built in 2023-01
+grid = CoverageGrid([month_index(np.datetime64("2022-01-15"))], [45], [-16], [50], built_at=1672531200 + 86400 * 20)
+
+
+def test_count_and_covers():
+    assert grid.count("2022-01-01", "2022-02-01", -40, 35, 2, 62) == 50
+    assert grid.count("2021-01-01", "2021-12-01", -40, 35, 2, 62) == 0
+    assert grid.covers("2022-01-01", "2022-02-01", -40, 35, 2, 62) is True
+    assert grid.covers("2022-01-01", "2022-02-01", 100, 35, 120, 62) is False
+    # Data newer than the grid may exist
+    assert grid.covers("2023-01-01", "2023-02-01", 100, 35, 120, 62) is None
+
+
+def test_record_round_trip():
+    restored = CoverageGrid.from_record(grid.to_record())
+    assert len(restored) == 1
+    assert restored.built_at == grid.built_at
+    assert restored.count("2022-01-01", "2022-02-01", -40, 35, 2, 62) == 50
+
+
+class CountTransport:
+    """
+    Transport answering the orderByCount query of CoverageGrid.build() : temp is all-NaN in the second cell.
+    """
+
+    def __init__(self):
+        self.urls = []
+
+    def read_csv(self, url, **kwargs):
+        self.urls.append(url)
+        return pd.read_csv(io.StringIO("time,latitude,longitude,temp,psal\n"
+                                       "UTC,degrees_north,degrees_east,count,count\n"
+                                       "2022-01-01T00:00:00Z,45.0,-16.0,50,48\n"
+                                       "2022-03-01T00:00:00Z,45.0,-16.0,0,20\n"), **kwargs)
+
+
+def test_build_counts_every_parameter():
+    dataset = SimpleNamespace(name="ArgoFloats", data_url="https://erddap.example.org/erddap/tabledap/ArgoFloats",
+                              parameters={"SDN:P01::TEMPPR01": "temp", "SDN:P01::PSALPR01": "psal"},
+                              transport=CountTransport())
+    built = CoverageGrid.build(dataset)
+    assert "time%2Clatitude%2Clongitude%2Ctemp%2Cpsal&orderByCount" in dataset.transport.urls[0]
+    assert built.count("2022-01-01", "2022-02-01", -40, 35, 2, 62) == 50
+    # Only psal has data in 2022-03
+    assert built.covers("2022-03-01", "2022-03-31", -40, 35, 2, 62) is True
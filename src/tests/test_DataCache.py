@@ -0,0 +1,106 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from marine_eov_broker.DataCache import DataCache, canonical_url
+
+dataset = SimpleNamespace(server="https://www.ifremer.fr/erddap", name="ArgoFloats", protocol="tabledap",
+                          validators={"marker": "2000-01-01T00:00:00Z,2023-01-01T00:00:00Z"})
+
+
+def request(start, end, min_lon, min_lat, max_lon, max_lat, variables="time%2Clatitude%2Clongitude%2Ctemp"):
+    url = (f"{dataset.server}/tabledap/{dataset.name}.nc?{variables}"
+           f"&time%3E={start}&time%3C={end}&latitude%3E={min_lat}&latitude%3C={max_lat}"
+           f"&longitude%3E={min_lon}&longitude%3C={max_lon}")
+    return SimpleNamespace(dataset=dataset, query_variables=["temp"], query_specific_variable=None,
+                           query_start_date=start, query_end_date=end, query_url=url,
+                           query_min_lon=min_lon, query_min_lat=min_lat, query_max_lon=max_lon, query_max_lat=max_lat,
+                           build_url=lambda output_format="": url, is_subset=lambda: False)
+
+
+def data():
+    n = 48
+    return xr.Dataset({"time": ("row", pd.date_range("2022-01-01", periods=n, freq="h").values),
+                       "latitude": ("row", np.linspace(40, 50, n)),
+                       "longitude": ("row", np.linspace(-20, -10, n)),
+                       "temp": ("row", np.arange(n, dtype=float))})
+
+
+def test_canonical_url():
+    assert canonical_url("HTTPS://WWW.ifremer.fr/erddap/tabledap/A.nc?time%2Ctemp") == \
+        canonical_url("https://www.ifremer.fr/erddap/tabledap/A.nc?time,temp")
+
+
+def test_exact_and_subset_hits(tmp_path):
+    cache = DataCache(str(tmp_path))
+    full = request("2022-01-01", "2022-01-03", -40, 35, 2, 62)
+    cache.put_bytes(full, data().to_netcdf())
+
+    assert cache.get(full) is not None
+    subset = cache.get_subset(request("2022-01-01T00:00:00Z", "2022-01-01T11:00:00Z", -40, 35, 2, 62))
+    assert subset.sizes["row"] == 12
+    assert cache.get_subset(request("2021-12-01", "2022-01-03", -40, 35, 2, 62)) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["subset_hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_lru_eviction(tmp_path):
+    size = len(data().to_netcdf())
+    cache = DataCache(str(tmp_path), max_bytes=2 * size)
+    first = request("2022-01-01", "2022-01-03", -40, 35, 2, 62)
+    cache.put_bytes(first, data().to_netcdf())
+    cache.put_bytes(request("2022-01-01", "2022-01-02", -40, 35, 2, 62), data().to_netcdf())
+    cache.get(first)
+    cache.put_bytes(request("2022-01-01", "2022-01-04", -40, 35, 2, 62), data().to_netcdf())
+
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["evictions"] == 1
+    # The least recently used entry was evicted
+    assert cache.get(first) is not None
+    assert cache.get(request("2022-01-01", "2022-01-02", -40, 35, 2, 62)) is None
+
+
+def test_file_larger_than_cache(tmp_path):
+    size = len(data().to_netcdf())
+    cache = DataCache(str(tmp_path / "cache"), max_bytes=size + 10)
+    cached = request("2022-01-01", "2022-01-03", -40, 35, 2, 62)
+    cache.put_bytes(cached, data().to_netcdf())
+    # A file larger than the whole cache is not cached, and left where it was downloaded
+    large = xr.concat([data()] * 100, dim="row")
+    path = str(tmp_path / "large.nc")
+    with open(path, "wb") as out:
+        out.write(large.to_netcdf())
+    assert cache.put(request("2022-01-01", "2022-01-04", -40, 35, 2, 62), path) == path
+    assert os.path.exists(path)
+    assert cache.stats()["entries"] == 1 and cache.stats()["evictions"] == 0
+    assert cache.get(cached) is not None
+    assert cache.put_bytes(request("2022-01-01", "2022-01-05", -40, 35, 2, 62), large.to_netcdf()) is None
+
+    # A file filling the cache evicts the others, but never itself
+    path = str(tmp_path / "full.nc")
+    with open(path, "wb") as out:
+        out.write(data().to_netcdf())
+    full = request("2022-01-01", "2022-01-06", -40, 35, 2, 62)
+    cached_path = cache.put(full, path)
+    assert os.path.exists(cached_path) and cache.get(full) == cached_path
+    assert cache.get(cached) is None and cache.stats()["entries"] == 1
+
+
+def test_subset_reuse_needs_all_the_url_variables(tmp_path):
+    cache = DataCache(str(tmp_path))
+    cache.put_bytes(request("2022-01-01", "2022-01-03", -40, 35, 2, 62), data().to_netcdf())
+    # platform_number is requested by the tabledap URL but missing from the cached file
+    with_platform = "time%2Clatitude%2Clongitude%2Cplatform_number%2Ctemp"
+    assert cache.get_subset(request("2022-01-01", "2022-01-02", -40, 35, 2, 62, with_platform)) is None
+
+    platforms = data().assign(platform_number=("row", np.array(["6901"] * 48)))
+    cache.put_bytes(request("2022-01-01", "2022-01-03", -40, 35, 2, 62, with_platform), platforms.to_netcdf())
+    subset = cache.get_subset(request("2022-01-01T00:00:00Z", "2022-01-01T11:00:00Z", -40, 35, 2, 62, with_platform))
+    assert subset.sizes["row"] == 12
+    assert sorted(subset.data_vars) == ["latitude", "longitude", "platform_number", "temp", "time"]
+    # A request without platform_number can be sliced from either entry
+    assert "temp" in cache.get_subset(request("2022-01-01", "2022-01-02", -40, 35, 2, 62)).data_vars
@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from marine_eov_broker.DatasetIndex import DatasetIndex
+
+
+def fake_dataset(name, bbox, start_date, end_date):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return SimpleNamespace(name=name, min_lon=min_lon, min_lat=min_lat, max_lon=max_lon, max_lat=max_lat,
+                           start_date=np.datetime64(start_date) if start_date else None,
+                           end_date=np.datetime64(end_date) if end_date else None)
+
+
+datasets = [
+    fake_dataset("north_atlantic", (-60, 20, 10, 70), "2000-01-01", "2023-01-01"),
+    fake_dataset("mediterranean", (-6, 30, 36, 46), "1960-01-01", "1990-01-01"),
+    fake_dataset("pacific_0_360", (120, -60, 290, 60), "2000-01-01", None),
+    fake_dataset("no_coverage", (None, None, None, None), None, None),
+]
+index = DatasetIndex(datasets)
+
+
+def test_candidates():
+    names = [d.name for d in index.candidates("2022-01-16", "2022-01-17", -40, 35, 2, 62)]
+    assert names == ["north_atlantic", "pacific_0_360", "no_coverage"]
+
+
+def test_candidates_time_pruning():
+    names = [d.name for d in index.candidates("19700101", "1971-01-01T00:00:00Z", -40, 35, 20, 62)]
+    assert names == ["mediterranean", "no_coverage"]
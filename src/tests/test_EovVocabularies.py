@@ -0,0 +1,43 @@
+import threading
+import time
+
+import pytest
+
+from marine_eov_broker.MarineRiBroker import EovVocabularies
+
+
+class FakeResolver:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, eovs):
+        self.calls.append(list(eovs))
+        time.sleep(0.05)
+        return {eov: [{"P01not": f"SDN:P01::{eov}"}] for eov in eovs}
+
+
+def test_vocabularies_resolved_on_lookup():
+    resolver = FakeResolver()
+    vocabularies = EovVocabularies(resolver, ["EV_SEATEMP", "EV_NUTS"])
+    assert resolver.calls == [] and vocabularies.loaded() == {}
+    assert "EV_NUTS" in vocabularies and "EV_UNKNOWN" not in vocabularies
+    assert vocabularies["EV_SEATEMP"] == [{"P01not": "SDN:P01::EV_SEATEMP"}]
+    assert vocabularies["EV_SEATEMP"] is vocabularies["EV_SEATEMP"]
+    assert resolver.calls == [["EV_SEATEMP"]] and list(vocabularies.loaded()) == ["EV_SEATEMP"]
+    with pytest.raises(KeyError):
+        vocabularies["EV_UNKNOWN"]
+
+
+def test_concurrent_lookups_resolve_once():
+    resolver = FakeResolver()
+    vocabularies = EovVocabularies(resolver, ["EV_SEATEMP", "EV_SALIN", "EV_NUTS"])
+    threads = [threading.Thread(target=vocabularies.load, args=(eovs,))
+               for eovs in [["EV_SEATEMP", "EV_SALIN"], ["EV_SALIN", "EV_SEATEMP"], ["EV_SEATEMP"]] * 3]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert resolver.calls == [["EV_SEATEMP", "EV_SALIN"]] or resolver.calls == [["EV_SALIN", "EV_SEATEMP"]]
+    assert "EV_NUTS" not in vocabularies.loaded()
+    vocabularies.update({"EV_NUTS": []})
+    assert vocabularies["EV_NUTS"] == [] and len(resolver.calls) == 1
@@ -0,0 +1,155 @@
+import hashlib
+import io
+
+import pandas as pd
+import pytest
+
+from conftest import SERVER, TABLE_METADATA, StubTransport
+from marine_eov_broker.ErddapMarineRI import ErddapDataset, conditional_get
+
+METADATA = """Row Type,Variable Name,Attribute Name,Data Type,Value
+attribute,NC_GLOBAL,cdm_data_type,String,Grid
+attribute,NC_GLOBAL,title,String,Climatology
+attribute,NC_GLOBAL,summary,String,
+attribute,NC_GLOBAL,time_coverage_start,String,1960-01-16T00:00:00Z
+dimension,time,,double,"nValues=12, evenlySpaced=false, averageSpacing=30 days"
+attribute,time,units,String,seconds since 1970-01-01T00:00:00Z
+dimension,latitude,,double,"nValues=11, evenlySpaced=true, averageSpacing=0.25"
+variable,TEMP,,float,"time, latitude"
+attribute,TEMP,sdn_parameter_urn,String,SDN:P01::TEMPPR01
+attribute,TEMP,units,String,degree_Celsius
+variable,DEPTH,,short,"time, latitude"
+attribute,DEPTH,sdn_parameter_urn,String,SDN:P01::ADEPZZ01
+"""
+GRIDDAP_ATTRIBUTES = {"wms_time_values": ["1960-01-16T00:00:00Z"], "wms_elevation_values": [0.0], "bbox": [-10, 40, 0, 50]}
+
+
+def test_parsed_metadata():
+    dataset = ErddapDataset(SERVER, "Clim", metadata=METADATA, griddap_attributes=GRIDDAP_ATTRIBUTES)
+    assert dataset.protocol == "griddap"
+    assert dataset.global_attributes["title"] == "Climatology"
+    assert dataset.get_global_attribute("summary", "none") == "none"
+    assert dataset.variables["TEMP"] == {"sdn_parameter_urn": "SDN:P01::TEMPPR01", "units": "degree_Celsius"}
+    assert dataset.parameters == {"SDN:P01::TEMPPR01": "TEMP", "SDN:P01::ADEPZZ01": "DEPTH"}
+    assert dataset.depth_variables == ["DEPTH"]
+    assert dataset.dimension_spacing("latitude") == 0.25
+    assert dataset.dimension_spacing("time") is None
+    assert dataset.variable_size("DEPTH") == 2 and dataset.variable_size("unknown") == 8
+    assert dataset.metadata.shape == (12, 5)
+    with pytest.raises(AttributeError):
+        dataset.unknown_attribute = 1
+
+
+def test_record_round_trip():
+    dataset = ErddapDataset(SERVER, "Clim", metadata=METADATA, griddap_attributes=GRIDDAP_ATTRIBUTES)
+    copy = ErddapDataset.from_record(dataset.to_record())
+    assert copy.variables == dataset.variables
+    assert copy.dimensions == dataset.dimensions
+    assert copy.min_lon == -10 and len(copy.wms_time_values) == 1
+
+
+def test_summary_dataset_is_not_loaded():
+    dataset = ErddapDataset(SERVER, "Argo",
+                            summary={"dataStructure": "table", "minTime": "2000-01-01T00:00:00Z", "maxTime": None,
+                                     "minLongitude": -60, "maxLongitude": 10, "minLatitude": 20, "maxLatitude": 70})
+    assert dataset.protocol == "tabledap" and dataset.max_lat == 70
+    assert dataset.memory_size() > 0
+    assert not dataset.metadata_loaded
+    assert dataset.to_record()["metadata"] is None
+
+
+def test_conditional_get():
+    transport = StubTransport({"/info/Argo/index.csv": TABLE_METADATA})
+    url = f"{SERVER}/info/Argo/index.csv"
+    resp, validators = conditional_get(url, transport=transport)
+    assert resp.content == TABLE_METADATA.encode() and transport.headers[0] == {}
+    assert validators["etag"] == hashlib.sha1(TABLE_METADATA.encode()).hexdigest()
+    assert validators["checksum"] == validators["etag"] and validators["marker"] is None
+
+    validators["marker"] = "2000-01-01T00:00:00Z/None"
+    resp, revalidated = conditional_get(url, validators, transport)
+    assert resp is None and revalidated == validators
+    assert transport.headers[1] == {"If-None-Match": validators["etag"]}
+
+
+def test_revalidate():
+    transport = StubTransport({"/info/Argo/index.csv": TABLE_METADATA})
+    dataset = ErddapDataset(SERVER, "Argo", transport=transport)
+    assert dataset.parameters == {"SDN:P01::TEMPPR01": "temp", "SDN:P01::PRESPR01": "pres"}
+    validators = dict(dataset.validators)
+
+    # Unchanged allDatasets marker : no request
+    dataset.validators["marker"] = "2000-01-01T00:00:00Z/None"
+    assert dataset.revalidate("2000-01-01T00:00:00Z/None") is False
+    assert len(transport.urls) == 1
+
+    # Changed marker, unchanged metadata : the server answers 304 and the new marker is stored
+    assert dataset.revalidate("2000-01-01T00:00:00Z/2023-01-01T00:00:00Z") is False
+    assert transport.headers[-1] == {"If-None-Match": validators["etag"]}
+    assert dataset.validators == dict(validators, marker="2000-01-01T00:00:00Z/2023-01-01T00:00:00Z")
+
+    # Changed metadata : parsed again
+    transport.pages["/info/Argo/index.csv"] = TABLE_METADATA.replace("TEMPPR01", "TEMPST01")
+    assert dataset.revalidate() is True
+    assert dataset.parameters == {"SDN:P01::TEMPST01": "temp", "SDN:P01::PRESPR01": "pres"}
+    assert dataset.validators["etag"] != validators["etag"]
+    assert dataset.validators["marker"] == "2000-01-01T00:00:00Z/2023-01-01T00:00:00Z"
+
+
+def grid_dataset(time_values):
+    return ErddapDataset(SERVER, "Clim", metadata=METADATA,
+                         griddap_attributes=dict(GRIDDAP_ATTRIBUTES, wms_time_values=time_values))
+
+
+def test_griddap_time_indices():
+    dataset = grid_dataset([f"1960-{month:02d}-16T00:00:00Z" for month in range(1, 13)])
+    # Both bounds are included
+    assert dataset.griddap_time_indices("1960-02-16T00:00:00Z", "1960-04-16T00:00:00Z") == (1, 4)
+    assert dataset.griddap_time_indices("1960-02-01", "1960-04-01") == (1, 3)
+    assert dataset.griddap_time_indices(None, "1960-01-16T00:00:00Z") == (0, 1)
+    assert dataset.griddap_time_indices("1960-12-16T00:00:00Z", None) == (11, 12)
+    # No time value within the query
+    assert dataset.griddap_time_indices("1960-02-17", "1960-03-15") == (2, 2)
+    assert dataset.griddap_time_indices("1961-01-01", "1961-12-31") == (12, 12)
+    assert dataset.griddap_time_indices("1960-05-01", "1960-03-01") == (4, 4)
+
+    single = grid_dataset(["1960-01-16T00:00:00Z"])
+    assert single.griddap_time_indices("1960-01-16T00:00:00Z", "1960-01-16T00:00:00Z") == (0, 1)
+    assert single.griddap_time_indices("1960-01-01", "1960-01-15") == (0, 0)
+    assert single.griddap_time_indices("1960-01-17", "1960-12-31") == (1, 1)
+
+
+def test_covers_griddap_query():
+    dataset = grid_dataset([f"1960-{month:02d}-16T00:00:00Z" for month in range(1, 13)])
+    assert dataset.covers_griddap_query("1960-03-16T00:00:00Z", "1960-03-16T00:00:00Z", -5, 42, -2, 45)
+    assert not dataset.covers_griddap_query("1960-03-17", "1960-04-15", -5, 42, -2, 45)
+    assert not dataset.covers_griddap_query("1960-03-01", "1960-04-01", 20, 42, 30, 45)
+
+    single = grid_dataset(["1960-01-16T00:00:00Z"])
+    assert single.covers_griddap_query("1960-01-01", "1960-12-31", -5, 42, -2, 45)
+    assert not single.covers_griddap_query("1960-02-01", "1960-12-31", -5, 42, -2, 45)
+
+
+def large_metadata(variables=60):
+    """
+    info/index.csv table of a dataset with many variables & attributes, like the Argo or glider datasets.
+    """
+    rows = ["Row Type,Variable Name,Attribute Name,Data Type,Value",
+            "attribute,NC_GLOBAL,cdm_data_type,String,TrajectoryProfile",
+            f"attribute,NC_GLOBAL,summary,String,\"{'Long summary of the dataset. ' * 20}\""]
+    rows += [f"attribute,NC_GLOBAL,attribute{index},String,value {index}" for index in range(30)]
+    for variable in range(variables):
+        rows.append(f"variable,var{variable},,float,")
+        rows += [f"attribute,var{variable},{name},String,{name} of var{variable}"
+                 for name in ["long_name", "standard_name", "units", "ioos_category", "comment", "C_format"]]
+        rows.append(f"attribute,var{variable},sdn_parameter_urn,String,SDN:P01::CODE{variable:04d}")
+    return "\n".join(rows) + "\n"
+
+
+def test_memory_size_below_metadata_table():
+    metadata = large_metadata()
+    dataset = ErddapDataset(SERVER, "Argo", metadata=metadata)
+    assert len(dataset.parameters) == 60
+    # Footprint of the metadata DataFrame previously kept by each dataset (object columns with pandas < 3).
+    table_size = pd.read_csv(io.StringIO(metadata), dtype=object).memory_usage(deep=True).sum()
+    assert dataset.memory_size() < 0.75 * table_size
@@ -0,0 +1,272 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+import xarray as xr
+
+from conftest import GRID_ATTRIBUTES, GRID_METADATA, GRID_TIMES, SERVER, TABLE_METADATA
+from marine_eov_broker.ErddapMarineRI import ErddapDataset
+from marine_eov_broker.MarineRiBroker import ErddapRequest, MarineBroker, period_to_seconds
+
+TABLE_CSV = """platform_number,time,latitude,longitude,temp,pres
+,UTC,degrees_north,degrees_east,degree_Celsius,decibar
+6901,2022-01-01T00:00:00Z,40.0,-20.0,12.5,5.0
+6901,2022-01-01T00:00:00Z,40.0,-20.0,12.1,10.0
+6901,2022-01-01T00:00:00Z,40.0,-20.0,,15.0
+,2022-01-02T00:00:00Z,41.0,-21.0,,5.0
+,2022-01-02T00:00:00Z,41.0,-21.0,,10.0
+6902,2022-01-03T00:00:00Z,42.0,-22.0,11.0,5.0
+6902,2022-01-03T00:00:00Z,42.0,-22.0,10.5,10.0
+6902,2022-01-03T00:00:00Z,42.0,-22.0,,15.0
+"""
+
+
+def grid_dataset(server=SERVER):
+    return ErddapDataset(server, "Clim", metadata=GRID_METADATA, griddap_attributes=GRID_ATTRIBUTES)
+
+
+def table_request(start="2022-01-01T00:00:00Z", end="2022-12-31T23:59:59Z", bbox=(-40, 35, 2, 62), transport=None,
+                  **options):
+    dataset = ErddapDataset(SERVER, "ArgoFloats", metadata=TABLE_METADATA, transport=transport)
+    return ErddapRequest(dataset, ["temp"], *bbox, start, end, "nc", **options)
+
+
+def grid_request(dataset, start="1960-01-01", end="1960-12-31", bbox=(-10, 40, 0, 50), **options):
+    return ErddapRequest(dataset, ["TEMP"], *bbox, start, end, "nc", **options)
+
+
+def test_dask_xarray_applies_depth_range_and_strides(tmp_path):
+    # The OPeNDAP endpoint of the dataset is a local file
+    (tmp_path / "griddap").mkdir()
+    xr.Dataset({"TEMP": (("time", "depth", "latitude", "longitude"), np.random.rand(12, 4, 11, 11).astype("f4"))},
+               coords={"time": pd.to_datetime(GRID_TIMES).tz_localize(None), "depth": [0.0, 50.0, 100.0, 150.0],
+                       "latitude": np.arange(40.0, 51.0), "longitude": np.arange(-10.0, 1.0)}
+               ).to_netcdf(tmp_path / "griddap" / "Clim")
+    request = grid_request(grid_dataset(str(tmp_path)), "1960-02-01", "1960-07-01", (-8, 41, -2, 49),
+                           depth_range=(40, 160), strides={"time": 2, "depth": 2, "latitude": 3})
+    ds = request.to_dask_xarray()
+    assert ds["depth"].values.tolist() == [50.0, 150.0]
+    assert np.datetime_as_string(ds["time"].values, unit="D").tolist() == ["1960-02-16", "1960-04-16", "1960-06-16"]
+    assert ds["latitude"].values.tolist() == [41.0, 44.0, 47.0]
+    assert ds["longitude"].values.tolist() == list(np.arange(-8.0, -1.0))
+    assert ds["TEMP"].chunks[:2] == ((1, 1, 1), (1, 1))
+    assert "[(50.0):2:(150.0)]" in request.query_url
+
+
+def seconds(date):
+    return np.datetime64(date.rstrip("Z"), "s")
+
+
+def milliseconds(date):
+    return np.datetime64(date.rstrip("Z"), "ms")
+
+
+def test_split_time_tiles_the_time_range():
+    request = table_request()
+    sub_requests = request.split_time(7)
+    assert len(sub_requests) == 7
+    assert sub_requests[0].query_start_date == request.query_start_date
+    assert sub_requests[-1].query_end_date == request.query_end_date
+    # Both time bounds are included : each window starts one millisecond after the end of the previous one
+    for previous, sub_request in zip(sub_requests, sub_requests[1:]):
+        assert previous.query_end_date.endswith(".999Z")
+        assert milliseconds(sub_request.query_start_date) - milliseconds(previous.query_end_date) == np.timedelta64(1, "ms")
+        # A value half a second before the next window is in the previous one
+        value = milliseconds(sub_request.query_start_date) - np.timedelta64(500, "ms")
+        assert milliseconds(previous.query_start_date) <= value <= milliseconds(previous.query_end_date)
+    for sub_request in sub_requests:
+        assert seconds(sub_request.query_start_date) <= seconds(sub_request.query_end_date)
+        assert (sub_request.query_min_lon, sub_request.query_min_lat, sub_request.query_max_lon, sub_request.query_max_lat) == (-40, 35, 2, 62)
+    # Windows shorter than a second are merged
+    assert len(table_request("2022-01-01T00:00:00Z", "2022-01-01T00:00:02Z").split_time(10)) == 2
+    # Aggregation bins would be cut by the windows
+    aggregated = table_request(aggregation={"time": "1month"})
+    assert aggregated.split_time(4) == [aggregated]
+
+
+def test_split_time_tiles_griddap_time_values():
+    for strides in ({}, {"time": 2}):
+        request = grid_request(grid_dataset(), strides=strides)
+        sub_requests = request.split_time(5)
+        assert len(sub_requests) == 5
+        expected = list(range(0, 12, strides.get("time", 1)))
+        indices = []
+        for sub_request in sub_requests:
+            first, last = request.dataset.griddap_time_indices(sub_request.query_start_date, sub_request.query_end_date)
+            indices.extend(range(first, last, sub_request.strides["time"]))
+        assert indices == expected
+    single = grid_request(grid_dataset(), "1960-01-01", "1960-01-31")
+    assert single.split_time(3) == [single]
+
+
+def test_split_space_tiles_the_bbox():
+    request = table_request()
+    bands = request.split_space(3)
+    assert bands[0].query_min_lon == -40 and bands[-1].query_max_lon == 2
+    # Both longitude bounds are included : each band starts just after the end of the previous one
+    for previous, band in zip(bands, bands[1:]):
+        assert band.query_min_lon == np.nextafter(previous.query_max_lon, np.inf)
+    assert all((band.query_min_lat, band.query_max_lat) == (35, 62) for band in bands)
+    assert all(band.query_start_date == request.query_start_date and band.query_end_date == request.query_end_date
+               for band in bands)
+    grid = grid_request(grid_dataset())
+    assert grid.split_space(3) == [grid]
+
+
+def test_split_request_covers_each_point_once():
+    request = table_request()
+    split = MarineBroker({}).split_request(request, time_chunks=4, space_chunks=3)
+    assert len(split.sub_requests) == 12
+    times = np.arange(seconds(request.query_start_date), seconds(request.query_end_date) + 1, np.timedelta64(7, "D"))
+    times = np.concatenate([times, [seconds(sub.query_end_date) for sub in split.sub_requests]])
+    longitudes = np.concatenate([np.linspace(-40, 2, 85), [sub.query_max_lon for sub in split.sub_requests]])
+    for time in times:
+        for lon in longitudes:
+            matches = [sub for sub in split.sub_requests
+                       if seconds(sub.query_start_date) <= time <= seconds(sub.query_end_date)
+                       and sub.query_min_lon <= lon <= sub.query_max_lon]
+            assert len(matches) == 1
+
+
+def test_period_to_seconds():
+    assert period_to_seconds("1day") == 86400
+    assert period_to_seconds("3months") == 3 * 30.4375 * 86400
+    assert period_to_seconds(" 2 Hours ") == 7200
+    assert period_to_seconds("1.5days") == 1.5 * 86400
+    assert period_to_seconds("week") == 7 * 86400
+    with pytest.raises(Exception, match="Invalid time period"):
+        period_to_seconds("1fortnight")
+    with pytest.raises(Exception, match="Invalid time period"):
+        period_to_seconds("-1day")
+
+
+def test_tabledap_aggregation_url():
+    request = table_request(aggregation={"time": "1month", "latitude": 1, "longitude": 2})
+    url = request.query_url
+    # Aggregated values are not linked to a platform
+    assert url.startswith("https://www.ifremer.fr/erddap/tabledap/ArgoFloats.nc?time%2Clatitude%2Clongitude%2Ctemp%2Cpres&")
+    assert url.endswith('&longitude%3C=2&orderByMean(%22time/1month,latitude/1,longitude/2%22)')
+    assert request.count_url().endswith("&orderByCount(%22%22)") and "orderByMean" not in request.count_url()
+
+    request.set_aggregation({"time": "1year", "depth": 10, "function": "count"})
+    assert request.query_url.endswith("&orderByCount(%22time/1year,pres/10%22)")
+    assert request.aggregation == {"time": "1year", "depth": 10, "function": "count"}
+    assert request.is_subset()
+
+    request.set_aggregation(None)
+    assert request.aggregation is None and "orderBy" not in request.query_url
+    assert "platform_number%2Ctemp" in request.query_url and not request.is_subset()
+
+
+def test_griddap_aggregation_strides():
+    request = grid_request(grid_dataset(), aggregation={"time": "2months", "latitude": 2, "longitude": 3})
+    assert request.strides == {"time": 2, "depth": 1, "latitude": 2, "longitude": 3}
+    assert "orderBy" not in request.query_url
+    assert "TEMP[(1960-01-16T00:00:00Z):2:(1960-12-16T00:00:00Z)]" in request.query_url
+    assert request.query_url.endswith("[(40):2:(50)][(-10):3:(0)]")
+
+
+def test_invalid_aggregation():
+    request = table_request()
+    with pytest.raises(Exception, match="Unknown aggregation keys"):
+        request.set_aggregation({"salinity": 1})
+    with pytest.raises(Exception, match="Aggregation function median"):
+        request.set_aggregation({"time": "1day", "function": "median"})
+    with pytest.raises(Exception, match="Invalid time period"):
+        request.set_aggregation({"time": "daily"})
+    assert request.aggregation is None and "orderBy" not in request.query_url
+
+
+class StreamedResponse:
+    """
+    Streamed response yielding chunks, and raising requests.ConnectionError after failing_after chunks.
+    """
+
+    def __init__(self, chunks, status_code=200, failing_after=None):
+        self.chunks = chunks
+        self.status_code = status_code
+        self.failing_after = failing_after
+        self.headers = {"Content-Length": str(sum(len(chunk) for chunk in chunks))}
+        self.closed = False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error", response=self)
+
+    def iter_content(self, chunk_size=1):
+        for index, chunk in enumerate(self.chunks):
+            if index == self.failing_after:
+                raise requests.ConnectionError("Connection broken: IncompleteRead")
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class StreamTransport:
+    def __init__(self, resp):
+        self.resp = resp
+
+    def get(self, url, stream=False, **kwargs):
+        assert stream
+        return self.resp
+
+
+def test_stream_to_file(tmp_path):
+    resp = StreamedResponse([b"CDF", b"data"])
+    request = table_request(transport=StreamTransport(resp))
+    progress = []
+    path = str(tmp_path / "argo.nc")
+    assert request.stream_to_file(path, progress=lambda done, total: progress.append((done, total))) == path
+    assert open(path, "rb").read() == b"CDFdata" and os.listdir(tmp_path) == ["argo.nc"]
+    assert progress == [(3, 7), (7, 7)] and resp.closed
+
+
+def test_stream_to_file_failing_halfway(tmp_path):
+    path = str(tmp_path / "argo.nc")
+    resp = StreamedResponse([b"CDF", b"data"], failing_after=1)
+    request = table_request(transport=StreamTransport(resp))
+    progress = []
+    with pytest.raises(requests.ConnectionError):
+        request.stream_to_file(path, progress=lambda done, total: progress.append(os.listdir(tmp_path)))
+    # The .part file was written, then removed with the failure
+    assert progress == [["argo.nc.part"]]
+    assert os.listdir(tmp_path) == [] and resp.closed
+
+    resp = StreamedResponse([b"Not Found"], status_code=404)
+    with pytest.raises(requests.HTTPError):
+        table_request(transport=StreamTransport(resp)).stream_to_file(path)
+    assert os.listdir(tmp_path) == [] and resp.closed
+
+
+def test_arrow_batches_share_a_schema(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    # NetCDF file of the tabledap result, as downloaded by get_nc_file()
+    df = pd.read_csv(io.StringIO(TABLE_CSV), skiprows=[1], dtype={"platform_number": str}, keep_default_na=False,
+                     na_values={"temp": [""]}, parse_dates=["time"])
+    df["time"] = df["time"].dt.tz_localize(None)
+    df.index.name = "row"
+    df.to_xarray().to_netcdf(tmp_path / "argo.nc")
+    request = table_request()
+    request.dataset.found_eovs = {"EV_SEATEMP": ["temp"], "EV_PRES": ["pres"]}
+    request.nc_file = str(tmp_path / "argo.nc")
+
+    batches = list(request.iter_arrow_batches(["temp"], batch_rows=2))
+    # The rows without temperature are dropped, the chunk of rows 2 & 3 is empty
+    assert [batch.num_rows for batch in batches] == [2, 1, 1]
+    assert all(batch.schema == batches[0].schema for batch in batches)
+    assert batches[0].schema.names == ["row", "platform_number", "time", "latitude", "longitude", "temp"]
+    assert batches[0].schema.field("time").type == pa.timestamp("ns")
+    assert batches[0].schema.field("platform_number").type == pa.string()
+
+    batches = list(request.iter_arrow_batches(batch_rows=3, dropna=False))
+    assert [batch.num_rows for batch in batches] == [3, 3, 2]
+    assert all(batch.schema == batches[0].schema for batch in batches)
+    assert "pres" in batches[0].schema.names
+
+    table = request.to_arrow(["temp"])
+    assert table.num_rows == 4 and table.column("temp").to_pylist() == [12.5, 12.1, 11.0, 10.5]
+    assert table.column("platform_number").to_pylist() == ["6901", "6901", "6902", "6902"]
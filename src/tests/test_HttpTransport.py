@@ -0,0 +1,142 @@
+import http.server
+import io
+import threading
+
+import pytest
+import requests
+
+from marine_eov_broker import HttpTransport as http_transport
+from marine_eov_broker.HttpTransport import HttpTransport
+
+URL = "https://www.ifremer.fr/erddap/tabledap/ArgoFloats.nc"
+
+
+class StubAdapter(requests.adapters.BaseAdapter):
+    """
+    Transport adapter answering every request with a 200 response, or raising error.
+    """
+
+    def __init__(self, error=None):
+        super().__init__()
+        self.error = error
+        self.sent = 0
+
+    def send(self, request, **kwargs):
+        self.sent += 1
+        if self.error is not None:
+            raise self.error
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.raw = io.BytesIO(b"data")
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+def stub_transport(max_per_host=2, error=None):
+    transport = HttpTransport(max_per_host=max_per_host)
+    adapter = StubAdapter(error)
+    transport.session.mount("https://", adapter)
+    return transport, adapter
+
+
+def free_slots(transport, url=URL):
+    semaphore = transport.host_semaphore(url)
+    slots = 0
+    while semaphore.acquire(blocking=False):
+        slots += 1
+    for _ in range(slots):
+        semaphore.release()
+    return slots
+
+
+def test_slot_released_after_response():
+    transport, adapter = stub_transport()
+    assert transport.get(URL).content == b"data"
+    assert free_slots(transport) == 2 and adapter.sent == 1
+
+
+def test_slot_kept_until_streamed_response_closed():
+    transport, _ = stub_transport()
+    first = transport.get(URL, stream=True)
+    second = transport.get(URL, stream=True)
+    assert free_slots(transport) == 0
+    # Other hosts are not blocked
+    assert free_slots(transport, "https://erddap.emodnet.eu/erddap") == 2
+    assert b"".join(first.iter_content(2)) == b"data"
+    first.close()
+    assert free_slots(transport) == 1
+    # Closing again does not release the slot twice
+    first.close()
+    assert free_slots(transport) == 1
+    with second:
+        pass
+    assert free_slots(transport) == 2
+
+
+def test_slot_released_on_exception():
+    transport, adapter = stub_transport(error=requests.ConnectionError("Connection refused"))
+    for stream in (False, True):
+        with pytest.raises(requests.ConnectionError):
+            transport.get(URL, stream=stream)
+    assert free_slots(transport) == 2 and adapter.sent == 2
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers 503 to the first `failures` requests, then 200.
+    """
+    failures = 2
+    calls = 0
+
+    def do_GET(self):
+        type(self).calls += 1
+        status = 503 if type(self).calls <= type(self).failures else 200
+        body = b"unavailable" if status == 503 else b"done"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_slot_released_after_retries():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/erddap/info/index.csv"
+    try:
+        transport = HttpTransport(max_per_host=1, retries=3, backoff_factor=0)
+        resp = transport.get(url)
+        assert resp.status_code == 200 and resp.content == b"done" and FlakyHandler.calls == 3
+        assert free_slots(transport, url) == 1
+
+        # Retries exhausted : the last error response is returned
+        FlakyHandler.calls, FlakyHandler.failures = 0, 10
+        with transport.get(url, stream=True) as resp:
+            assert resp.status_code == 503 and FlakyHandler.calls == 4
+        assert free_slots(transport, url) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_default_transport_created_once(monkeypatch):
+    monkeypatch.setattr(http_transport, "DEFAULT_TRANSPORT", None)
+    barrier = threading.Barrier(8)
+    transports = []
+
+    def get_default():
+        barrier.wait()
+        transports.append(http_transport.default_transport())
+
+    threads = [threading.Thread(target=get_default) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(transports) == 8 and all(transport is transports[0] for transport in transports)
@@ -0,0 +1,175 @@
+import threading
+import time
+
+import requests
+
+from conftest import (ALL_DATASETS, GRID_ATTRIBUTES, GRID_METADATA, SERVER, TABLE_METADATA, VOCABULARIES,
+                      StubTransport)
+from marine_eov_broker.ErddapMarineRI import ErddapDataset
+from marine_eov_broker.MarineRiBroker import ErddapRequest, MarineBroker
+
+
+def offline_broker(datasets=()):
+    """
+    Broker without any Erddap server nor vocabulary server, whose datasets are registered by the test.
+    """
+    broker = MarineBroker({})
+    broker.vocabularies.update(VOCABULARIES)
+    for dataset in datasets:
+        broker.register_dataset(dataset)
+    return broker
+
+
+def test_find_eov_in_dataset_is_an_index_lookup(monkeypatch):
+    dataset = ErddapDataset(SERVER, "ArgoFloats", metadata=TABLE_METADATA)
+    broker = offline_broker([dataset])
+    assert broker.candidate_datasets(["EV_SEATEMP"], "2022-01-16", "2022-01-17", -40, 35, 2, 62) == [dataset]
+
+    def not_called(*args):
+        raise AssertionError("the index is updated once per request, by candidate_datasets()")
+    monkeypatch.setattr(broker, "load_datasets_metadata", not_called)
+    monkeypatch.setattr(broker, "update_index", not_called)
+    assert list(broker.find_variables_in_dataset(dataset, ["EV_SEATEMP", "EV_OXY"])) == ["temp"]
+    assert dataset.found_eovs == {"EV_SEATEMP": ["temp"]}
+    # Vocabularies other than the broker ones are matched against the dataset only
+    assert list(broker.find_eov_in_dataset(dataset, "EV_OXY", [{"P01not": "SDN:P01::PRESPR01"}])) == ["pres"]
+
+
+def test_refresh_skips_datasets_with_unchanged_markers():
+    transport = StubTransport({"/tabledap/allDatasets.csv": ALL_DATASETS})
+    broker = MarineBroker({SERVER: None}, transport=transport)
+    assert sorted(dataset.name for dataset in broker.datasets) == ["ArgoFloats", "Ongoing"]
+    transport.urls.clear()
+
+    assert broker.refresh() == []
+    # The markers are read from the allDatasets table downloaded for the datasets list, a missing maxTime included
+    assert transport.urls == [f"{SERVER}/tabledap/allDatasets.csv?datasetID%2CdataStructure%2Ccdm_data_type"
+                              "%2CminLongitude%2CmaxLongitude%2CminLatitude%2CmaxLatitude%2CminTime%2CmaxTime"]
+    assert {dataset.name: dataset.validators["marker"] for dataset in broker.datasets} == {
+        "ArgoFloats": "2000-01-01T00:00:00Z/2023-01-01T00:00:00Z", "Ongoing": "2010-01-01T00:00:00Z/None"}
+
+
+def test_refresh_stores_markers_of_new_datasets():
+    transport = StubTransport({"/tabledap/allDatasets.csv": ALL_DATASETS,
+                               "/info/index.csv": "Dataset ID\nallDatasets\nArgoFloats\n",
+                               "/info/ArgoFloats/index.csv": TABLE_METADATA, "/info/Ongoing/index.csv": TABLE_METADATA})
+    broker = MarineBroker({SERVER: None}, transport=transport, bulk_metadata=False)
+    assert [dataset.validators["marker"] for dataset in broker.datasets] == ["2000-01-01T00:00:00Z/2023-01-01T00:00:00Z"]
+
+    transport.pages["/info/index.csv"] += "Ongoing\n"
+    transport.urls.clear()
+    changed = broker.refresh()
+    assert [dataset.name for dataset in changed] == ["Ongoing"]
+    assert changed[0].validators["marker"] == "2010-01-01T00:00:00Z/None"
+    assert transport.requested("/info/ArgoFloats/index.csv") == []
+
+    transport.urls.clear()
+    assert broker.refresh() == []
+    assert transport.requested("/info/ArgoFloats/index.csv") == transport.requested("/info/Ongoing/index.csv") == []
+
+
+def table_request(rows, **options):
+    request = ErddapRequest(ErddapDataset(SERVER, "ArgoFloats", metadata=TABLE_METADATA), ["temp"],
+                            -40, 35, 2, 62, "2022-01-01T00:00:00Z", "2022-12-31T23:59:59Z", "nc", **options)
+    request.estimated_rows = rows
+    return request
+
+
+def grid_request(start="1960-01-01", end="1960-12-31"):
+    dataset = ErddapDataset(SERVER, "Clim", metadata=GRID_METADATA, griddap_attributes=GRID_ATTRIBUTES)
+    return offline_broker().estimate_request(ErddapRequest(dataset, ["TEMP"], -10, 40, 0, 50, start, end, "nc"))
+
+
+def test_apply_budget_drop():
+    broker = offline_broker()
+    small, large, unknown = table_request(100), table_request(1000), table_request(None)
+    kept, dropped = broker.apply_budget([small, large, unknown], max_rows=500, policy="drop", estimated=True)
+    assert kept == [small, unknown] and dropped == [large]
+    assert large.dropped_reason == "1000 rows exceed the budget of 500 rows" and small.dropped_reason is None
+
+
+def test_apply_budget_split():
+    broker = offline_broker()
+    large = table_request(1000)
+    kept, dropped = broker.apply_budget([large], max_rows=300, policy="split", estimated=True)
+    assert len(kept) == 4 and dropped == []
+    assert [request.estimated_rows for request in kept] == [250] * 4
+    assert kept[0].query_start_date == large.query_start_date and kept[-1].query_end_date == large.query_end_date
+
+    # Aggregation bins would be cut by the time windows : the request is dropped
+    aggregated = table_request(1000, aggregation={"time": "1month"})
+    kept, dropped = broker.apply_budget([aggregated], max_rows=300, policy="split", estimated=True)
+    assert kept == [] and dropped == [aggregated]
+    assert aggregated.dropped_reason == "1000 rows exceed the budget of 300 rows and the request can not be split"
+
+    # A single griddap time value can not be split : the request is downsampled
+    single = grid_request("1960-01-16", "1960-01-16")
+    assert single.estimated_rows == 4 * 11 * 11
+    kept, dropped = broker.apply_budget([single], max_rows=100, policy="split", estimated=True)
+    assert kept == [single] and dropped == []
+    assert single.estimated_rows <= 100 and single.strides["latitude"] > 1
+
+    grid = grid_request()
+    kept, dropped = broker.apply_budget([grid], max_rows=2000, policy="split", estimated=True)
+    assert len(kept) == 3 and all(request.estimated_rows <= 2000 for request in kept)
+
+
+def test_apply_budget_downsample():
+    broker = offline_broker()
+    grid = grid_request()
+    assert grid.estimated_rows == 12 * 4 * 11 * 11
+    kept, dropped = broker.apply_budget([grid], max_rows=1000, policy="downsample", estimated=True)
+    assert kept == [grid] and dropped == []
+    assert grid.estimated_rows <= 1000 and grid.strides["latitude"] == grid.strides["longitude"] > 1
+
+    # Tabledap requests are split
+    kept, dropped = broker.apply_budget([table_request(1000)], max_rows=500, policy="downsample", estimated=True)
+    assert len(kept) == 2 and dropped == []
+
+    aggregated = table_request(1000, aggregation={"time": "1month"})
+    kept, dropped = broker.apply_budget([aggregated], max_rows=500, policy="downsample", estimated=True)
+    assert kept == [] and dropped == [aggregated]
+
+
+class ServersTransport(StubTransport):
+    """
+    StubTransport also answering for a server refusing connections and a server blocked until release is set.
+    """
+    BROKEN = "https://broken.example.org/erddap"
+    SLOW = "https://slow.example.org/erddap"
+
+    def __init__(self, pages):
+        super().__init__(pages)
+        self.release = threading.Event()
+
+    def get(self, url, **kwargs):
+        if url.startswith(self.BROKEN):
+            raise requests.ConnectionError(f"Connection refused : {url}")
+        if url.startswith(self.SLOW):
+            self.release.wait(30)
+            url = SERVER + url[len(self.SLOW):]
+        return super().get(url, **kwargs)
+
+
+def test_failing_servers_do_not_block_the_others():
+    transport = ServersTransport({"/tabledap/allDatasets.csv": ALL_DATASETS})
+    start = time.time()
+    broker = MarineBroker({SERVER: None, transport.BROKEN: None, transport.SLOW: None},
+                          transport=transport, server_timeout=0.5)
+    try:
+        assert time.time() - start < 10
+        assert sorted(dataset.name for dataset in broker.datasets) == ["ArgoFloats", "Ongoing"]
+        assert set(broker.failed_servers) == {transport.BROKEN, transport.SLOW}
+        assert broker.failed_servers[transport.BROKEN].startswith("Could not get datasets list : ConnectionError")
+        assert broker.failed_servers[transport.SLOW] == "Still loading after 0.5 seconds"
+
+        status = broker.servers_status()
+        assert status.status.to_dict() == {SERVER: "ready", transport.BROKEN: "failed", transport.SLOW: "loading"}
+        assert status.datasets.to_dict() == {SERVER: 2, transport.BROKEN: 0, transport.SLOW: 0}
+        assert status.error.notna().to_dict() == {SERVER: False, transport.BROKEN: True, transport.SLOW: True}
+    finally:
+        transport.release.set()
+    # The slow server keeps loading in background
+    broker.ready[transport.SLOW].result(timeout=10)
+    assert broker.servers_status().status[transport.SLOW] != "loading"
+    assert broker.failed_servers[transport.BROKEN].startswith("Could not get datasets list")
@@ -55,6 +55,12 @@ def test_find_eov_in_dataset(eov, assert_var):
     assert found_vars[0] == assert_var
 
 
+@pytest.mark.parametrize("eov, assert_var", dataset_tests)
+def test_datasets_for_eov(eov, assert_var):
+    eov_datasets = broker.datasets_for_eov(eov)
+    assert assert_var in eov_datasets[broker.datasets[0]]
+
+
 def test_submit_sparql_query():
     response = broker.submit_sparql_query(
         qry,
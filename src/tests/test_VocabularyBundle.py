@@ -0,0 +1,33 @@
+import pytest
+
+from marine_eov_broker.VocabularyBundle import VocabularyBundle
+
+VOCABULARIES = {
+    "EV_SEATEMP": [
+        {"p01_mem": "http://vocab.nerc.ac.uk/collection/P01/current/TEMPPR01/", "P01not": "SDN:P01::TEMPPR01",
+         "p01lbl": "Temperature of the water body", "P02not": "SDN:P02::TEMP", "R03not": "SDN:R03::TEMP"},
+        {"p01_mem": "http://vocab.nerc.ac.uk/collection/P01/current/TEMPST01/", "P01not": "SDN:P01::TEMPST01",
+         "p01lbl": "Temperature of the water body by thermistor", "P02not": "SDN:P02::TEMP"},
+    ],
+    "EV_OXY": [],
+}
+
+
+def sorted_rows(vocabularies):
+    return {eov: sorted(rows, key=lambda row: row["P01not"]) for eov, rows in vocabularies.items()}
+
+
+@pytest.mark.parametrize("file_name", ["vocabularies.json", "vocabularies.ttl"])
+def test_bundle_round_trip(tmp_path, file_name):
+    bundle = VocabularyBundle(VOCABULARIES, source="https://vocab.nerc.ac.uk/sparql/")
+    bundle.save(tmp_path / file_name)
+    copy = VocabularyBundle.load(tmp_path / file_name)
+    assert sorted_rows(copy.vocabularies) == sorted_rows(VOCABULARIES)
+    assert copy.source == bundle.source and copy.created == bundle.created and copy.version == bundle.version
+
+
+def test_unsupported_version():
+    record = VocabularyBundle(VOCABULARIES).to_record()
+    record["version"] += 1
+    with pytest.raises(Exception, match="Unsupported"):
+        VocabularyBundle.from_record(record)
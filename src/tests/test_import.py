@@ -0,0 +1,53 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+import marine_eov_broker
+
+# Dependencies which must only be imported when they are first used
+HEAVY_MODULES = ["pandas", "xarray", "shapely", "pykg2tbl", "rdflib", "pyarrow", "jinja2"]
+SRC_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(marine_eov_broker.__file__)))
+
+
+def run_python(code, cwd):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([SRC_FOLDER, os.environ.get("PYTHONPATH", "")]))
+    output = subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout)
+
+
+def import_module(module, cwd):
+    """
+    Imports a module in a new interpreter, returns the import time in seconds & the heavy modules imported.
+    """
+    return run_python(f"""
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps([time.perf_counter() - start, [m for m in {HEAVY_MODULES} if m in sys.modules]]))
+""", cwd)
+
+
+def test_import_is_lazy(tmp_path):
+    for module in ["marine_eov_broker.MarineRiBroker", "marine_eov_broker.NVSQueries", "marine_eov_broker.ErddapMarineRI"]:
+        duration, imported = import_module(module, tmp_path)
+        assert imported == [], f"{module} imports {imported}"
+
+
+def test_templates_found_from_any_folder(tmp_path):
+    queries = run_python("""
+import json
+from marine_eov_broker.NVSQueries import DEFAULT_QUERY_STRINGS
+print(json.dumps(DEFAULT_QUERY_STRINGS))
+""", tmp_path)
+    assert "A05/current/EV_NUTS/" in queries["EV_NUTS"]
+
+
+if __name__ == "__main__":
+    # Import time benchmark : python src/tests/test_import.py [runs]
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for module in ["marine_eov_broker.NVSQueries", "marine_eov_broker.ErddapMarineRI",
+                   "marine_eov_broker.MarineRiBroker", "marine_eov_broker.AsyncMarineRiBroker"]:
+        durations = [import_module(module, os.getcwd())[0] for _ in range(runs)]
+        print(f"{module:40} median {statistics.median(durations) * 1000:7.1f} ms, min {min(durations) * 1000:7.1f} ms")